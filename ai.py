@@ -14,23 +14,49 @@ This module needs access to the currently active bot.
 The bot can be given to the module by calling `link_bot`.
 If the bot is changed, `link_bot` needs to be called again.
 
+Embeddings are NumPy float32 arrays from `embed_strings` all the way into the vector database.
+Check them with `is None`, as the truth value of an array is ambiguous.
+
 FUNCTIONS
 ---------
 link_bot
 
 embed_strings
 
+aembed_strings
+
 create_channel_memory_if_new
 
 remove_channel_memory_if_exist
 
+embedding_text
+
+ingest_history
+
+start_history_ingestion
+
+stop_history_ingestion
+
+sync_channel
+
 add_messages_into_memory
 
+retrieve_long_term_memory
+
+expand_hits
+
+replay_failed_saves
+
+start_spooler
+
+stop_spooler
+
 respond
 '''
 
-import openai, os, json, datetime, asyncio
-import debug, prompt, vectorDatabase, cog
+import openai, os, json, datetime, asyncio, time, random, threading
+import numpy as np
+import debug, prompt, vectorDatabase, indexManager, embeddingCache, shortTermMemory, syncState, memorySpool, cog
 openai.api_key = os.environ["API_KEY_OPENAI"]
 
 w  = debug.Fore.WHITE
@@ -40,21 +66,50 @@ ly = debug.Fore.LIGHTYELLOW_EX
 lr = debug.Fore.LIGHTRED_EX
 
 
+EMBEDDING_MODEL = "text-embedding-ada-002"
 EMBEDDING_TRUE_MAX_TOKEN_SIZE = 8191
 
 EMBEDDING_MAX_BATCH_SIZE = 1000
+EMBEDDING_MAX_BATCH_TOKENS = 50000      # Keep well below EMBEDDING_TPM so that several batches can be in flight
 # EMBEDDING_MAX_TOKEN_SIZE = 7800         # 100 tokens ~= 75 words, hence  tokens = 1.33333333333333333333333 * words
 EMBEDDING_RPM = 20 
 EMBEDDING_TPM = 150000
+EMBEDDING_MAX_CONCURRENCY = 4
+EMBEDDING_MAX_RETRIES = 6
+EMBEDDING_MAX_BACKOFF = 60              # Seconds
 
 # RESPONSE_SPINE_TOKENS   = 634
 RESPONSE_MAX_LTM_TOKENS = 1500
 RESPONSE_MAX_STM_TOKENS = 1500
 
+RETRIEVAL_QUERY_MESSAGES    = 3     # Newest short-term messages each searched for on their own
+RETRIEVAL_WINDOW_MESSAGES   = 8     # Newest short-term messages searched for together, as one conversation window
+RETRIEVAL_LIMIT             = 10    # Hits searched for each query
+RETRIEVAL_MAX_MEMORIES      = 5     # Long-term memories given to the prompt after fusing the hits of every query
+RETRIEVAL_RRF_K             = 60    # Reciprocal rank fusion constant. Larger lets lower ranked hits matter more
+
+HISTORY_LIMIT       = 20000     # Max messages of a channel's history ingested into long-term memory
+INGEST_CHUNK_SIZE   = 500       # Messages read, embedded and inserted at a time while ingesting history
+INGEST_QUEUE_SIZE   = 4         # Chunks allowed to wait between two ingestion stages
+SYNC_CHUNK_SIZE     = 100       # Messages read from Discord at a time while syncing a channel
+
+SPOOL_BATCH_SIZE        = EMBEDDING_MAX_BATCH_SIZE  # Spooled messages saved into long-term memory at a time, across all channels
+SPOOL_FLUSH_INTERVAL    = 5                         # Seconds between checks of the spool
+SPOOL_RETRY_DELAY       = 30                        # Seconds before a failed message is tried again. Doubles with every failed attempt
+SPOOL_MAX_RETRY_DELAY   = 30 * 60                   # Longest delay between attempts
+SPOOL_MAX_ATTEMPTS      = 12                        # Failed attempts before a message is quarantined
+
 TESTING_WRITE_TO_FILE = True
 bot = None
 
 
+_spooler        = None      # Thread saving spooled messages into long-term memory
+_spooler_wake   = threading.Event()
+_spooler_stop   = threading.Event()
+
+_ingest_tasks   = {}        # channel_id (str) -> task ingesting the channel's history in the background
+
+
 def link_bot(_bot):
     '''
     Gives this module access to the current discord bot.
@@ -65,6 +120,155 @@ def link_bot(_bot):
     bot = _bot
 
 
+class TokenBucket:
+    '''
+    Token bucket used for staying inside OpenAI's rate limits.
+
+    The bucket holds at most `capacity` tokens and refills `capacity` tokens every `period` seconds.
+    Taking tokens from the bucket waits until enough tokens are available.
+
+    Works from both threads (`take`) and coroutines (`atake`).
+    '''
+
+    def __init__(self, capacity, period=60):
+        self.capacity   = capacity
+        self.rate       = capacity / period
+        self.tokens     = capacity
+        self.updated    = time.monotonic()
+        self.lock       = threading.Lock()
+
+    def _reserve(self, amount):
+        '''
+        Take `amount` tokens from the bucket, going into debt if necessary.
+        Returns how many seconds the caller must wait before its tokens are actually available.
+        '''
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self.tokens  = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0: return 0
+            return -self.tokens / self.rate
+
+    def take(self, amount=1):
+        delay = self._reserve(amount)
+        if delay > 0: time.sleep(delay)
+
+    async def atake(self, amount=1):
+        delay = self._reserve(amount)
+        if delay > 0: await asyncio.sleep(delay)
+
+
+_embedding_requests = TokenBucket(EMBEDDING_RPM)
+_embedding_tokens   = TokenBucket(EMBEDDING_TPM)
+
+
+def _pack_embedding_batches(strings):
+    '''
+    Split strings into batches that fit inside `EMBEDDING_MAX_BATCH_SIZE` strings and `EMBEDDING_MAX_BATCH_TOKENS` tokens.
+
+    Strings keep their order, so concatenating the batches gives back `strings`.
+
+    RETURN
+    ------
+    Returns a list of `( batch, tokens )` tuples, 
+    or `None` if a string is longer than `EMBEDDING_TRUE_MAX_TOKEN_SIZE` tokens and can never be embedded.
+    '''
+    batches = []
+    batch, batch_tokens = [], 0
+
+    for string, tokens in zip(strings, prompt.tokens_from_strings(strings)):
+        if tokens > EMBEDDING_TRUE_MAX_TOKEN_SIZE:
+            debug.log(ly, f"[*] AI - Failed to embed strings because a string was too long")
+            debug.log(ly, f"         tokens: {tokens}    string: {string[:100]}"           )
+            return
+
+        if len(batch) > 0 and (len(batch) >= EMBEDDING_MAX_BATCH_SIZE or batch_tokens + tokens > EMBEDDING_MAX_BATCH_TOKENS):
+            batches.append((batch, batch_tokens))
+            batch, batch_tokens = [], 0
+
+        batch.append(string)
+        batch_tokens += tokens
+
+    if len(batch) > 0: batches.append((batch, batch_tokens))
+    return batches
+
+
+def _embedding_retry_delay(exception, attempt):
+    '''
+    Returns how many seconds to wait before retrying a failed embedding request, 
+    or `None` if the request should not be retried.
+
+    Rate limits (429), server errors (5xx), timeouts and connection errors are retried with exponential backoff.
+    '''
+    if attempt >= EMBEDDING_MAX_RETRIES: return
+
+    retryable = isinstance(exception, (
+        openai.error.RateLimitError, 
+        openai.error.ServiceUnavailableError, 
+        openai.error.Timeout, 
+        openai.error.APIConnectionError
+    ))
+    if isinstance(exception, openai.error.APIError) and (exception.http_status or 500) >= 500: retryable = True
+    if not retryable: return
+
+    return min(EMBEDDING_MAX_BACKOFF, 2 ** attempt) * (0.5 + random.random() / 2)
+
+
+def _validate_strings(strings):
+    '''
+    Returns `( strings, was_string )`, or `None` if an item inside `strings` was not actually a string.
+    '''
+    was_string = False
+
+    if type(strings) == str: 
+        was_string = True
+        strings = [strings]
+    for string in strings:
+        if type(string) != str:
+            debug.log(ly, f"[*] AI - Failed to embed string{ '' if len(strings) == 1 else 's' } because { 'the' if len(strings) == 1 else 'a' } string was not actually of type string")
+            debug.log(ly, f"         invalid string: {string}"      )
+            debug.log(ly, f"                   type: {type(string)}")
+            return
+    return strings, was_string
+
+
+
+def _split_cached(strings):
+    '''
+    Look up `strings` inside the embedding cache.
+
+    RETURN
+    ------
+    Returns `( result, missing )`.
+
+    `result` has an embedding for every cached string, and `None` for the rest.
+
+    `missing` contains every string that still needs to be embedded, once per normalized form.
+    '''
+    result  = embeddingCache.get_many(EMBEDDING_MODEL, strings)
+    missing = {}
+    for string, embedding in zip(strings, result):
+        if embedding is None: missing.setdefault(embeddingCache.normalize(string), string)
+    return result, list(missing.values())
+
+
+def _merge_cached(strings, result, missing, embeddings):
+    '''
+    Save freshly created embeddings into the cache, and fill them into the `None` slots of `result`.
+
+    RETURN
+    ------
+    Returns every embedding as one float32 matrix, a row for each string.
+    '''
+    embeddingCache.put_many(EMBEDDING_MODEL, missing, embeddings)
+    fresh  = { embeddingCache.normalize(string) : embedding for string, embedding in zip(missing, embeddings) }
+    matrix = np.empty((len(strings), vectorDatabase._DIM), dtype=np.float32)
+    for i in range(len(result)):
+        matrix[i] = result[i] if result[i] is not None else fresh[embeddingCache.normalize(strings[i])]
+    return matrix
+
 def embed_strings(strings, debug_info=False, output_to_file=False):
     '''
     Embed string or a list of strings.
@@ -73,6 +277,10 @@ def embed_strings(strings, debug_info=False, output_to_file=False):
     Currently when writing, this is priced at `$0.0004 / 1000 tokens`.
     Check OpenAI's official website for more up-to-date pricings.
 
+    Strings already inside the embedding cache are not sent again, and duplicates are only sent once.
+    Batches are sent one after another, waiting when needed to stay inside `EMBEDDING_RPM` and `EMBEDDING_TPM`.
+    Use `aembed_strings` from async code, which also sends batches concurrently.
+
     PARAMETERS
     ----------
     `strings` : `str || str[]`
@@ -86,51 +294,58 @@ def embed_strings(strings, debug_info=False, output_to_file=False):
 
     ASSUMPTIONS
     -----------
-    The length of all strings must not be too large.
-    How large? Idk, `openai.Embedding.create` just doesn't work if string inside of `input` are "too large". 
-    Just test bro. lol
+    No string can be longer than `EMBEDDING_TRUE_MAX_TOKEN_SIZE` tokens.
 
     FAILURE
     -------
     `[*]` : An item inside of `strings` was not actually of type str 
 
-    `[*]` : Failed to embed batch. One reason this could happen is because a string inside the batch was too long.
+    `[*]` : A string was too long to be embedded
+
+    `[*]` : Failed to embed batch, even after retrying
 
     RETURN
     ------
     `None` if failure
 
-    If `strings` was of type `str`, returns the embedding of that string directly.
+    If `strings` was of type `str`, returns the embedding of that string directly, as a float32 array.
 
-    Else if `stings` was of type `str[]`, returns a list of embeddings.
+    Else if `stings` was of type `str[]`, returns the embeddings as a float32 matrix, a row for each string.
 
     Check OpenAI's documentation for more information on embeddings.
     '''
-    was_string = False
-    
-    if type(strings) == str: 
-        was_string = True
-        strings = [strings]
-    for string in strings:
-        if type(string) != str:
-            debug.log(ly, f"[*] AI - Failed to embed string{ '' if len(strings) == 1 else 's' } because { 'the' if len(strings) == 1 else 'a' } string was not actually of type string")
-            debug.log(ly, f"         invalid string: {string}"      )
-            debug.log(ly, f"                   type: {type(string)}")
-            return
+    validated = _validate_strings(strings)
+    if validated is None: return
+    strings, was_string = validated
+    string_amount = len(strings)
+
+    cached, missing = _split_cached(strings)
     
+    batches = _pack_embedding_batches(missing)
+    if batches is None: return
+
     try:
         result = []
         total_amount_of_batches = 0     # The amount of batches sent to openAI
-        string_amount = len(strings)
         tokens = 0
 
         if output_to_file: open('outputs/embedding_responses.json', 'w', encoding='utf-8').close()
 
-        while True:
-            if EMBEDDING_MAX_BATCH_SIZE*total_amount_of_batches >= len(strings): break
-            batch = strings[EMBEDDING_MAX_BATCH_SIZE*total_amount_of_batches:(total_amount_of_batches+1)*EMBEDDING_MAX_BATCH_SIZE]
-                 
-            response = openai.Embedding.create(model="text-embedding-ada-002", input = batch)
+        for batch, batch_tokens in batches:
+            attempt = 0
+            while True:
+                _embedding_requests.take()
+                _embedding_tokens  .take(batch_tokens)
+                try:
+                    response = openai.Embedding.create(model=EMBEDDING_MODEL, input=batch)
+                    break
+                except Exception as e:
+                    delay = _embedding_retry_delay(e, attempt)
+                    if delay is None: raise
+                    debug.log(lb, f"[-] AI - Retrying embedding batch in {delay:.1f}s ( attempt, exception ): {attempt + 1} {type(e).__name__}")
+                    time.sleep(delay)
+                    attempt += 1
+
             total_amount_of_batches += 1
             tokens                  += response.usage.total_tokens
 
@@ -143,7 +358,9 @@ def embed_strings(strings, debug_info=False, output_to_file=False):
 
             if debug_info: debug.logt(lb, f"[-] AI - Batch embedded ( number, tokens ): {total_amount_of_batches} {response.usage.total_tokens}")
 
-        debug.log(lg, f"[#] AI - Embedding {string_amount} string{ '' if string_amount == 1 else 's' } completed with {total_amount_of_batches} batch{'' if total_amount_of_batches == 1 else 'es'} costing {tokens} tokens")
+        result = _merge_cached(strings, cached, missing, result)
+
+        debug.log(lg, f"[#] AI - Embedding {string_amount} string{ '' if string_amount == 1 else 's' } completed with {total_amount_of_batches} batch{'' if total_amount_of_batches == 1 else 'es'} costing {tokens} tokens ( cached: {string_amount - len(missing)} )")
         if was_string:  return result[0]
         else:           return result
         
@@ -154,6 +371,90 @@ def embed_strings(strings, debug_info=False, output_to_file=False):
         return
 
 
+async def aembed_strings(strings, debug_info=False):
+    '''
+    Asynchronous version of `embed_strings`.
+
+    Strings already inside the embedding cache are not sent again, and duplicates are only sent once.
+    The rest are packed into batches by token count, 
+    and up to `EMBEDDING_MAX_CONCURRENCY` batches are embedded at the same time while staying inside `EMBEDDING_RPM` and `EMBEDDING_TPM`.
+    Batches failing because of rate limits or server errors are retried with exponential backoff.
+    Embeddings are returned in the same order as `strings`, no matter in which order batches complete.
+
+    PARAMETERS
+    ----------
+    `strings` : `str || str[]`
+        String(s) to be embedded
+
+    `debug_info` : `bool`
+        Print extra information
+
+    FAILURE
+    -------
+    `[*]` : An item inside of `strings` was not actually of type str 
+
+    `[*]` : A string was too long to be embedded
+
+    `[*]` : Failed to embed batch, even after retrying
+
+    RETURN
+    ------
+    `None` if failure
+
+    If `strings` was of type `str`, returns the embedding of that string directly, as a float32 array.
+
+    Else if `stings` was of type `str[]`, returns the embeddings as a float32 matrix, a row for each string.
+    '''
+    validated = _validate_strings(strings)
+    if validated is None: return
+    strings, was_string = validated
+    string_amount = len(strings)
+
+    # The cache is an SQLite database, which is read and written outside the event loop
+    cached, missing = await asyncio.to_thread(_split_cached, strings)
+
+    batches = _pack_embedding_batches(missing)
+    if batches is None: return
+
+    in_flight = asyncio.Semaphore(EMBEDDING_MAX_CONCURRENCY)
+
+    async def embed_batch(number, batch, batch_tokens):
+        attempt = 0
+        while True:
+            async with in_flight:
+                await _embedding_requests.atake()
+                await _embedding_tokens  .atake(batch_tokens)
+                try:
+                    response = await openai.Embedding.acreate(model=EMBEDDING_MODEL, input=batch)
+                except Exception as e:
+                    delay = _embedding_retry_delay(e, attempt)
+                    if delay is None: raise
+                    debug.log(lb, f"[-] AI - Retrying embedding batch {number} in {delay:.1f}s ( attempt, exception ): {attempt + 1} {type(e).__name__}")
+                else:
+                    if debug_info: debug.logt(lb, f"[-] AI - Batch embedded ( number, tokens ): {number} {response.usage.total_tokens}")
+                    return response
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    tasks = [asyncio.create_task(embed_batch(i + 1, batch, batch_tokens)) for i, (batch, batch_tokens) in enumerate(batches)]
+    try:
+        responses = await asyncio.gather(*tasks)
+    except Exception as e:
+        for task in tasks: task.cancel()
+        debug.log(ly,                         f"[*] AI - Failed to embed string{ '' if string_amount == 1 else 's' }"  )
+        if len(str(e)) > 1000:  debug.log(ly, f"         exception: {str(e)[:50]}...{str(e)[-100:]}"                    )
+        else:                   debug.log(ly, f"         exception: {e}"                                                )
+        return
+
+    result = [embeddingObject.embedding for response in responses for embeddingObject in response.data]
+    tokens = sum(response.usage.total_tokens for response in responses)
+    result = await asyncio.to_thread(_merge_cached, strings, cached, missing, result)
+
+    debug.log(lg, f"[#] AI - Embedding {string_amount} string{ '' if string_amount == 1 else 's' } completed with {len(batches)} batch{'' if len(batches) == 1 else 'es'} costing {tokens} tokens ( cached: {string_amount - len(missing)} )")
+    if was_string:  return result[0]
+    else:           return result
+
+
 async def create_channel_memory_if_new(channel_id):
     '''
     Create new memory for channel if this channel doesn't already have memory.
@@ -172,19 +473,20 @@ async def create_channel_memory_if_new(channel_id):
 
     `False` : channel memory already existed.
     '''
-    if not os.path.isfile(f"short-term-memory/{str(channel_id)}"):
-        with open(f"short-term-memory/{str(channel_id)}", 'w', encoding='uft-8') as file:
-            json.dump({
-                "total_tokens": 0,
-                "messages": [],
-                "failedSaves": []
-            }, file, ensure_ascii=False)
-        vectorDatabase.remove_channel_memory_if_exist(channel_id)
+    if not shortTermMemory.exists(channel_id):
+        shortTermMemory.create(channel_id)
+        syncState.remove(channel_id)
+        memorySpool.remove_channel(channel_id)
+        await vectorDatabase.aremove_channel_memory_if_exist(channel_id)
 
         messages = await cog.getHistory(channel_id, limit=15)
-        if not add_messages_into_memory(channel_id, messages, debug_mode=True): return
+        if not await asyncio.to_thread(add_messages_into_memory, channel_id, messages): return
+
+        if len(messages) > 0: 
+            syncState.update(channel_id, backfill={ "before": messages[0]["id"], "count": 0, "limit": HISTORY_LIMIT, "done": False })
+            start_history_ingestion(channel_id)
 
-        vectorDatabase.create_index()
+        await asyncio.to_thread(indexManager.ensure_index, force=True)
 
         debug.log(lg, f"[#] AI - New channel added into memory: {str(channel_id)}")
         return True
@@ -206,14 +508,206 @@ async def remove_channel_memory_if_exist(channel_id):
     
     `False` : there was no memory to drop.
     '''
-    if os.path.isfile(f"short-term-memory/{str(channel_id)}"):
-        os.remove(f"short-term-memory/{str(channel_id)}")
-        vectorDatabase.remove_channel_memory_if_exist(channel_id)
+    if shortTermMemory.remove(channel_id):
+        task = _ingest_tasks.pop(str(channel_id), None)
+        if task is not None: task.cancel()
+        syncState.remove(channel_id)
+        memorySpool.remove_channel(channel_id)
+        await vectorDatabase.aremove_channel_memory_if_exist(channel_id)
         debug.log(lg, f"[#] AI - Channel removed from memory: {str(channel_id)}")
         return True
     return False
 
 
+def embedding_text(message):
+    '''
+    Returns the text of a message that gets embedded. Messages without text are attachments.
+    '''
+    return message["content"] if message["content"] != "" else "[attachment]"
+
+
+async def ingest_history(channel_id, debug_info=False):
+    '''
+    Ingest a channel's older history into long-term memory, continuing from where the last ingestion stopped.
+
+    History is streamed through three stages running at the same time, connected by bounded queues:
+    reading chunks of messages from Discord, embedding them, and inserting them into the vector database.
+    So only a few chunks are ever held in memory, no matter how long the history is.
+
+    After each inserted chunk the id of the oldest ingested message is saved into the channel's sync state,
+    so a crash in the middle of a backfill continues from that message the next time this is called.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel whose history is ingested
+
+    `debug_info` : `bool`
+        Print extra information
+
+    ASSUMPTIONS
+    -----------
+    The channel's sync state contains a `backfill`, which is created by `create_channel_memory_if_new`.
+
+    FAILURE
+    -------
+    `[*]` : Embedding a chunk failed. Ingestion stops and can be continued later
+
+    `[*]` : Inserting a chunk failed. Failed messages are spooled and saved later by the spooler
+
+    `[*]` : Spooling failed messages failed. Ingestion stops before the chunk and can be continued later
+
+    RETURN
+    ------
+    `True` : whole history was ingested
+
+    `False` : ingestion stopped before the end of the history
+    '''
+    backfill = syncState.load(channel_id)["backfill"]
+    if backfill is None or backfill["done"]: return True
+
+    fetched  = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+    embedded = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+
+    async def fetch():
+        async for chunk in cog.iterHistory(channel_id, chunk_size=INGEST_CHUNK_SIZE, limit=backfill["limit"] - backfill["count"], before=backfill["before"]):
+            await fetched.put(chunk)
+        await fetched.put(None)
+
+    async def embed():
+        while (chunk := await fetched.get()) is not None:
+            embeddings = await aembed_strings([embedding_text(message) for message in chunk])
+            if embeddings is None: raise RuntimeError("embedding a chunk failed")
+            await embedded.put(vectorDatabase.MessageBatch.from_messages(chunk, embeddings))
+        await embedded.put(None)
+
+    async def insert():
+        progress = dict(backfill)
+        while (batch := await embedded.get()) is not None:
+            # No timeout, so `None` means nothing was inserted rather than an insert still running
+            response = await vectorDatabase.aadd_messages(channel_id, batch, timeout=None)
+            if response is None: response = { "fullSuccess": False, "failedSlices": [(0, len(batch))] }
+            if not response["fullSuccess"]:
+                failed = [message for failed_slice in response["failedSlices"] for message in batch[failed_slice[0]:failed_slice[1]].to_messages(embedding=False)]
+                if not memorySpool.put(channel_id, failed): raise RuntimeError("spooling messages that failed to insert failed")
+                start_spooler()
+
+            # Only the backfill is saved, as `newest` moves on while the history is ingested
+            progress["before"] = int(batch.ids[-1])
+            progress["count"] += len(batch)
+            syncState.update(channel_id, backfill=progress)
+            if debug_info: debug.logt(lb, f"[-] AI - History chunk ingested ( messages, total ): {len(batch)} {progress['count']}")
+
+        progress["done"] = True
+        syncState.update(channel_id, backfill=progress)
+        return progress
+
+    # If any stage fails, the others are stopped. Everything up to the last inserted chunk is kept
+    tasks = [asyncio.create_task(stage()) for stage in (fetch, embed, insert)]
+    try:
+        progress = (await asyncio.gather(*tasks))[2]
+    except Exception as e:
+        for task in tasks: task.cancel()
+        debug.log(ly, f"[*] AI - History ingestion stopped for channel {channel_id}. It will continue from where it stopped")
+        debug.log(lb, f"         exception: {e}")
+        return False
+    except BaseException:
+        for task in tasks: task.cancel()
+        raise
+
+    debug.log(lg, f"[#] AI - History ingested for channel {channel_id} ( messages: {progress['count']} )")
+    return True
+
+
+def start_history_ingestion(channel_id):
+    '''
+    Ingest a channel's history in the background with `ingest_history`, unless it is already being ingested.
+
+    So that a new channel is answered right away, instead of after its whole history has been ingested.
+
+    RETURN
+    ------
+    Returns the task ingesting the history.
+    '''
+    task = _ingest_tasks.get(str(channel_id))
+    if task is not None and not task.done(): return task
+
+    task = asyncio.create_task(ingest_history(channel_id))
+    _ingest_tasks[str(channel_id)] = task
+    task.add_done_callback(lambda done: _ingest_tasks.pop(str(channel_id)) if _ingest_tasks.get(str(channel_id)) is done else None)
+    return task
+
+
+def stop_history_ingestion():
+    '''
+    Cancel every background history ingestion. A cancelled ingestion continues from where it stopped when it is started again.
+    '''
+    for task in list(_ingest_tasks.values()): task.cancel()
+    _ingest_tasks.clear()
+
+
+async def sync_channel(channel_id, debug_info=False):
+    '''
+    Bring a channel's memory up to date with messages sent while the bot wasn't watching, for example while it was off.
+
+    Only messages newer than the newest message already in memory are read from Discord.
+    Messages already inside short-term or long-term memory are skipped, so nothing is embedded twice.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel to sync
+
+    `debug_info` : `bool`
+        Print extra information
+
+    ASSUMPTIONS
+    -----------
+    Memory for channel is assummed to be initialized.
+
+    FAILURE
+    -------
+    `[*]` : Checking long-term memory for already saved messages failed. Sync stops and can be continued later
+
+    RETURN
+    ------
+    Returns the amount of messages added into memory, or `None` if failed.
+    '''
+    newest = syncState.load(channel_id)["newest"]
+    if newest is None:
+        last = shortTermMemory.load(channel_id).last()
+        if last is None: return 0
+        newest = last.id
+
+    added = 0
+    async for chunk in cog.iterHistory(channel_id, chunk_size=SYNC_CHUNK_SIZE, after=newest, oldest_first=True):
+        in_short_term_memory = { record.id for record in shortTermMemory.load(channel_id).messages }
+        in_long_term_memory  = await vectorDatabase.aexisting_ids(channel_id, [message["id"] for message in chunk])
+        if in_long_term_memory is None:
+            debug.log(ly, f"[*] AI - Syncing channel {channel_id} stopped, as long-term memory could not be checked")
+            return
+        in_long_term_memory |= memorySpool.spooled_ids(channel_id, [message["id"] for message in chunk])
+
+        new_messages = [message for message in chunk if message["id"] not in in_short_term_memory and message["id"] not in in_long_term_memory]
+        if len(new_messages) > 0: await asyncio.to_thread(add_messages_into_memory, channel_id, new_messages)
+        added += len(new_messages)
+
+        # add_messages_into_memory only moves the newest id forward for messages it actually added
+        _remember_newest(channel_id, chunk[-1]["id"])
+        if debug_info: debug.logt(lb, f"[-] AI - Sync chunk ( read, added ): {len(chunk)} {len(new_messages)}")
+
+    debug.log(lg, f"[#] AI - Channel {channel_id} synced ( messages added: {added} )")
+    return added
+
+
+def _remember_newest(channel_id, message_id):
+    '''
+    Save `message_id` as the newest message in the channel's memory, if it is newer than the current one.
+    '''
+    newest = syncState.load(channel_id)["newest"]
+    if newest is None or message_id > newest: syncState.update(channel_id, newest=message_id)
+
+
 def add_messages_into_memory(channel_id, messages, debug_info=False, debug_mode=False):
     '''
     Add a message or a list of messages into AI's memory
@@ -248,6 +742,8 @@ def add_messages_into_memory(channel_id, messages, debug_info=False, debug_mode=
     `author`    : str, not longer than vectordatabase._MAX_AUTHOR_LENGTH
     `content`   : str, not longer than vectordatabase._MAX_MESSAGE_LENGTH
 
+    Messages should also contain `timestamp`, the date already parsed with `prompt.parse_date`, like the ones from `cog.getHistory` do.
+
     FAILURE
     -------
     [ADD FAILURES. TOO LAZY RIGHT NOW...]
@@ -258,74 +754,309 @@ def add_messages_into_memory(channel_id, messages, debug_info=False, debug_mode=
     Return `True` if function succeeded
     '''
     if type(messages) != list: messages = [messages]
-    memory = None
+    memory = shortTermMemory.load(channel_id)
 
-    with open(f"short-term-memory/{channel_id}.json", encoding='utf-8') as file:
-        memory = json.load(file)
-
-    tokensOriginaly = memory["total_tokens"]
-    tokensAdded = 0
-    tokensRemoved = 0
+    tokensOriginaly = memory.total_tokens
 
     # ADD MESSAGES INTO SHORT-TERM MEMORY
-    prev_message = None if len(memory["messages"]) == 0 else memory["messages"][-1]
-    
-    for message in messages:
-        tokens = prompt.tokens_from_message(prev_message, message)
-
-        memory["messages"].append({ 
-            "id"        : message["id"], 
-            "date"      : message["date"], 
-            "author"    : message["author"], 
-            "content"   : message["content"],
-            "tokens"    : tokens
-        })
-        memory["total_tokens"] += tokens
-        prev_message = memory["messages"][-1]
-    tokensAdded = memory["total_tokens"] - tokensOriginaly
-
-    # TRIM SHORT-TERM MEMORY AND ADD TRIMMED MESSAGES INTO LONG-TERM MEMORY SO THAT SHORT-TERM MEMORY IS INSIDE OF TOKEN THRESHOLD
-    trim_count = 0
-
-    while memory["total_tokens"] > RESPONSE_MAX_STM_TOKENS:
-        memory["total_tokens"] -= memory["messages"][trim_count]["tokens"]
-        trim_count += 1
-    tokensRemoved = tokensAdded - memory["total_tokens"]
+    tokens = prompt.tokens_from_messages(messages, prev_message=memory.last())
+    tokensAdded = tokens["total"]
+    added_messages = [
+        shortTermMemory.MessageRecord(
+            message["id"], 
+            message["date"], 
+            prompt.message_timestamp(message),
+            message["author"], 
+            message["content"],
+            message_tokens
+        ) for message, message_tokens in zip(messages, tokens["each"])
+    ]
 
     if debug_mode:
+        # Only write what would happen, without touching the actual memory
+        stm = shortTermMemory.ShortTermMemory()
+        for record in [*memory.messages, *added_messages]: stm.append(record)
+        removed = stm.evict_overflow(RESPONSE_MAX_STM_TOKENS)
+
         with open("outputs/add_messages_into_memory_debug.json", 'w', encoding='utf-8') as file:
             json.dump({
-                "added"                   : memory["messages"][-len(messages):],
-                "removed"                 : memory["messages"][:trim_count],
+                "added"                   : [record.to_dict() for record in added_messages],
+                "removed"                 : [record.to_dict() for record in removed],
                 "tokensBefore"            : tokensOriginaly,
-                "tokensAfterAdd"          : memory["total_tokens"] + tokensRemoved,
-                "tokensAfterTrim"         : memory["total_tokens"],
+                "tokensAfterAdd"          : tokensOriginaly + tokensAdded,
+                "tokensAfterTrim"         : stm.total_tokens,
                 "RESPONSE_MAX_STM_TOKENS" : RESPONSE_MAX_STM_TOKENS
-            }, file, ensure_ascii=False)
+            }, file, ensure_ascii=False, default=str)
         return True
 
-    trimmed_messages = memory["messages"][:trim_count]
+    # TRIM SHORT-TERM MEMORY SO THAT IT IS INSIDE OF TOKEN THRESHOLD. TRIMMED MESSAGES ARE SPOOLED AND SAVED INTO LONG-TERM MEMORY IN THE BACKGROUND
+    shortTermMemory.append_messages(channel_id, added_messages)
+    trimmed_messages = shortTermMemory.peek_overflow(channel_id, RESPONSE_MAX_STM_TOKENS)
+    spooled = memorySpool.put(channel_id, [record.to_dict() for record in trimmed_messages])
+    if spooled and len(trimmed_messages) > 0:
+        shortTermMemory.trim(channel_id, len(trimmed_messages))
+        start_spooler()
+        _spooler_wake.set()
 
-    embeddings = embed_strings(trimmed_messages["content"])
-    if not embeddings is None: 
-        for i in range(trimmed_messages): trimmed_messages[i]["embedding"] = embeddings[i]
+    if len(messages) > 0: _remember_newest(channel_id, messages[-1]["id"])
 
-        response = vectorDatabase.add_messages(channel_id, trimmed_messages)
+    if spooled: debug.log(lg, f"[#] AI - Adding messages success.")
+    else      : debug.log(ly, f"[*] AI - Adding messages succeeded, but trimmed messages could not be spooled. They stay in short-term memory until the next add.")
 
-        if not response["fullSuccess"]:
-            for failed_slice in response["failedSlices"]:
-                for message in trimmed_messages[failed_slice[0]:failed_slice[1]]: 
-                    memory["failedSaves"].append(message)
+    return True
 
-    memory["messages"] = memory["messages"][trim_count:]
 
-    with open(f"short-term-memory/{channel_id}.json", 'w', encoding='utf-8') as file:
-        json.dump(memory, file, ensure_ascii=False)
+def _save_spooled(debug_info=False):
+    '''
+    Save one batch of spooled messages into long-term memory.
 
-    if not embeddings is None: debug.log(lg, f"[#] AI - Adding messages success.")
-    else                     : debug.log(lr, f"[!] AI - Adding messages failed while trimming. Loss occured for oldest short-term memories.")
+    The batch is taken across all channels, so that its messages are embedded together.
+    They are then inserted channel by channel, as every channel has its own partition.
+    Messages that fail are left inside the spool and tried again later.
+    Nothing is taken while Milvus is unreachable, so an outage doesn't count towards their attempts.
 
-    return True
+    RETURN
+    ------
+    Returns the amount of messages taken from the spool.
+    '''
+    if not vectorDatabase.is_available(): return 0
+
+    rows = memorySpool.take(SPOOL_BATCH_SIZE)
+    if len(rows) == 0: return 0
+
+    channels = {}   # channel_id -> ( messages, their rows inside the batch, their attempts )
+    for row, (channel_id, message, attempts) in enumerate(rows):
+        messages, indexes, message_attempts = channels.setdefault(channel_id, ([], [], {}))
+        messages.append(message)
+        indexes.append(row)
+        message_attempts[message["id"]] = attempts
+
+    def retry(channel_id, messages, attempts):
+        # Every message backs off by its own attempts
+        delays = {}
+        for message in messages:
+            delay = min(SPOOL_MAX_RETRY_DELAY, SPOOL_RETRY_DELAY * 2 ** attempts[message["id"]])
+            delays.setdefault(delay, []).append(message["id"])
+        for delay, ids in delays.items(): memorySpool.retry_later(channel_id, ids, delay)
+
+    embeddings = embed_strings([embedding_text(message) for _, message, _ in rows])
+    if embeddings is None:
+        debug.log(ly, f"[*] AI - Failed to embed spooled messages. They will be tried again later")
+        for channel_id, (messages, _, attempts) in channels.items(): retry(channel_id, messages, attempts)
+        return len(rows)
+
+    for channel_id, (messages, indexes, attempts) in channels.items():
+        # The channel was removed while its messages were waiting
+        if not shortTermMemory.exists(channel_id):
+            memorySpool.remove_channel(channel_id)
+            continue
+
+        response = vectorDatabase.add_messages(channel_id, vectorDatabase.MessageBatch.from_messages(messages, embeddings[indexes]))
+        if response is None: response = { "fullSuccess": False, "failedSlices": [(0, len(messages))] }
+
+        failed = [message for failed_slice in response["failedSlices"] for message in messages[failed_slice[0]:failed_slice[1]]]
+        failed_ids = { message["id"] for message in failed }
+        memorySpool.ack(channel_id, [message["id"] for message in messages if message["id"] not in failed_ids])
+
+        # Messages Milvus will never accept, and messages that keep failing on their own, are poisoned
+        invalid = response.get("invalid", {})
+        reasons = {}
+        for i, reason in invalid.items(): reasons.setdefault(reason, []).append(messages[i])
+        for reason, poisoned in reasons.items(): memorySpool.quarantine(channel_id, poisoned, reason)
+
+        failed = [message for message in failed if message["id"] not in { messages[i]["id"] for i in invalid }]
+        exhausted = [message for message in failed if attempts[message["id"]] + 1 >= SPOOL_MAX_ATTEMPTS]
+        failed    = [message for message in failed if attempts[message["id"]] + 1 <  SPOOL_MAX_ATTEMPTS]
+        if len(exhausted) > 0:
+            memorySpool.quarantine(channel_id, exhausted, f"failed {SPOOL_MAX_ATTEMPTS} attempts")
+        if len(failed) > 0:
+            debug.log(ly, f"[*] AI - Failed to save {len(failed)} spooled message{'' if len(failed) == 1 else 's'} of channel {channel_id}. They will be tried again later")
+            retry(channel_id, failed, attempts)
+
+    if debug_info: debug.logt(lb, f"[-] AI - Spooled messages saved ( messages, channels ): {len(rows)} {len(channels)}")
+    return len(rows)
+
+
+def replay_failed_saves(channel_id):
+    '''
+    Spool the messages left inside a channel's `failedSaves`, so that the spooler tries saving them again.
+
+    RETURN
+    ------
+    Returns the amount of spooled messages.
+    '''
+    failed_saves = shortTermMemory.load(channel_id).failed_saves
+    if len(failed_saves) == 0: return 0
+
+    messages = [{ key: value for key, value in message.items() if key != "embedding" } for message in failed_saves]
+    if not memorySpool.put(channel_id, messages): return 0
+    shortTermMemory.clear_failed_saves(channel_id)
+    start_spooler()
+    _spooler_wake.set()
+    debug.log(lg, f"[#] AI - Spooled {len(messages)} failed save{'' if len(messages) == 1 else 's'} of channel {channel_id}")
+    return len(messages)
+
+
+def _spool_worker():
+    '''
+    Save spooled messages into long-term memory until `stop_spooler` is called.
+
+    Wakes up every `SPOOL_FLUSH_INTERVAL` seconds, or right away when messages are spooled.
+    Every time it wakes up, it also lets the vector database flush messages inserted during a quiet period
+    and release partitions that haven't been searched for `PARTITION_TTL`,
+    and lets the index manager check whether memory has grown enough for a new index.
+    '''
+    while True:
+        _spooler_wake.wait(SPOOL_FLUSH_INTERVAL)
+        _spooler_wake.clear()
+        try:
+            while _save_spooled() == SPOOL_BATCH_SIZE: pass
+            vectorDatabase.flush_if_due()
+            vectorDatabase.release_idle_partitions()
+            embeddingCache.flush()
+            indexManager.ensure_index()
+        except Exception as e:
+            debug.log(lr,  "[!] AI - Spooler failed to save messages. They will be tried again later")
+            debug.log(lb, f"         exception: {e}")
+        if _spooler_stop.is_set(): return
+
+
+def start_spooler():
+    '''
+    Start saving spooled messages into long-term memory in the background, if not started already.
+
+    Called automatically when messages are spooled.
+    Call it on start as well, so that messages left inside the spool from the last run are saved.
+    '''
+    global _spooler
+
+    if _spooler is not None and _spooler.is_alive(): return
+    _spooler_stop.clear()
+    _spooler = threading.Thread(target=_spool_worker, name="memory-spooler", daemon=True)
+    _spooler.start()
+
+
+def stop_spooler(timeout=None):
+    '''
+    Save everything that is ready inside the spool and stop the background spooler.
+
+    Messages that could not be saved stay inside the spool for the next run.
+
+    FAILURE
+    -------
+    `[*]` : The spooler didn't stop within `timeout` seconds. The spool is left open, as the spooler is still using it
+    '''
+    global _spooler
+
+    if _spooler is None: return
+    _spooler_stop.set()
+    _spooler_wake.set()
+    _spooler.join(timeout)
+    if _spooler.is_alive():
+        debug.log(ly, f"[*] AI - Spooler didn't stop within {timeout}s, so the spool is left open")
+        return
+    _spooler = None
+    memorySpool.stop()
+    debug.log(lg, "[#] AI - Spooler stopped")
+
+
+def _retrieval_queries(short_term_memory):
+    '''
+    Returns the strings searched for inside long-term memory, most important first:
+    the newest messages on their own, and a window of the newest messages together.
+    '''
+    messages = list(short_term_memory.messages)
+    queries  = [embedding_text(message) for message in reversed(messages[-RETRIEVAL_QUERY_MESSAGES:])]
+
+    window, tokens = [], 0
+    for message in reversed(messages[-RETRIEVAL_WINDOW_MESSAGES:]):
+        tokens += message.tokens
+        if tokens > EMBEDDING_TRUE_MAX_TOKEN_SIZE // 2: break
+        window.append(embedding_text(message))
+    if len(window) > 1: queries.append("\n".join(reversed(window)))
+    return queries
+
+
+def _fuse_hits(results, exclude_ids=()):
+    '''
+    Merge the hits of several queries with reciprocal rank fusion.
+
+    A hit scores `1 / (RETRIEVAL_RRF_K + rank)` for every query that found it, so messages found by several queries rise to the top,
+    and scores of different queries never have to be compared directly.
+
+    RETURN
+    ------
+    Returns at most `RETRIEVAL_MAX_MEMORIES` hits as `dict[]` containing the fields `id`, `date`, `author`, `content`, and `score`,
+    from the highest score to the lowest.
+    '''
+    fused = {}
+    for hits in results:
+        for rank, hit in enumerate(hits):
+            if hit.id in exclude_ids: continue
+            if hit.id not in fused:
+                fused[hit.id] = {
+                    "id"        : hit.id,
+                    "date"      : hit.entity.get('date'),
+                    "author"    : hit.entity.get('author'),
+                    "content"   : hit.entity.get('content'),
+                    "score"     : 0
+                }
+            fused[hit.id]["score"] += 1 / (RETRIEVAL_RRF_K + rank + 1)
+    return sorted(fused.values(), key=lambda hit: hit["score"], reverse=True)[:RETRIEVAL_MAX_MEMORIES]
+
+
+def retrieve_long_term_memory(channel_id, short_term_memory):
+    '''
+    Find the messages inside long-term memory most related to the current conversation.
+
+    Several queries are made from short-term memory, embedded in one call and searched for in one batched search,
+    and their hits are merged with `_fuse_hits`. Messages still inside short-term memory are left out.
+
+    FAILURE
+    -------
+    `[*]` : Embedding or searching failed
+
+    RETURN
+    ------
+    Returns the hits as `dict[]`, from oldest to newest, or `None` if failed.
+    '''
+    queries = _retrieval_queries(short_term_memory)
+    vectors = embed_strings(queries)
+    if vectors is None: return
+
+    result = vectorDatabase.search(channel_id, vectors, limit=RETRIEVAL_LIMIT)
+    if result is None: return
+
+    hits = _fuse_hits(result, exclude_ids={ message.id for message in short_term_memory.messages })
+    return sorted(hits, key=lambda hit: hit["id"])
+
+
+def expand_hits(channel_id, hits, exclude_ids=()):
+    '''
+    Turn long-term memory hits into memories containing the messages sent around them, 
+    read from long-term memory with one query for all hits.
+
+    Memories that overlap or touch are merged into one, so no message is given to the prompt twice.
+    If the neighbors can't be read, every hit becomes a memory of its own.
+
+    RETURN
+    ------
+    Returns memories as `dict[][]`, in the format used by `prompt.prompt_crafter`.
+    '''
+    hits = sorted(hits, key=lambda hit: hit["id"])
+    neighbors = vectorDatabase.get_neighbors(channel_id, [hit["id"] for hit in hits])
+
+    memories = []
+    for hit in hits:
+        chain = neighbors.get(hit["id"]) if neighbors is not None else None
+        if not chain: chain = [{ key: hit[key] for key in ("id", "date", "author", "content") }]
+        chain = [message for message in chain if message["id"] not in exclude_ids or message["id"] == hit["id"]]
+
+        if len(memories) > 0 and chain[0]["id"] <= memories[-1][-1]["id"]:
+            memories[-1].extend(message for message in chain if message["id"] > memories[-1][-1]["id"])
+        else:
+            memories.append(chain)
+    return memories
 
 
 def respond(channel_id, output_to_file=False):
@@ -334,6 +1065,7 @@ def respond(channel_id, output_to_file=False):
     
     Context for the response is build with the current long-term and short-term memory of the given channel.
     Any new messages that should be taken into consideration by the AI should be added in with the `add_messages_into_memory` function.
+    While long-term memory is unavailable, the response is created with short-term memory only, instead of waiting for Milvus.
 
     Responding uses `gpt-3.5-turbo`.
     Currently when writing, this is priced at `$0.002 / 1000 tokens`.
@@ -358,26 +1090,35 @@ def respond(channel_id, output_to_file=False):
     # CHECK MODERATION AND PRINT
     # RETURN ANSWER
 
-    short_term_memory = None
+    short_term_memory = shortTermMemory.load(channel_id)
 
-    with open(f"short-term-memory/{channel_id}.json", encoding='utf-8') as file:
-        short_term_memory = json.load(file)
-
-    if len(short_term_memory["messages"]) == 0:
+    if len(short_term_memory) == 0:
         debug.log(ly, "[*] AI - Failed to create response because short-term memory has no messages")
         return
 
-    vector = embed_strings(short_term_memory["messages"][-1]["content"])
-    if not vector: return
-    long_term_memory_search_result = vectorDatabase.search(channel_id, vector)[0]
+    hits = retrieve_long_term_memory(channel_id, short_term_memory) if vectorDatabase.is_available() else None
+
+    if hits is None:
+        debug.log(ly, "[*] AI - Long-term memory is unavailable, responding with short-term memory only")
+        long_term_memory = []
+    else:
+        if len(hits) > 0: debug.log(lb, f"[-] AI - Long-term memory retrieved ( hits, best score ): {len(hits)} {max(hit['score'] for hit in hits):.4f}")
+        long_term_memory = expand_hits(channel_id, hits, exclude_ids={ message.id for message in short_term_memory.messages })
 
-    for hit in long_term_memory_search_result:
-        print(w, f"date: {hit.entity.get('date')}, author: {hit.entity.get('author')}, " + f"message: {hit.entity.get('message')}")
+    crafted = prompt.prompt_crafter(
+        long_term_memory, list(short_term_memory.messages), RESPONSE_MAX_LTM_TOKENS, RESPONSE_MAX_STM_TOKENS,
+        output_result_to_file=output_to_file, channel_id=channel_id
+    )
 
-    chat_response = openai.ChatCompletion.create(
-        model       =   "gpt-3.5-turbo",
-        messages    =   [{"role": "user", "content": message}],
-        temperature =   0.5)
+    try:
+        chat_response = openai.ChatCompletion.create(
+            model       =   "gpt-3.5-turbo",
+            messages    =   [{"role": "user", "content": crafted["string"]}],
+            temperature =   0.5)
+    except openai.error.OpenAIError as e:
+        debug.log(lr,  "[!] AI - Failed to create response")
+        debug.log(lb, f"         exception: {e}")
+        return
     
     # moderation_response = openai.Moderation.create(input=[message])
     
@@ -0,0 +1,373 @@
+'''
+BENCHMARK
+=========
+
+Benchmarks for the performance sensitive parts of the bot.
+
+Run from the command line:
+    >>> python benchmark.py
+
+The search benchmark needs Milvus running and NumPy installed:
+    >>> python benchmark.py search
+
+FUNCTIONS
+---------
+synthetic_messages
+
+benchmark_memory_string_crafter
+
+benchmark_message_to_string
+
+synthetic_embeddings
+
+load_embeddings
+
+benchmark_search
+'''
+
+import random, datetime, time, io, contextlib, sys
+import debug, prompt
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+_WORDS   = ["lol", "ok", "yeah", "what", "the", "bot", "is", "so", "slow", "today", "milvus", "memory", "embedding", "no", "way", "did", "you", "see", "that"]
+_AUTHORS = ["alice#0001", "bob#0002", "carol#0003"]
+
+
+def synthetic_messages(amount, seed=0):
+    '''
+    Create fake messages that look like a Discord chat, from oldest to newest.
+
+    Authors often send several messages in a row within a few seconds,
+    so that both message formats of `prompt.message_to_string` are used.
+
+    RETURN
+    ------
+    Returns a list of messages in the format used by `prompt.message_to_string`.
+    '''
+    rng = random.Random(seed)
+    date = datetime.datetime(2023, 1, 1)
+    author = _AUTHORS[0]
+    messages = []
+
+    for i in range(amount):
+        if rng.random() < 0.4: author = rng.choice(_AUTHORS)
+        date += datetime.timedelta(seconds=rng.choice([2, 5, 30, 200, 4000]), microseconds=rng.randrange(1000000))
+        messages.append({
+            "id"        : i,
+            "date"      : date.strftime(prompt.DATE_FORMAT),
+            "timestamp" : prompt.parse_date(date),
+            "author"    : author,
+            "content"   : " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 30)))
+        })
+    return messages
+
+
+def _old_message_to_string(prev_message, current_message):
+    '''
+    The previous implementation of `prompt.message_to_string`, kept for comparison.
+    It parses both dates on every call.
+    '''
+    if prev_message is None: return f"\n({current_message['date'].split('.')[0]}) {current_message['author']}:\n{current_message['content']}\n"
+
+    if current_message['content'] == "": current_message['content'] = "[attachment]"
+
+    if len(prev_message['date'])    == 19:    prev_message['date'] += ".000000"
+    if len(current_message['date']) == 19: current_message['date'] += ".000000"
+
+    prev_date    = datetime.datetime.strptime(   prev_message['date'], '%Y-%m-%d %H:%M:%S.%f')
+    current_date = datetime.datetime.strptime(current_message['date'], '%Y-%m-%d %H:%M:%S.%f')  
+    if current_message['author'] == prev_message['author'] and abs( current_date - prev_date ).total_seconds() < 3 * 60:    
+        return current_message['content'] + '\n'
+    else:                                           
+        return f"\n({current_message['date'].split('.')[0]}) {current_message['author']}:\n{current_message['content']}\n"
+
+
+def _old_memory_string_crafter(memory, max_tokens, mode=1):
+    '''
+    The previous implementation of `prompt.memory_string_crafter`, kept for comparison.
+
+    Two bugs are fixed, so that its output can be compared with the new implementation:
+    mode 1 rendered the oldest message after the newest one (`memory[-1]`),
+    and mode 2 left out the newest message of the window (`memory[section[0]:section[1]]`).
+    '''
+    A = {
+        "string" : "",
+        "tokens" : 0
+    }
+
+    if len(memory) == 0: return A
+
+    if mode == 0:
+        prev_message = None
+
+        for message in memory:
+            next        = prompt.message_to_string(prev_message, message)
+            next_tokens = prompt.tokens_from_string(next)
+            if A["tokens"] + next_tokens > max_tokens: break
+            A["tokens"] += next_tokens
+            A["string"] += next
+            prev_message = message
+
+    elif mode == 1:
+        prev_A = None
+
+        for i in range(len(memory) - 1, -1, -1):
+            next_tokens = prompt.tokens_from_string(prompt.message_to_string(None, memory[i]))
+
+            if A["tokens"] + next_tokens > max_tokens:
+                if not i == len(memory) - 1:
+                    next        = prompt.message_to_string(None, memory[i+1])
+                    next_tokens = prompt.tokens_from_string(next)
+                    A = prev_A
+                    A["tokens"] += next_tokens
+                    A["string"]  = next + A["string"]
+                break
+
+            prev_A = A.copy()
+
+            prev_message = None
+            if i - 1 >= 0: prev_message = memory[i - 1]
+            next        = prompt.message_to_string(prev_message, memory[i])
+            next_tokens = prompt.tokens_from_string(next)
+            A["tokens"] += next_tokens
+            A["string"] = next + A["string"]
+
+    elif mode == 2:
+        result = prompt.tokens_from_messages(memory)
+
+        switch = True
+        section = [0, len(memory) - 1]
+        while result["total"] > max_tokens:
+            if switch:
+                result["total"] -= result["each"][section[0]]
+                section[0]      += 1
+                switch           = False
+            else:
+                result["total"] -= result["each"][section[1]]
+                section[1]      -= 1
+                switch           = True
+
+        if section[0] > section[1]: return A
+
+        result["total"] -= result["each"][section[0]]
+        tokens = prompt.tokens_from_message(None, memory[section[0]])
+        result["total"] += tokens
+
+        if result["total"] > max_tokens: section[0] += 1
+
+        prev_message = None
+        for message in memory[section[0]:section[1] + 1]:
+            next        = prompt.message_to_string(prev_message, message)
+            next_tokens = prompt.tokens_from_string(next)
+            A["tokens"] += next_tokens
+            A["string"] += next
+            prev_message = message
+
+    return A
+
+
+def _time(func, repeats):
+    '''
+    Returns the best time out of `repeats` runs of `func`, with an empty token cache every run.
+    '''
+    best = None
+    for _ in range(repeats):
+        prompt._token_cache.clear()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best: best = elapsed
+    return best
+
+
+def benchmark_memory_string_crafter(message_amounts=(100, 1000, 5000), max_tokens_list=(1500, 20000), repeats=3):
+    '''
+    Compare `prompt.memory_string_crafter` against its previous implementation in every mode.
+
+    Both implementations must return the same string and tokens, otherwise the mismatch is reported.
+
+    RETURN
+    ------
+    Returns a list of dictionaries containing the fields `messages`, `maxTokens`, `mode`, `old`, `new`, and `same`.
+    '''
+    results = []
+    for amount in message_amounts:
+        memory = synthetic_messages(amount)
+        for max_tokens in max_tokens_list:
+            for mode in (0, 1, 2):
+                old = _old_memory_string_crafter(memory, max_tokens, mode)
+                new = prompt.memory_string_crafter(memory, max_tokens, mode)
+                result = {
+                    "messages"  : amount,
+                    "maxTokens" : max_tokens,
+                    "mode"      : mode,
+                    "old"       : _time(lambda: _old_memory_string_crafter(memory, max_tokens, mode), repeats),
+                    "new"       : _time(lambda: prompt.memory_string_crafter(memory, max_tokens, mode), repeats),
+                    "same"      : old == new
+                }
+                results.append(result)
+                debug.log(lg if result["same"] else lr,
+                    f"[#] BENCHMARK - memory_string_crafter ( messages, max tokens, mode, old, new, speedup ): "
+                    f"{amount:>6} {max_tokens:>6} {mode} {result['old']*1000:9.2f}ms {result['new']*1000:9.2f}ms {result['old']/result['new']:6.1f}x"
+                    f"{'' if result['same'] else '    OUTPUT MISMATCH'}"
+                )
+    return results
+
+
+def benchmark_message_to_string(amount=20000, repeats=3):
+    '''
+    Render a whole history with `prompt.message_to_string`, 
+    using pre-parsed timestamps, against parsing both dates on every call like before.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `messages`, `old`, `new`, and `same`.
+    '''
+    memory = synthetic_messages(amount)
+
+    def render(message_to_string):
+        prev_message = None
+        strings = []
+        for message in memory:
+            strings.append(message_to_string(prev_message, message))
+            prev_message = message
+        return strings
+
+    result = {
+        "messages"  : amount,
+        "old"       : _time(lambda: render(_old_message_to_string), repeats),
+        "new"       : _time(lambda: render(prompt.message_to_string), repeats),
+        "same"      : render(_old_message_to_string) == render(prompt.message_to_string)
+    }
+    debug.log(lg if result["same"] else lr,
+        f"[#] BENCHMARK - message_to_string ( messages, old, new, speedup ): "
+        f"{amount:>6} {result['old']*1000:9.2f}ms {result['new']*1000:9.2f}ms {result['old']/result['new']:6.1f}x"
+        f"{'' if result['same'] else '    OUTPUT MISMATCH'}"
+    )
+    return result
+
+
+SEARCH_SWEEPS = {
+    "IVF_FLAT"  : { "params": {"nlist": 1024},                   "search": "nprobe", "values": [1, 4, 16, 64] },
+    "IVF_SQ8"   : { "params": {"nlist": 1024},                   "search": "nprobe", "values": [1, 4, 16, 64] },
+    "HNSW"      : { "params": {"M": 16, "efConstruction": 200},  "search": "ef",     "values": [16, 32, 64, 128] }
+}
+
+
+def synthetic_embeddings(amount, dim=1536, clusters=200, seed=0):
+    '''
+    Create fake normalized embeddings, grouped around `clusters` random topics like real messages are.
+
+    RETURN
+    ------
+    Returns a float32 NumPy array of shape `( amount, dim )`.
+    '''
+    import numpy as np
+
+    rng     = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(clusters, size=amount)] + 0.5 * rng.normal(size=(amount, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def load_embeddings(path):
+    '''
+    Load exported embeddings from a `.npy` file of shape `( amount, dim )`,
+    for example saved from `vectorDatabase.get_embeddings`.
+    '''
+    import numpy as np
+    return np.load(path).astype(np.float32)
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def benchmark_search(vectors=None, amount=20000, queries=200, k=10, metrics=("L2", "IP"), indexes=("IVF_FLAT", "IVF_SQ8", "HNSW"), collection_name="benchmark_memory"):
+    '''
+    Measure recall@k against p50/p99 latency of `vectorDatabase.search`, across index types, metrics and search parameters.
+
+    The vectors are inserted into a separate collection, which is dropped afterwards.
+    Exact nearest neighbors are found by brute force with NumPy, and every search is done one query at a time, like when responding.
+
+    PARAMETERS
+    ----------
+    `vectors` : `None || float[][]`
+        Embeddings to search, for example from `load_embeddings`. By default `amount` synthetic embeddings
+
+    `queries` : `int`
+        Embeddings searched for. Taken from `vectors`, with a little noise so that they aren't exact matches
+
+    ASSUMPTIONS
+    -----------
+    Milvus is running
+
+    RETURN
+    ------
+    Returns a list of dictionaries containing the fields `index`, `metric`, `param`, `value`, `recall`, `p50`, and `p99`.
+    Latencies are in seconds.
+    '''
+    import numpy as np
+    import vectorDatabase, indexManager
+
+    if vectors is None: vectors = synthetic_embeddings(amount)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    rng     = np.random.default_rng(1)
+    query_vectors = vectors[rng.choice(len(vectors), size=queries, replace=False)] + 0.05 * rng.normal(size=(queries, vectors.shape[1])).astype(np.float32)
+    query_vectors /= np.linalg.norm(query_vectors, axis=1, keepdims=True)
+
+    vectorDatabase.start(collection_name, backend="milvus")
+    results = []
+    try:
+        messages = [{ "id": i, "date": "2023-01-01 00:00:00.000000", "author": "benchmark#0000", "content": "" } for i in range(len(vectors))]
+        vectorDatabase.add_messages(0, vectorDatabase.MessageBatch.from_messages(messages, vectors))
+        vectorDatabase.flush(force=True)
+
+        for metric in metrics:
+            exact = indexManager.exact_neighbors(vectors, query_vectors, k, metric)
+            for index_type in indexes:
+                sweep = SEARCH_SWEEPS[index_type]
+                if not vectorDatabase.create_index({ "index_type": index_type, "metric_type": metric, "params": sweep["params"] }): continue
+
+                for value in sweep["values"]:
+                    found, latencies = 0, []
+                    for query, neighbors in zip(query_vectors, exact):
+                        with contextlib.redirect_stdout(io.StringIO()):
+                            start = time.perf_counter()
+                            res = vectorDatabase.search(0, query, limit=k, **{ sweep["search"]: value })
+                            latencies.append(time.perf_counter() - start)
+                        if res is not None: found += len({ hit.id for hit in res[0] } & set(neighbors.tolist()))
+
+                    result = {
+                        "index"   : index_type,
+                        "metric"  : metric,
+                        "param"   : sweep["search"],
+                        "value"   : value,
+                        "recall"  : found / (len(query_vectors) * exact.shape[1]),
+                        "p50"     : _percentile(latencies, 50),
+                        "p99"     : _percentile(latencies, 99)
+                    }
+                    results.append(result)
+                    debug.log(lg, f"[#] BENCHMARK - search ( index, metric, param, recall@{k}, p50, p99 ): "
+                                  f"{index_type:>8} {metric} {sweep['search']:>6}={value:<4} {result['recall']:6.3f} {result['p50']*1000:8.2f}ms {result['p99']*1000:8.2f}ms")
+    finally:
+        vectorDatabase.DROP_ALL_MEMORY()
+        vectorDatabase.stop()
+    return results
+
+
+if __name__ == "__main__":
+    debug.init()
+    if "search" in sys.argv[1:]:
+        benchmark_search()
+    else:
+        benchmark_message_to_string()
+        benchmark_memory_string_crafter()
+    debug.deinit()
@@ -1,4 +1,4 @@
-import json, datetime
+import json
 from discord.ext import commands
 from settings import BOT_ID, COMMAND_PREFIX, CONTAINER_CHAR
 import utility
@@ -52,68 +52,3 @@ async def stop():
 
 def is_ready():
     return bot.is_ready()
-
-
-async def getHistory(channel_id, limit=20000, output_to_file=False):
-    channel = bot.get_channel(int(channel_id))
-
-    messages = [message async for message in channel.history(limit=limit, oldest_first=False)]
-    messages.reverse()
-
-    parsed_messages = [
-        {
-            "id" : message.id, 
-            "date" : message.created_at, 
-            "author" : f"{message.author.name}#{message.author.discriminator}", 
-            "content" : message.content
-        } for message in messages
-    ]
-
-    # print("MESSAGES LOADED")
-    # print("Saving messages...")
-    
-    if output_to_file:
-        with open("outputs/user_history.json", 'w', encoding='utf-8') as file:
-            json.dump(parsed_messages, file, ensure_ascii=False, default=str) # datetime.datetime.strptime("2019-11-22 18:32:20.461000", '%Y-%m-%d %H:%M:%S.%f')
-
-    return parsed_messages
-
-
-async def getHistoryAround(channel_id, date, limit=15, output_to_file=False):
-    channel = bot.get_channel(int(channel_id))
-
-    if type(date) != datetime.datetime:
-        if len(date) == 19: date += ".000000"
-        date = datetime.datetime.strptime(date, '%Y-%m-%d %H:%M:%S.%f')
-
-    messages = [message async for message in channel.history(limit=limit, around=date, oldest_first=True)]
-
-    index = 0
-    for i in range(len(messages)):
-        if messages[i].created_at == date: 
-            index = i
-            break
-
-    left  = index
-    right = len(messages) - 1 - index
-    diff  = left - right
-
-    if left > right: messages = messages[ diff:]
-    else           : messages = messages[:-diff]
-
-    parsed_messages = [
-        {
-            "id" : message.id, 
-            "date" : message.created_at, 
-            "author" : f"{message.author.name}#{message.author.discriminator}", 
-            "content" : message.content
-        }
-        for message in messages
-    ]
-
-    if output_to_file:
-        with open("outputs/user_history.json", 'w', encoding='utf-8') as file:
-            json.dump(parsed_messages, file, ensure_ascii=False, default=str) # datetime.datetime.strptime("2019-11-22 18:32:20.461000", '%Y-%m-%d %H:%M:%S.%f')
-
-
-    return parsed_messages
@@ -1,7 +1,7 @@
-import discord, json, datetime
+import discord, json, datetime, time, asyncio
 from discord.ext import commands
 from settings import BOT_ID, COMMAND_PREFIX
-import utility, debug, ai, vectorDatabase
+import utility, debug, ai, vectorDatabase, prompt, syncState
 
 w  = debug.Fore.WHITE
 lb = debug.Fore.LIGHTBLACK_EX
@@ -10,14 +10,33 @@ ly = debug.Fore.LIGHTYELLOW_EX
 lr = debug.Fore.LIGHTRED_EX
 
 
+DEBOUNCE_MIN_DELAY      = 1.5   # Seconds waited for more messages before answering
+DEBOUNCE_MAX_DELAY      = 8     # Longest wait, no matter how slowly messages arrive
+DEBOUNCE_GAP_FACTOR     = 2     # Delay = average gap between messages * factor
+DEBOUNCE_SMOOTHING      = 0.3   # Weight of the newest gap in the average
+DEBOUNCE_BURST_GAP      = 60    # Gaps longer than this are pauses, not typing speed
+DEBOUNCE_TYPING_TIMEOUT = 10    # Seconds a typing indicator lasts on Discord
+DEBOUNCE_MAX_BURST      = 60    # Seconds a burst may keep growing before it is answered anyway
+WORKER_IDLE_TIMEOUT     = 600   # Seconds a channel's worker waits for messages before stopping
+
+
 class MainCog(commands.Cog):
 
 
     def __init__(self, bot):
         self.bot = bot
         self.extra_info = False
-        self.locks  = {}
-        self.chache = {}
+        self.synced_channels    = set()     # Channels brought up to date since the bot was turned on
+        self.queues             = {}        # channel_id -> asyncio.Queue of messages waiting for an answer
+        self.workers            = {}        # channel_id -> task answering the channel
+        self.message_gaps       = {}        # channel_id -> average seconds between messages inside a burst
+        self.last_message_time  = {}        # channel_id -> when the last message arrived
+        self.typing_until       = {}        # channel_id -> when the last typing indicator runs out
+
+    def cog_unload(self):
+        # History ingestion continues from where it stopped the next time the channel is synced
+        ai.stop_history_ingestion()
+
 
     async def ping(self, ctx, message):
         print(f"PING - ARGS: {message}")
@@ -61,78 +80,104 @@ class MainCog(commands.Cog):
                 print(f"UNDEFINED     {channel}")
 
     
-    async def send_message(self, message):
+    def debounce_delay(self, channel_id):
+        '''
+        How long to wait for more messages before answering a channel.
+
+        The delay follows how fast messages have been arriving in the channel,
+        so fast typers get quick answers and slow typers are not interrupted.
+        While someone is typing, the worker waits for them to finish.
+        '''
+        gap = self.message_gaps.get(channel_id)
+        if gap is None: return DEBOUNCE_MIN_DELAY
+        return min(DEBOUNCE_MAX_DELAY, max(DEBOUNCE_MIN_DELAY, gap * DEBOUNCE_GAP_FACTOR))
+
+
+    def enqueue_message(self, message):
+        '''
+        Give a message to its channel's worker, starting the worker if the channel doesn't have one.
+        '''
         channel_id = message.channel.id
+        now = time.monotonic()
+
+        # Average time between messages inside bursts. Longer pauses start a new burst and are not counted
+        last = self.last_message_time.get(channel_id)
+        if last is not None and now - last < DEBOUNCE_BURST_GAP:
+            gap = self.message_gaps.get(channel_id, now - last)
+            self.message_gaps[channel_id] = DEBOUNCE_SMOOTHING * (now - last) + (1 - DEBOUNCE_SMOOTHING) * gap
+        self.last_message_time[channel_id] = now
+
+        if channel_id not in self.queues: self.queues[channel_id] = asyncio.Queue()
+        self.queues[channel_id].put_nowait(message)
+        if channel_id not in self.workers:
+            self.workers[channel_id] = asyncio.create_task(self.channel_worker(channel_id))
+
+
+    async def channel_worker(self, channel_id):
+        '''
+        Answer a single channel, one burst of messages at a time.
+
+        Each channel has its own worker, so channels are answered concurrently,
+        while messages of the same channel are never handled at the same time.
+        The worker stops after `WORKER_IDLE_TIMEOUT` seconds without messages.
+        '''
+        queue = self.queues[channel_id]
+        while True:
+            try: messages = [await asyncio.wait_for(queue.get(), WORKER_IDLE_TIMEOUT)]
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    del self.workers[channel_id]
+                    return
+                continue
+
+            # Collect the rest of the burst
+            burst_start = time.monotonic()
+            while time.monotonic() - burst_start < DEBOUNCE_MAX_BURST:
+                delay = self.debounce_delay(channel_id)
+                delay = max(delay, self.typing_until.get(channel_id, 0) - time.monotonic())
+                try: messages.append(await asyncio.wait_for(queue.get(), delay))
+                except asyncio.TimeoutError: break
+            while not queue.empty(): messages.append(queue.get_nowait())
+
+            try: await self.send_message(messages)
+            except Exception as e:
+                debug.log(ly, f"[*] BOT - Failed to answer channel {channel_id}")
+                debug.log(lb, f"          exception: {e}")
 
-        # notes
-        # ( stm must store token size )
-
-        # if (fisrt message since turn on) and (not new channel)
-            # GET RECENT CHANNEL HISTORY
-            # if (stm doesn't match history)
-                # UPDATE STM
-            # if ()
-
-        # ADD MESSAGE into CHANNEL QUEUE
-        # LOCK CHANNEL
-
-        # if new channel
-            # GET CHANNEL HISTORY UP TO 50000 - MINUS CURRENT MESSAGE
-            # BUILD STM
-            # GET LTM EMBEDDINGS
-            # BUILD LTM
-            # SAVE FAILED EMBEDDINGS INTO FILE
-
-        # ADD MESSAGES FROM QUEUE INTO STM
-        # SEND OVERFLOWING STM INTO LTM
-
-        # GENERATE RESPONSE
-
-        # RESPOND
-        # UNLOCK CHANNEL
-
-
-        # if (fisrt message since turn on) and (not new channel)
-            # GET RECENT CHANNEL HISTORY
-            # if (stm doesn't match history)
-                # UPDATE STM
-
-        # ADD MESSAGE TO BUFFER
-
-        # LOCK
-        # DYNAMIC DELAY
-
-        # if new channel
-            # GET CHANNEL HISTORY
-            # BUILD STM
-            # GET LTM EMBEDDINGS
-            # BUILD LTM
-
-        # ADD MESSAGE FROM BUFFER INTO STM
-        # ADD OVERFLOWING STM INTO LTM
 
-        # SEND MESSAGE
-        # UNLOCK
+    async def send_message(self, messages):
+        '''
+        Add a burst of messages into the channel's memory and answer them with a single response.
+        '''
+        channel = messages[-1].channel
+        channel_id = channel.id
 
+        # First message since turn on: fetch only the messages missed while off.
+        # A new channel gets its history instead
+        if channel_id not in self.synced_channels:
+            if not await ai.create_channel_memory_if_new(channel_id):
+                await asyncio.to_thread(ai.replay_failed_saves, channel_id)
+                await ai.sync_channel(channel_id)
+                ai.start_history_ingestion(channel_id)
+            self.synced_channels.add(channel_id)
 
-        # if vectorDatabase.create_channel_memory_if_new(channel_id):
-        #     pass
-        #     # GET CHANNEL HISTORY
-        #     # BUILD STM
-        #     # GET LTM EMBEDDINGS
-        #     # BUILD LTM
+        # Syncing might already have added the messages
+        newest = syncState.load(channel_id)["newest"]
+        new_messages = [parse_message(message) for message in messages if newest is None or message.id > newest]
+        if len(new_messages) > 0: await asyncio.to_thread(ai.add_messages_into_memory, channel_id, new_messages)
+        if self.extra_info: debug.log(lb, f"[-] BOT - Answering burst of {len(messages)} message{'' if len(messages) == 1 else 's'} in channel {channel_id}")
 
-        # else:
-        #     pass
-            
-            
+        chat_response = await asyncio.to_thread(ai.respond, channel_id)
+        if chat_response is None: return
 
-            # if not vectorDatabase.add_messages(message.author.id, memory, debug_info=True): return
-            # if not vectorDatabase.create_index(): return
+        sent = await channel.send(chat_response["choices"][0]["message"]["content"])
+        await asyncio.to_thread(ai.add_messages_into_memory, channel_id, [parse_message(sent)])
 
-            # debug.logt(g, "Index created")     
 
-        # UNLOCK
+    @commands.Cog.listener()
+    async def on_typing(self, channel, user, when):
+        if user.id == BOT_ID: return
+        self.typing_until[channel.id] = time.monotonic() + DEBOUNCE_TYPING_TIMEOUT
 
 
     @commands.Cog.listener()
@@ -170,11 +215,119 @@ class MainCog(commands.Cog):
         
         if not utility.is_admin(message.author.id): return
 
-        # INITIATE SENDING MESSAGE
-        # await self.send_message(message)
+        self.enqueue_message(message)
+
+
+def parse_message(message):
+    '''
+    Turn a `discord.Message` into the message format used by the AI.
+
+    The message's date is parsed once here into `timestamp` (seconds since epoch, UTC),
+    so that nothing after this has to parse `date` again.
+    '''
+    return {
+        "id"        : message.id, 
+        "date"      : message.created_at.strftime(prompt.DATE_FORMAT), 
+        "timestamp" : message.created_at.timestamp(),
+        "author"    : f"{message.author.name}#{message.author.discriminator}", 
+        "content"   : message.content
+    }
+
+
+async def getHistory(channel_id, limit=20000, output_to_file=False):
+    channel = bot.get_channel(int(channel_id))
+
+    messages = [message async for message in channel.history(limit=limit, oldest_first=False)]
+    messages.reverse()
+
+    parsed_messages = [parse_message(message) for message in messages]
+
+    # print("MESSAGES LOADED")
+    # print("Saving messages...")
+    
+    if output_to_file:
+        with open("outputs/user_history.json", 'w', encoding='utf-8') as file:
+            json.dump(parsed_messages, file, ensure_ascii=False, default=str) # datetime.datetime.strptime("2019-11-22 18:32:20.461000", '%Y-%m-%d %H:%M:%S.%f')
+
+    return parsed_messages
+
+
+async def iterHistory(channel_id, chunk_size=100, limit=None, before=None, after=None, oldest_first=False):
+    '''
+    Page through a channel's history, yielding it in chunks instead of all at once.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel whose history is read
+
+    `chunk_size` : `int`
+        Messages inside each chunk
+
+    `limit` : `None || int`
+        Max amount of messages. `None` reads the whole history
+
+    `before` / `after` : `None || int`
+        Only read messages older / newer than the message with this id
+
+    `oldest_first` : `bool`
+        Read from oldest to newest instead of newest to oldest
+
+    RETURN
+    ------
+    Async generator of `dict[]` chunks, in the format of `parse_message`.
+    Messages are ordered the same way inside and between chunks.
+    '''
+    channel = bot.get_channel(int(channel_id))
+
+    chunk = []
+    async for message in channel.history(
+        limit           = limit, 
+        before          = discord.Object(id=before) if before is not None else None, 
+        after           = discord.Object(id=after)  if after  is not None else None, 
+        oldest_first    = oldest_first
+    ):
+        chunk.append(parse_message(message))
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0: yield chunk
+
+
+async def getHistoryAround(channel_id, date, limit=15, output_to_file=False):
+    channel = bot.get_channel(int(channel_id))
+
+    if type(date) != datetime.datetime:
+        date = datetime.datetime.fromtimestamp(prompt.parse_date(date), datetime.timezone.utc)
+
+    messages = [message async for message in channel.history(limit=limit, around=date, oldest_first=True)]
+
+    index = 0
+    for i in range(len(messages)):
+        if messages[i].created_at == date: 
+            index = i
+            break
+
+    left  = index
+    right = len(messages) - 1 - index
+    diff  = left - right
+
+    if left > right: messages = messages[ diff:]
+    else           : messages = messages[:-diff]
+
+    parsed_messages = [parse_message(message) for message in messages]
+
+    if output_to_file:
+        with open("outputs/user_history.json", 'w', encoding='utf-8') as file:
+            json.dump(parsed_messages, file, ensure_ascii=False, default=str) # datetime.datetime.strptime("2019-11-22 18:32:20.461000", '%Y-%m-%d %H:%M:%S.%f')
+
+
+    return parsed_messages
 
 
 def setup(_bot):
     global bot
     bot = _bot
-    _bot.add_cog(MainCog(_bot))
\ No newline at end of file
+    _bot.add_cog(MainCog(_bot))
+    # Save messages left inside the spool from the last run
+    ai.start_spooler()
\ No newline at end of file
@@ -0,0 +1,282 @@
+'''
+EMBEDDING CACHE
+===============
+
+Persistent cache for embeddings, so that the same text is never paid for twice.
+
+Embeddings are saved inside an SQLite database, by default `embedding-cache.sqlite3`.
+Entries are keyed by the embedding model and a hash of the normalized text,
+and stored as raw float32 bytes.
+
+When the cache grows past `CACHE_MAX_ENTRIES`, the least recently used entries are evicted.
+Reads don't write anything. When entries were last used is remembered in memory,
+and written together with the next `put_many`, by `flush`, or once `TOUCH_FLUSH_AFTER` entries are waiting.
+
+NOTES
+-----
+The cache opens itself on first use, but should be closed when the program stops:
+    >>> get_many(model, strings)
+    >>> DO STUFF ...
+    >>> stop()
+
+FUNCTIONS
+---------
+normalize
+
+get_many
+
+put_many
+
+flush
+
+get_stats
+
+stop
+'''
+
+import sqlite3, hashlib, threading, time, unicodedata
+import numpy as np
+import debug
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+CACHE_PATH          = "embedding-cache.sqlite3"
+CACHE_MAX_ENTRIES   = 500000     # ~3 GB of ada-002 embeddings
+CACHE_EVICT_TO      = 0.9        # Fraction of CACHE_MAX_ENTRIES left after an eviction
+TOUCH_FLUSH_AFTER   = 10000      # Used entries whose `last_used` waits in memory before it is written
+
+_connection = None
+_entries    = 0
+_touched    = {}        # ( model, hash ) -> when the entry was last used, not yet written
+_lock       = threading.Lock()
+_stats      = {
+    "hits"      : 0,
+    "misses"    : 0,
+    "evicted"   : 0
+}
+
+
+def _connect():
+    '''
+    Open the cache database if it isn't open already.
+    '''
+    global _connection, _entries
+
+    if _connection is not None: return
+    _connection = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+    _connection.execute("PRAGMA journal_mode=WAL")
+    _connection.execute("PRAGMA synchronous=NORMAL")
+    _connection.execute('''
+        CREATE TABLE IF NOT EXISTS embeddings (
+            model       TEXT    NOT NULL,
+            hash        BLOB    NOT NULL,
+            embedding   BLOB    NOT NULL,
+            last_used   REAL    NOT NULL,
+            PRIMARY KEY (model, hash)
+        ) WITHOUT ROWID
+    ''')
+    _connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+    _connection.commit()
+    _entries = _connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    debug.log(lg, f"[#] EMBEDDING CACHE - Cache opened with {_entries} entries")
+
+
+def normalize(string):
+    '''
+    Returns the normalized form of a string.
+    Strings with the same normalized form share the same embedding.
+    '''
+    return unicodedata.normalize("NFC", string).strip()
+
+
+def _key(string):
+    return hashlib.blake2b(normalize(string).encode('utf-8'), digest_size=16).digest()
+
+
+def get_many(model, strings):
+    '''
+    Look up cached embeddings.
+
+    PARAMETERS
+    ----------
+    `model` : `str`
+        Model the embeddings were created with
+
+    `strings` : `str[]`
+        Strings to look up
+
+    FAILURE
+    -------
+    `[*]` : Reading the cache failed. Everything is treated as a miss
+
+    RETURN
+    ------
+    Returns a list with the same length as `strings`,
+    containing the embedding (float32 array) of each string, or `None` if the string wasn't cached.
+    '''
+    global _connection
+
+    keys   = [_key(string) for string in strings]
+    found  = {}
+
+    with _lock:
+        try:
+            _connect()
+            unique_keys = list(set(keys))
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i+500]
+                rows = _connection.execute(
+                    f"SELECT hash, embedding FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk]
+                ).fetchall()
+                for hash, blob in rows: found[hash] = np.frombuffer(blob, dtype=np.float32)
+
+            now = time.time()
+            for hash in found: _touched[(model, hash)] = now
+        except Exception as e:
+            debug.log(ly,  "[*] EMBEDDING CACHE - Failed to read cache")
+            debug.log(lb, f"                      exception: {e}"      )
+            found = {}
+
+        result = [found.get(key) for key in keys]
+        hits = sum(1 for embedding in result if embedding is not None)
+        _stats["hits"]   += hits
+        _stats["misses"] += len(result) - hits
+
+        if len(_touched) >= TOUCH_FLUSH_AFTER: _flush()
+    return result
+
+
+def put_many(model, strings, embeddings):
+    '''
+    Save embeddings into the cache, evicting the least recently used entries if the cache gets too large.
+
+    PARAMETERS
+    ----------
+    `model` : `str`
+        Model the embeddings were created with
+
+    `strings` : `str[]`
+        The embedded strings
+
+    `embeddings` : `float[][]`
+        The embedding of each string
+
+    FAILURE
+    -------
+    `[*]` : Writing into the cache failed. Nothing is saved
+    '''
+    global _connection, _entries
+
+    now  = time.time()
+    rows = [(model, _key(string), np.asarray(embedding, dtype=np.float32).tobytes(), now) for string, embedding in zip(strings, embeddings)]
+
+    with _lock:
+        try:
+            _connect()
+            # Written first, so that eviction sees which entries were used
+            _write_touched()
+            before = _connection.total_changes
+            _connection.executemany("INSERT OR IGNORE INTO embeddings (model, hash, embedding, last_used) VALUES (?, ?, ?, ?)", rows)
+            _entries += _connection.total_changes - before
+
+            if _entries > CACHE_MAX_ENTRIES:
+                evict_amount = _entries - int(CACHE_MAX_ENTRIES * CACHE_EVICT_TO)
+                _connection.execute(
+                    "DELETE FROM embeddings WHERE (model, hash) IN (SELECT model, hash FROM embeddings ORDER BY last_used LIMIT ?)",
+                    (evict_amount,)
+                )
+                _entries          -= evict_amount
+                _stats["evicted"] += evict_amount
+                debug.log(lb, f"[-] EMBEDDING CACHE - Evicted {evict_amount} least recently used entries")
+
+            _connection.commit()
+            _touched.clear()
+        except Exception as e:
+            debug.log(ly,  "[*] EMBEDDING CACHE - Failed to write into cache")
+            debug.log(lb, f"                      exception: {e}"            )
+            try: _connection.rollback()
+            except Exception: pass
+
+
+def _write_touched():
+    '''
+    Write when the used entries were last used, without committing. Call while holding `_lock`.
+    '''
+    if len(_touched) == 0: return
+    _connection.executemany("UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?", [(now, model, hash) for (model, hash), now in _touched.items()])
+
+
+def _flush():
+    '''
+    Same as `flush`. Call while holding `_lock`.
+    '''
+    if len(_touched) == 0: return
+    try:
+        _connect()
+        _write_touched()
+        _connection.commit()
+    except Exception as e:
+        debug.log(ly,  "[*] EMBEDDING CACHE - Failed to write when entries were last used")
+        debug.log(lb, f"                      exception: {e}"                              )
+        try: _connection.rollback()
+        except Exception: pass
+    # Only decides the eviction order, so it isn't kept around after a failure
+    _touched.clear()
+
+
+def flush():
+    '''
+    Write when the entries used since the last write were last used.
+
+    FAILURE
+    -------
+    `[*]` : Writing failed. The entries keep their older `last_used`
+    '''
+    with _lock: _flush()
+
+
+def get_stats():
+    '''
+    Get information about how well the cache is working.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `hits`, `misses`, `hitRate`, `evicted`, and `entries`:
+
+    `hits` : `int`
+        Strings found in the cache
+    `misses` : `int`
+        Strings not found in the cache
+    `hitRate` : `float`
+        `hits / (hits + misses)`, or `0` if nothing has been looked up
+    `evicted` : `int`
+        Entries removed because the cache was full
+    `entries` : `int`
+        Entries currently inside the cache
+    '''
+    with _lock:
+        lookups = _stats["hits"] + _stats["misses"]
+        return {
+            **_stats,
+            "hitRate" : _stats["hits"] / lookups if lookups > 0 else 0,
+            "entries" : _entries
+        }
+
+
+def stop():
+    '''
+    Close the cache database.
+    '''
+    global _connection
+    with _lock:
+        if _connection is None: return
+        _flush()
+        _connection.close()
+        _connection = None
+        debug.log(lg, "[#] EMBEDDING CACHE - Cache closed")
@@ -0,0 +1,270 @@
+'''
+INDEX MANAGER
+=============
+
+Module for choosing and maintaining the index of long-term memory as it grows.
+
+The index type and its parameters are chosen from the amount of messages inside memory:
+
+`IVF_FLAT` : small memory. Cheap to build, exact distances inside the searched clusters
+
+`HNSW` : medium memory. Lowest latency and highest recall, but its graph must fit inside the memory budget
+
+`IVF_SQ8` : large memory. Vectors are stored as 8-bit integers, a quarter of the memory of `IVF_FLAT`
+
+The index is only rebuilt when memory has grown by `REBUILD_GROWTH` since the last build,
+or when a different index type is chosen, and builds run in a background thread.
+Every build is recorded into `index-state.json` with how long it took and the recall it reached,
+so that the latency/recall trade-off can be checked as memory grows.
+
+NOTES
+-----
+Requires NumPy for measuring recall.
+
+FUNCTIONS
+---------
+choose_index
+
+ensure_index
+
+build_index
+
+exact_neighbors
+
+measure_recall
+
+get_state
+'''
+
+import threading, time, json, os, random
+import numpy as np
+import debug, utility, vectorDatabase, milvusVectorStore
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+STATE_PATH = "index-state.json"
+
+IVF_FLAT_MAX_ENTITIES   = 100000        # Below this IVF_FLAT is used
+HNSW_M                  = 16
+HNSW_EF_CONSTRUCTION    = 200
+REBUILD_GROWTH          = 2             # Rebuild once memory is this many times larger than at the last build
+REBUILD_MIN_ENTITIES    = 1000          # Growth of memory smaller than this is never worth a rebuild
+CHECK_INTERVAL          = 10 * 60       # Seconds between checks of whether the index should be rebuilt
+METRIC                  = "L2"          # "L2" or "IP". ada-002 embeddings are normalized, so both give the same neighbors
+
+RECALL_K                = 10
+RECALL_QUERIES          = 100
+RECALL_MAX_ENTITIES     = 50000         # Largest channel used for measuring recall, as every one of its vectors is compared
+
+_state          = None      # { "index": dict, "entities": int, "builtAt": float, "buildSeconds": float, "recall": float, "history": dict[] }
+_last_check     = 0
+_builder        = None      # Thread building an index
+_lock           = threading.Lock()
+
+
+def _load_state():
+    global _state
+    if _state is not None: return _state
+    _state = { "index": None, "entities": 0, "builtAt": None, "buildSeconds": None, "recall": None, "history": [] }
+    if os.path.isfile(STATE_PATH):
+        with open(STATE_PATH, encoding='utf-8') as file:
+            _state.update(json.load(file))
+    return _state
+
+
+def choose_index(entities):
+    '''
+    Choose the index type and parameters for memory of `entities` messages.
+
+    RETURN
+    ------
+    Returns the index parameters in the format used by `vectorDatabase.create_index`.
+    '''
+    # Recommended amount of IVF clusters is around 4 * sqrt(n)
+    nlist = int(min(65536, max(128, 4 * entities ** 0.5)))
+
+    hnsw_bytes = entities * (vectorDatabase._DIM * 4 + HNSW_M * 2 * 8)
+    if entities < IVF_FLAT_MAX_ENTITIES:
+        return { "index_type": "IVF_FLAT", "metric_type": METRIC, "params": { "nlist": nlist } }
+    if hnsw_bytes <= milvusVectorStore.PARTITION_MAX_MEMORY_BYTES:
+        return { "index_type": "HNSW",     "metric_type": METRIC, "params": { "M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION } }
+    return     { "index_type": "IVF_SQ8",  "metric_type": METRIC, "params": { "nlist": nlist } }
+
+
+def _needs_rebuild(index, entities):
+    state = _load_state()
+    current = vectorDatabase.get_index()
+    if current is None or state["index"] is None: return True
+    if current["index_type"] != index["index_type"] or current["metric_type"] != index["metric_type"]: return True
+    return entities >= max(state["entities"], REBUILD_MIN_ENTITIES) * REBUILD_GROWTH
+
+
+def ensure_index(force=False, background=True):
+    '''
+    Rebuild the index if memory has grown enough, or a different index type should be used.
+
+    Cheap to call often: the amount of messages is checked at most every `CHECK_INTERVAL` seconds.
+
+    PARAMETERS
+    ----------
+    `force` : `bool`
+        Check right away, ignoring `CHECK_INTERVAL`
+
+    `background` : `bool`
+        Build the index inside a background thread instead of waiting for it
+
+    FAILURE
+    -------
+    `[*]` : Counting messages failed
+
+    RETURN
+    ------
+    Returns `True` if a build was started.
+    '''
+    global _last_check, _builder
+
+    if not vectorDatabase.is_available(): return False
+
+    with _lock:
+        if not force and time.time() - _last_check < CHECK_INTERVAL: return False
+        _last_check = time.time()
+        if _builder is not None and _builder.is_alive(): return False
+
+        try: entities = vectorDatabase.count_entities()
+        except Exception as e:
+            debug.log(ly,  "[*] INDEX MANAGER - Failed to count messages")
+            debug.log(lb, f"                    exception: {e}")
+            return False
+
+        index = choose_index(entities)
+        if not _needs_rebuild(index, entities): return False
+
+        if background:
+            _builder = threading.Thread(target=build_index, args=(index, entities), name="index-builder", daemon=True)
+            _builder.start()
+            return True
+
+    build_index(index, entities)
+    return True
+
+
+def build_index(index, entities=None):
+    '''
+    Build an index, measure its recall, and record both into `index-state.json`.
+
+    RETURN
+    ------
+    Returns `True` if the index was built.
+    '''
+    if entities is None: entities = vectorDatabase.count_entities()
+
+    debug.log(w, f"[%] INDEX MANAGER - Building {index['index_type']} index for {entities} messages")
+    start = time.perf_counter()
+    if not vectorDatabase.create_index(index): return False
+    build_seconds = time.perf_counter() - start
+    recall = measure_recall()
+
+    with _lock:
+        state = _load_state()
+        record = { "index": index, "entities": entities, "builtAt": time.time(), "buildSeconds": build_seconds, "recall": recall }
+        state.update(record)
+        state["history"].append(record)
+        utility.write_json_atomic(STATE_PATH, state)
+
+    debug.log(lg, f"[#] INDEX MANAGER - Index built ( type, messages, seconds, recall@{RECALL_K} ): "
+                  f"{index['index_type']} {entities} {build_seconds:.1f} {'?' if recall is None else f'{recall:.3f}'}")
+    return True
+
+
+def exact_neighbors(vectors, queries, k, metric=METRIC):
+    '''
+    Find the exact `k` nearest neighbors of each query by comparing it against every vector.
+
+    PARAMETERS
+    ----------
+    `vectors` : `float[][]`
+        Vectors searched
+
+    `queries` : `float[][]`
+        Vectors searched for
+
+    `metric` : `str`
+        `L2` or `IP`
+
+    RETURN
+    ------
+    Returns an `int` array of shape `( len(queries), k )` containing indexes into `vectors`, nearest first.
+    '''
+    vectors = np.asarray(vectors, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(vectors))
+
+    scores = queries @ vectors.T
+    if metric == "L2": scores = 2 * scores - (vectors * vectors).sum(axis=1)     # Larger is nearer, |q|^2 is the same for every vector
+
+    nearest = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order   = np.argsort(-np.take_along_axis(scores, nearest, axis=1), axis=1)
+    return np.take_along_axis(nearest, order, axis=1)
+
+
+def measure_recall(k=RECALL_K, queries=RECALL_QUERIES, channel_id=None):
+    '''
+    Measure how many of the exact nearest neighbors the current index finds.
+
+    A channel small enough to brute force is searched with its own messages as queries,
+    and the results are compared against `exact_neighbors`.
+
+    PARAMETERS
+    ----------
+    `channel_id` : `None || int`
+        Channel to measure with. By default a random channel with at most `RECALL_MAX_ENTITIES` messages
+
+    FAILURE
+    -------
+    `[*]` : No channel could be used, or searching failed
+
+    RETURN
+    ------
+    Returns recall@k as `float`, or `None` if failed.
+    '''
+    try:
+        if channel_id is None:
+            channels = [id for id in vectorDatabase.list_channels() if k < vectorDatabase.count_entities(id) <= RECALL_MAX_ENTITIES]
+            if len(channels) == 0: return None
+            channel_id = random.choice(channels)
+
+        result = vectorDatabase.get_embeddings(channel_id, RECALL_MAX_ENTITIES)
+        if result is None: return None
+        ids, vectors = result
+
+        sample = random.sample(range(len(vectors)), min(queries, len(vectors)))
+        metric = (vectorDatabase.get_index() or vectorDatabase.DEFAULT_INDEX)["metric_type"]
+        exact  = exact_neighbors(vectors, [vectors[i] for i in sample], k, metric)
+
+        res = vectorDatabase.search(channel_id, [vectors[i] for i in sample], limit=k)
+        if res is None: return None
+
+        found = 0
+        for hits, neighbors in zip(res, exact):
+            found += len({ hit.id for hit in hits[:k] } & { ids[i] for i in neighbors })
+        return found / (len(sample) * exact.shape[1])
+    except Exception as e:
+        debug.log(ly,  "[*] INDEX MANAGER - Failed to measure recall")
+        debug.log(lb, f"                    exception: {e}")
+
+
+def get_state():
+    '''
+    Get the current index and the history of every build.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `index`, `entities`, `builtAt`, `buildSeconds`, `recall`, `history`, and `building`.
+    '''
+    with _lock:
+        return { **json.loads(json.dumps(_load_state())), "building": _builder is not None and _builder.is_alive() }
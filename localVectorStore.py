@@ -0,0 +1,785 @@
+'''
+LOCAL VECTOR STORE
+==================
+
+In-process vector engine, used by `vectorDatabase` instead of Milvus when it is started with `backend="local"`.
+
+Everything is kept inside `vector-store/{collection name}`, one directory per channel:
+
+`{n}.vectors` : embeddings of segment `n`, as a raw float32 matrix that is memory-mapped for searching
+
+`{n}.float16`, `{n}.int8`, `{n}.scales` : quantized embeddings of segment `n`, see `QUANTIZATION`
+
+`{n}.ids` : message id of every row of segment `n`, as raw int64
+
+`messages.sqlite3` : date, author, and content of every message, ordered by id,
+                     and the rows of removed messages (tombstones)
+
+New messages are appended onto the end of the newest segment, and a new segment is started after `SEGMENT_MAX_ROWS` rows.
+Removing a message only marks its row as removed, so segments are never rewritten.
+Searches only hold the store's lock while taking a view of the channel's segments, and scan the view without it.
+
+Searching compares the query against every row with NumPy and picks the nearest with `argpartition`.
+Channels with at least `IVF_MIN_ROWS` messages can be clustered by `create_index`,
+after which only the rows of the `nprobe` nearest clusters are compared.
+
+With `QUANTIZATION`, new segments are compared in float16 (half the memory),
+or in int8 with a float32 scale for each row (a quarter of the memory).
+The nearest `RERANK_FACTOR` times more candidates are then reordered with their exact float32 vectors,
+which stay on disk and are only read for those candidates.
+Without `KEEP_EXACT_VECTORS` the exact vectors are not written at all, saving disk as well, at the cost of some recall.
+
+NOTES
+-----
+Has the same functions as `milvusVectorStore`, which `vectorDatabase` calls without knowing which backend it is using.
+
+Search results look like the ones returned by Milvus: a list of hits for every query vector,
+each hit having `id`, `distance`, and `entity`.
+
+Requires NumPy.
+
+FUNCTIONS
+---------
+start
+
+stop
+
+is_available
+
+create_channel_memory_if_new
+
+remove_channel_memory_if_exist
+
+insert
+
+existing_ids
+
+get_neighbors
+
+get_embeddings
+
+list_channels
+
+count_entities
+
+drop_messages
+
+create_index
+
+get_index
+
+search
+
+flush
+
+get_segment_stats
+
+drop_all
+
+release_idle_partitions
+
+get_partition_stats
+
+get_connection_stats
+'''
+
+import os, sqlite3, threading, shutil
+import numpy as np
+import debug
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+STORE_DIRECTORY     = "vector-store"
+SEGMENT_MAX_ROWS    = 50000     # Rows appended into a segment before a new one is started
+IVF_MIN_ROWS        = 20000     # Channels smaller than this are always compared against every row
+IVF_ITERATIONS      = 10        # k-means iterations when clustering a channel
+
+QUANTIZATION        = None      # None, "float16", or "int8". Format new segments are compared in
+KEEP_EXACT_VECTORS  = True      # Keep the float32 vectors of quantized segments, for reranking
+RERANK_FACTOR       = 4         # Candidates reranked with the exact vectors, times the amount of wanted hits
+SCAN_CHUNK_ROWS     = 8192      # Quantized rows turned into float32 at a time while searching
+
+PARALLEL_INSERTS    = False     # Inserts hold the store's lock, so their batches are sent one at a time
+
+_directory  = None              # Directory of the opened collection
+_dim        = None
+_channels   = {}                # channel_id (str) -> _Channel, opened on first use
+_index      = None              # Index parameters given to create_index
+_lock       = threading.RLock()
+
+
+class Hit:
+    '''
+    A single search result, in the same shape as a Milvus hit.
+    '''
+    __slots__ = ("id", "distance", "entity")
+
+    def __init__(self, id, distance, entity):
+        self.id       = id
+        self.distance = distance
+        self.entity   = entity
+
+
+class _Segment:
+    '''
+    Rows of a channel inside a single set of files.
+
+    A segment keeps the format it was created with, so changing `QUANTIZATION` only affects new segments.
+    '''
+    __slots__ = ("number", "path", "quantization", "exact", "rows", "_vectors", "_scan", "_scales", "_ids", "_norms")
+
+    def __init__(self, directory, number):
+        self.number = number
+        self.path   = os.path.join(directory, str(number))
+
+        new = not os.path.isfile(self.path + ".ids")
+        self.quantization = next((format for format in ("float16", "int8") if os.path.isfile(f"{self.path}.{format}")), QUANTIZATION if new else None)
+        self.exact        = os.path.isfile(self.path + ".vectors") or (new and (self.quantization is None or KEEP_EXACT_VECTORS))
+        self.rows         = 0 if new else os.path.getsize(self.path + ".ids") // 8     # Kept up to date by `append` and `truncate`
+        self._norms       = None
+        self.invalidate()
+
+    def invalidate(self):
+        '''
+        Forget the mapped files, which don't cover appended rows. Norms are kept, as rows are only ever appended.
+        '''
+        self._vectors = None
+        self._scan    = None
+        self._scales  = None
+        self._ids     = None
+
+    def _map(self, format):
+        rows = self.rows
+        if rows == 0: return np.empty((0, _dim), format)
+        return np.memmap(f"{self.path}.{'vectors' if format == 'float32' else format}", dtype=format, mode='r', shape=(rows, _dim))
+
+    @property
+    def vectors(self):
+        '''
+        The exact float32 vectors, or `None` if they weren't kept.
+        '''
+        if self._vectors is None and self.exact: self._vectors = self._map("float32")
+        return self._vectors
+
+    @property
+    def scan(self):
+        '''
+        The vectors compared while searching, quantized or not.
+        '''
+        if self._scan is None: self._scan = self.vectors if self.quantization is None else self._map(self.quantization)
+        return self._scan
+
+    @property
+    def scales(self):
+        if self._scales is None and self.quantization == "int8": self._scales = np.fromfile(self.path + ".scales", dtype=np.float32)
+        return self._scales
+
+    @property
+    def ids(self):
+        if self._ids is None: self._ids = np.fromfile(self.path + ".ids", dtype=np.int64) if self.rows > 0 else np.empty(0, np.int64)
+        return self._ids
+
+    @property
+    def norms(self):
+        '''
+        Squared length of every compared row, needed for L2 distances. Only rows appended since the last call are computed.
+        '''
+        norms = self._norms if self._norms is not None else np.empty(0, np.float32)
+        if len(norms) < self.rows:
+            blocks = [norms]
+            for start in range(len(norms), self.rows, SCAN_CHUNK_ROWS):
+                block = self.dequantize(slice(start, min(self.rows, start + SCAN_CHUNK_ROWS)))
+                blocks.append(np.einsum('ij,ij->i', block, block))
+            norms = self._norms = np.concatenate(blocks)
+        return norms
+
+    def dequantize(self, rows):
+        '''
+        Returns the compared vectors of `rows` (a slice or an index array) as float32.
+        '''
+        return _dequantize(self.scan, self.scales, self.quantization, rows)
+
+    def view(self, removed):
+        '''
+        Returns a `_SegmentView` of the rows appended so far. Call while holding `_lock`.
+        '''
+        return _SegmentView(self, removed)
+
+    def append(self, ids, vectors):
+        if self.exact:
+            with open(self.path + ".vectors", 'ab') as file: file.write(vectors.tobytes())
+        if self.quantization == "float16":
+            with open(self.path + ".float16", 'ab') as file: file.write(vectors.astype(np.float16).tobytes())
+        elif self.quantization == "int8":
+            scales = np.abs(vectors).max(axis=1) / 127
+            scales[scales == 0] = 1
+            with open(self.path + ".int8", 'ab')   as file: file.write(np.rint(vectors / scales[:, None]).clip(-127, 127).astype(np.int8).tobytes())
+            with open(self.path + ".scales", 'ab') as file: file.write(scales.astype(np.float32).tobytes())
+        with open(self.path + ".ids", 'ab') as file: file.write(ids.tobytes())
+        self.rows += len(ids)
+        self.invalidate()
+
+    def truncate(self, rows):
+        '''
+        Cut every file down to `rows`, or to the rows of `.ids` if it has fewer, as it is written last by `append`.
+        Rows left over by an append torn by a crash would otherwise shift the vectors of all later rows against their ids,
+        and rows whose messages were never committed would be found without their date, author, and content.
+
+        RETURN
+        ------
+        Returns `True` if any file was cut.
+        '''
+        rows = min(rows, self.rows)
+        cut  = False
+        for extension, row_bytes in ((".ids", 8), (".vectors", _dim * 4), (".float16", _dim * 2), (".int8", _dim), (".scales", 4)):
+            if not os.path.isfile(self.path + extension) or os.path.getsize(self.path + extension) <= rows * row_bytes: continue
+            os.truncate(self.path + extension, rows * row_bytes)
+            cut = True
+        if cut:
+            self.rows   = rows
+            self._norms = None
+            self.invalidate()
+        return cut
+
+    def sync(self):
+        for extension in (".vectors", ".float16", ".int8", ".scales", ".ids"):
+            if not os.path.isfile(self.path + extension): continue
+            with open(self.path + extension, 'ab') as file: os.fsync(file.fileno())
+
+
+class _SegmentView:
+    '''
+    The rows of a segment at one moment, and everything needed to search them without holding `_lock`.
+    Rows are only ever appended, so the files behind a view never change under it.
+    '''
+    __slots__ = ("rows", "quantization", "exact", "vectors", "scan", "scales", "norms", "ids", "removed")
+
+    def __init__(self, segment, removed):
+        self.rows           = segment.rows
+        self.quantization   = segment.quantization
+        self.exact          = segment.exact
+        self.vectors        = segment.vectors
+        self.scan           = segment.scan
+        self.scales         = segment.scales
+        self.norms          = segment.norms
+        self.ids            = segment.ids
+        self.removed        = removed
+
+    def dequantize(self, rows):
+        return _dequantize(self.scan, self.scales, self.quantization, rows)
+
+
+def _dequantize(scan, scales, quantization, rows):
+    '''
+    Returns the compared vectors of `rows` (a slice or an index array) as float32.
+    '''
+    block = np.asarray(scan[rows], dtype=np.float32)
+    if quantization == "int8": block *= scales[rows][:, None]
+    return block
+
+
+class _Channel:
+    '''
+    A single channel's memory: its segments, the database of its messages, and its clusters.
+    '''
+
+    def __init__(self, directory):
+        self.directory  = directory
+        self.database   = sqlite3.connect(os.path.join(directory, "messages.sqlite3"), check_same_thread=False)
+        self.database.execute('''
+            CREATE TABLE IF NOT EXISTS messages (
+                id      INTEGER PRIMARY KEY,
+                date    TEXT    NOT NULL,
+                author  TEXT    NOT NULL,
+                content TEXT    NOT NULL,
+                segment INTEGER NOT NULL,
+                row     INTEGER NOT NULL
+            )
+        ''')
+        self.database.execute("CREATE TABLE IF NOT EXISTS tombstones (segment INTEGER NOT NULL, row INTEGER NOT NULL, PRIMARY KEY (segment, row)) WITHOUT ROWID")
+        self.database.commit()
+
+        # Every committed row is either a message or a tombstone. Rows after them were appended by an insert that never committed
+        committed = dict(self.database.execute("SELECT segment, MAX(row) + 1 FROM (SELECT segment, row FROM messages UNION ALL SELECT segment, row FROM tombstones) GROUP BY segment"))
+        numbers = sorted(int(name.split('.')[0]) for name in os.listdir(directory) if name.endswith(".ids"))
+        self.segments   = [_Segment(directory, number) for number in numbers] or [_Segment(directory, 0)]
+        for segment in self.segments:
+            if segment.truncate(committed.get(segment.number, 0)): debug.log(ly, f"[*] LOCAL VECTOR STORE - Rows of an unfinished insert were cut from {segment.path}")
+        self.removed    = None      # segment number -> bool[], rows that were removed
+        self.ivf        = None      # { "centroids": float[][], "lists": int[][], "offsets": int[], "rows": int }
+        self.dirty      = set()     # Segments appended into since the last flush
+
+    def removed_mask(self, segment):
+        if self.removed is None:
+            self.removed = {}
+            for number, row in self.database.execute("SELECT segment, row FROM tombstones"):
+                self.removed.setdefault(number, set()).add(row)
+        mask = np.zeros(segment.rows, dtype=bool)
+        rows = self.removed.get(segment.number)
+        if rows: mask[list(rows)] = True
+        return mask
+
+    def remove_rows(self, rows):
+        '''
+        Mark `( segment, row )` pairs as removed.
+        '''
+        self.database.executemany("INSERT OR IGNORE INTO tombstones (segment, row) VALUES (?, ?)", rows)
+        self.removed = None
+
+    def offsets(self):
+        '''
+        Returns the first global row of each segment, followed by the total amount of rows.
+        '''
+        return np.cumsum([0] + [segment.rows for segment in self.segments])
+
+    def count(self):
+        return self.database.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+
+
+def _path(channel_id):
+    return os.path.join(_directory, str(channel_id))
+
+
+def _get(channel_id, create=False):
+    '''
+    Returns the opened `_Channel`, or `None` if the channel has no memory and `create` is `False`.
+    '''
+    channel_id = str(channel_id)
+    if channel_id not in _channels:
+        if not os.path.isdir(_path(channel_id)):
+            if not create: return None
+            os.makedirs(_path(channel_id))
+        _channels[channel_id] = _Channel(_path(channel_id))
+    return _channels[channel_id]
+
+
+def start(name, dim):
+    '''
+    Open the collection `name` for embeddings of `dim` dimensions, creating it if it is new.
+    '''
+    global _directory, _dim
+    with _lock:
+        _directory = os.path.join(STORE_DIRECTORY, name)
+        _dim       = dim
+        os.makedirs(_directory, exist_ok=True)
+    debug.log(lg, f"[#] LOCAL VECTOR STORE - Store opened with {len(list_channels())} channels")
+
+
+def stop():
+    '''
+    Flush and close every channel.
+    '''
+    with _lock:
+        flush()
+        for channel in _channels.values(): channel.database.close()
+        _channels.clear()
+    debug.log(lg, "[#] LOCAL VECTOR STORE - Store closed")
+
+
+def is_available():
+    '''
+    The store is inside this process, so it is always available.
+    '''
+    return True
+
+
+def create_channel_memory_if_new(channel_id):
+    with _lock:
+        if os.path.isdir(_path(channel_id)): return False
+        _get(channel_id, create=True)
+        return True
+
+
+def remove_channel_memory_if_exist(channel_id):
+    with _lock:
+        channel = _channels.pop(str(channel_id), None)
+        if channel is not None: channel.database.close()
+        if not os.path.isdir(_path(channel_id)): return False
+        shutil.rmtree(_path(channel_id))
+        return True
+
+
+def insert(channel_id, entries):
+    '''
+    Append messages into a channel's memory. A message whose id is already inside memory replaces the old one.
+
+    PARAMETERS
+    ----------
+    `entries` : `list[]`
+        Columns `id`, `date`, `author`, `content`, and `embedding`, in the same format Milvus inserts
+
+    RETURN
+    ------
+    Returns the amount of added messages.
+    '''
+    ids, dates, authors, contents, embeddings = entries
+    if len(ids) == 0: return 0
+    ids     = np.asarray(ids, dtype=np.int64)
+    vectors = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), _dim)
+
+    # An id given more than once inside the batch is only appended once, the last time it is given
+    _, last = np.unique(ids[::-1], return_index=True)
+    if len(last) < len(ids):
+        keep     = np.sort(len(ids) - 1 - last)
+        ids      = ids[keep]
+        vectors  = vectors[keep]
+        dates    = [dates[i]    for i in keep]
+        authors  = [authors[i]  for i in keep]
+        contents = [contents[i] for i in keep]
+
+    with _lock:
+        channel = _get(channel_id, create=True)
+        replaced = []
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i+900].tolist()
+            replaced += channel.database.execute(f"SELECT segment, row FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        if len(replaced) > 0: channel.remove_rows(replaced)
+
+        start = 0
+        while start < len(ids):
+            segment = channel.segments[-1]
+            if segment.rows >= SEGMENT_MAX_ROWS:
+                segment = _Segment(channel.directory, segment.number + 1)
+                channel.segments.append(segment)
+            end   = min(len(ids), start + SEGMENT_MAX_ROWS - segment.rows)
+            first = segment.rows
+            segment.append(ids[start:end], vectors[start:end])
+            channel.database.executemany(
+                "INSERT OR REPLACE INTO messages (id, date, author, content, segment, row) VALUES (?, ?, ?, ?, ?, ?)",
+                [(int(ids[i]), dates[i], authors[i], contents[i], segment.number, first + i - start) for i in range(start, end)]
+            )
+            channel.dirty.add(segment.number)
+            start = end
+        channel.database.commit()
+    return len(ids)
+
+
+def existing_ids(channel_id, message_ids):
+    with _lock:
+        channel = _get(channel_id)
+        if channel is None or len(message_ids) == 0: return set()
+        found = set()
+        for i in range(0, len(message_ids), 900):
+            chunk = [int(id) for id in message_ids[i:i+900]]
+            found.update(id for id, in channel.database.execute(f"SELECT id FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk))
+        return found
+
+
+def get_neighbors(channel_id, message_ids, before, after, window):
+    '''
+    Same as `vectorDatabase.get_neighbors`, read from the ordered message database.
+    '''
+    delta = (window * 1000) << 22
+    neighbors = {}
+    with _lock:
+        channel = _get(channel_id)
+        for id in message_ids:
+            if channel is None or channel.database.execute("SELECT 1 FROM messages WHERE id = ?", (id,)).fetchone() is None:
+                neighbors[id] = []
+                continue
+            older = channel.database.execute("SELECT id, date, author, content FROM messages WHERE id < ? AND id >= ? ORDER BY id DESC LIMIT ?", (id, id - delta, before)).fetchall()
+            newer = channel.database.execute("SELECT id, date, author, content FROM messages WHERE id >= ? AND id <= ? ORDER BY id LIMIT ?", (id, id + delta, after + 1)).fetchall()
+            neighbors[id] = [{ "id": row[0], "date": row[1], "author": row[2], "content": row[3] } for row in [*reversed(older), *newer]]
+    return neighbors
+
+
+def get_embeddings(channel_id, limit=10000):
+    '''
+    Returns `( ids, embeddings )` of at most `limit` messages, the embeddings as a float32 matrix.
+    Segments without exact vectors give their quantized vectors.
+    '''
+    with _lock:
+        channel = _get(channel_id)
+        if channel is None: return [], np.empty((0, _dim), np.float32)
+        ids, vectors = [], []
+        for segment in channel.segments:
+            alive = np.flatnonzero(~channel.removed_mask(segment))[:limit - len(ids)]
+            ids.extend(segment.ids[alive].tolist())
+            vectors.append(np.asarray(segment.vectors[alive]) if segment.exact else segment.dequantize(alive))
+            if len(ids) >= limit: break
+        return ids, np.concatenate(vectors) if len(vectors) > 0 else np.empty((0, _dim), np.float32)
+
+
+def list_channels():
+    if not os.path.isdir(_directory): return []
+    return [int(name) for name in os.listdir(_directory) if name.isdigit()]
+
+
+def count_entities(channel_id=None):
+    with _lock:
+        if channel_id is not None:
+            channel = _get(channel_id)
+            return 0 if channel is None else channel.count()
+        return sum(_get(id).count() for id in list_channels())
+
+
+def drop_messages(channel_id, message_ids):
+    '''
+    Remove messages from a channel's memory. Their rows stay inside their segments, marked as removed.
+    '''
+    with _lock:
+        channel = _get(channel_id)
+        if channel is None: return 0
+        rows = []
+        for i in range(0, len(message_ids), 900):
+            chunk = [int(id) for id in message_ids[i:i+900]]
+            rows += channel.database.execute(f"SELECT segment, row FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            channel.database.execute(f"DELETE FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        channel.remove_rows(rows)
+        channel.database.commit()
+        return len(rows)
+
+
+def _kmeans(vectors, clusters, iterations=IVF_ITERATIONS, seed=0):
+    '''
+    Returns `( centroids, assignment of every vector )`.
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=clusters, replace=False)].copy()
+    norms = np.einsum('ij,ij->i', vectors, vectors)
+    for _ in range(iterations):
+        distances  = norms[:, None] - 2 * vectors @ centroids.T + np.einsum('ij,ij->i', centroids, centroids)[None, :]
+        assignment = distances.argmin(axis=1)
+        for cluster in range(clusters):
+            members = vectors[assignment == cluster]
+            if len(members) > 0: centroids[cluster] = members.mean(axis=0)
+    return centroids, assignment
+
+
+def create_index(index):
+    '''
+    Cluster every channel with at least `IVF_MIN_ROWS` rows into `nlist` clusters, one channel at a time.
+    Every index type is served by the same clustering. Quantization is chosen by `QUANTIZATION` instead.
+    '''
+    global _index
+    nlist = index.get("params", {}).get("nlist", 128)
+    with _lock: channel_ids = list_channels()
+
+    for channel_id in channel_ids:
+        # Only copying the vectors holds the lock. Clustering them doesn't, so inserts and searches keep running.
+        # Rows are only ever appended, so rows inserted meanwhile are simply searched as unclustered rows
+        with _lock:
+            channel = _get(channel_id)
+            if channel is None: continue
+            rows = int(channel.offsets()[-1])
+            if rows < IVF_MIN_ROWS:
+                channel.ivf = None
+                continue
+            vectors = np.concatenate([segment.dequantize(slice(0, segment.rows)) for segment in channel.segments])
+
+        clusters = min(nlist, int(rows ** 0.5))
+        centroids, assignment = _kmeans(vectors, clusters)
+        order = np.argsort(assignment, kind='stable')
+        starts = np.searchsorted(assignment[order], np.arange(clusters + 1))
+        ivf = {
+            "centroids" : centroids,
+            "lists"     : [order[starts[i]:starts[i + 1]] for i in range(clusters)],
+            "rows"      : rows
+        }
+
+        with _lock:
+            # The channel might have been removed, or removed and created again, while it was clustered
+            if _channels.get(str(channel_id)) is channel: channel.ivf = ivf
+
+    with _lock: _index = index
+    return True
+
+
+def get_index():
+    return _index
+
+
+def _scores(vectors, norms, queries, metric):
+    '''
+    Returns a score for every query and vector, larger is nearer.
+    '''
+    scores = queries @ vectors.T
+    if metric == "L2": scores = 2 * scores - norms[None, :]
+    return scores
+
+
+def _rerank(segments, offsets, query, scores, rows, candidates, metric):
+    '''
+    Keep the `candidates` best rows, and replace the scores of quantized rows with the scores of their exact vectors.
+
+    RETURN
+    ------
+    Returns `( scores, rows )` of the kept rows.
+    '''
+    k      = min(candidates, len(scores))
+    best   = np.argpartition(-scores, k - 1)[:k]
+    scores = scores[best]
+    rows   = rows[best]
+
+    in_segments = np.searchsorted(offsets, rows, side='right') - 1
+    for s in np.unique(in_segments):
+        segment = segments[s]
+        if segment.quantization is None or not segment.exact: continue
+        pick  = (in_segments == s) & np.isfinite(scores)
+        exact = np.asarray(segment.vectors[rows[pick] - offsets[s]])
+        scores[pick] = _scores(exact, np.einsum('ij,ij->i', exact, exact), query[None, :], metric)[0]
+    return scores, rows
+
+
+def search(channel_id, vectors, limit, param, expr=None):
+    '''
+    Find the `limit` nearest messages of each vector inside a channel's memory.
+
+    Quantized segments are compared in their own format, and the best candidates are reranked with their exact vectors.
+
+    PARAMETERS
+    ----------
+    `param` : `dict`
+        Search parameters, given by `vectorDatabase.search_params`. Only `metric_type` and `nprobe` are used
+
+    `expr` : `None`
+        Expressions are not supported, and raise `ValueError`
+
+    RETURN
+    ------
+    Returns a list containing the hits of each vector, nearest first.
+    '''
+    if expr is not None: raise ValueError("the local vector store does not support expressions")
+    metric  = param["metric_type"]
+    nprobe  = param["params"].get("nprobe")
+    queries = np.asarray(vectors, dtype=np.float32).reshape(-1, _dim)
+    query_norms = np.einsum('ij,ij->i', queries, queries)
+
+    # Only taking a view of the channel holds the lock. Scanning it doesn't, so other channels and inserts keep running
+    with _lock:
+        channel = _get(channel_id)
+        if channel is None: return [[] for _ in queries]
+        segments = [segment.view(channel.removed_mask(segment)) for segment in channel.segments]
+        ivf      = channel.ivf
+
+    offsets = np.cumsum([0] + [segment.rows for segment in segments])
+    # Every candidate is a global row: rows of all segments one after another
+    candidates_scores = [[] for _ in queries]
+    candidates_rows   = [[] for _ in queries]
+
+    first_unclustered = 0
+    if ivf is not None:
+        first_unclustered = ivf["rows"]
+        centroids = ivf["centroids"]
+        probes = np.argsort(-_scores(centroids, np.einsum('ij,ij->i', centroids, centroids), queries, "L2"), axis=1)[:, :nprobe or 10]
+        for q, clusters in enumerate(probes):
+            rows = np.concatenate([ivf["lists"][cluster] for cluster in clusters])
+            for s, segment in enumerate(segments):
+                in_segment = rows[(rows >= offsets[s]) & (rows < offsets[s + 1])]
+                if len(in_segment) == 0: continue
+                local = in_segment - offsets[s]
+                scores = _scores(segment.dequantize(local), segment.norms[local], queries[q:q+1], metric)[0]
+                scores[segment.removed[local]] = -np.inf
+                candidates_scores[q].append(scores)
+                candidates_rows[q].append(in_segment)
+
+    # Rows added after clustering, or every row if the channel isn't clustered
+    for s, segment in enumerate(segments):
+        if offsets[s + 1] <= first_unclustered: continue
+        for start in range(max(0, first_unclustered - offsets[s]), segment.rows, SCAN_CHUNK_ROWS):
+            end    = min(segment.rows, start + SCAN_CHUNK_ROWS)
+            scores = _scores(segment.dequantize(slice(start, end)), segment.norms[start:end], queries, metric)
+            scores[:, segment.removed[start:end]] = -np.inf
+            for q in range(len(queries)):
+                candidates_scores[q].append(scores[q])
+                candidates_rows[q].append(np.arange(start, end) + offsets[s])
+
+    rerank = any(segment.quantization is not None and segment.exact for segment in segments)
+
+    result = []
+    for q in range(len(queries)):
+        if len(candidates_scores[q]) == 0:
+            result.append([])
+            continue
+        scores = np.concatenate(candidates_scores[q])
+        rows   = np.concatenate(candidates_rows[q])
+        if rerank: scores, rows = _rerank(segments, offsets, queries[q], scores, rows, limit * RERANK_FACTOR, metric)
+        k      = min(limit, len(scores))
+        best   = np.argpartition(-scores, k - 1)[:k]
+        best   = best[np.argsort(-scores[best])]
+        best   = best[np.isfinite(scores[best])]
+
+        hits = []
+        for row, score in zip(rows[best], scores[best]):
+            s  = int(np.searchsorted(offsets, row, side='right') - 1)
+            id = int(segments[s].ids[row - offsets[s]])
+            hits.append((id, float(query_norms[q] - score) if metric == "L2" else float(score)))
+        result.append(hits)
+
+    # Message fields of every hit, read at once.
+    # Messages removed while scanning, or a channel removed meanwhile, have no fields and are left out
+    ids = list({ id for hits in result for id, _ in hits })
+    entities = {}
+    with _lock:
+        if _channels.get(str(channel_id)) is not channel: return [[] for _ in queries]
+        for i in range(0, len(ids), 900):
+            chunk = ids[i:i+900]
+            for id, date, author, content in channel.database.execute(f"SELECT id, date, author, content FROM messages WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                entities[id] = { "date": date, "author": author, "content": content }
+    return [[Hit(id, distance, entities[id]) for id, distance in hits if id in entities] for hits in result]
+
+
+def flush():
+    '''
+    Make sure every appended row is written onto disk.
+
+    RETURN
+    ------
+    Returns the amount of synced segments.
+    '''
+    with _lock:
+        synced = 0
+        for channel in _channels.values():
+            for segment in channel.segments:
+                if segment.number not in channel.dirty: continue
+                segment.sync()
+                synced += 1
+            channel.dirty.clear()
+        return synced
+
+
+def get_segment_stats():
+    '''
+    Returns `( segments, rows of each segment )` of every channel.
+    '''
+    with _lock:
+        rows = [segment.rows for channel_id in list_channels() for segment in _get(channel_id).segments]
+        return len(rows), rows
+
+
+def drop_all():
+    '''
+    Remove every channel's memory inside the opened collection.
+    '''
+    global _index
+    with _lock:
+        for channel in _channels.values(): channel.database.close()
+        _channels.clear()
+        _index = None
+        if os.path.isdir(_directory): shutil.rmtree(_directory)
+
+
+def release_idle_partitions(release_all=False):
+    '''
+    Segments are memory-mapped, so nothing is kept loaded. Returns `0`.
+    '''
+    return 0
+
+
+def get_partition_stats():
+    '''
+    Segments are memory-mapped, so nothing is kept loaded. Returns `None`.
+    '''
+    return None
+
+
+def get_connection_stats():
+    '''
+    The store has no connections. Returns `None`.
+    '''
+    return None
@@ -0,0 +1,318 @@
+'''
+MEMORY SPOOL
+============
+
+Durable queue of messages waiting to be saved into long-term memory.
+
+Messages trimmed out of short-term memory are written into the spool first,
+so that replying never has to wait for embedding them or for Milvus to insert them.
+A background worker (see `ai.start_spooler`) takes messages out of the spool in large batches, across all channels,
+and only removes them from the spool once they are inside long-term memory.
+
+The spool is an SQLite database, by default `memory-spool.sqlite3`, so spooled messages survive a crash or restart.
+Messages that failed to save are tried again later, after a delay that grows with every failed attempt.
+Messages that can never be saved, or that keep failing, are moved into quarantine,
+where they are kept for inspection instead of failing every batch they are in.
+
+FUNCTIONS
+---------
+put
+
+take
+
+ack
+
+retry_later
+
+quarantine
+
+quarantined
+
+remove_channel
+
+spooled_ids
+
+pending
+
+get_stats
+
+stop
+'''
+
+import sqlite3, json, threading, time
+import debug
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+SPOOL_PATH = "memory-spool.sqlite3"
+
+_connection = None
+_lock       = threading.Lock()
+_stats      = {
+    "spooled"       : 0,
+    "saved"         : 0,
+    "retried"       : 0,
+    "quarantined"   : 0
+}
+
+
+def _connect():
+    '''
+    Open the spool database if it isn't open already.
+    '''
+    global _connection
+
+    if _connection is not None: return
+    _connection = sqlite3.connect(SPOOL_PATH, check_same_thread=False)
+    _connection.execute("PRAGMA journal_mode=WAL")
+    _connection.execute("PRAGMA synchronous=NORMAL")
+    _connection.execute('''
+        CREATE TABLE IF NOT EXISTS spool (
+            channel_id  INTEGER NOT NULL,
+            message_id  INTEGER NOT NULL,
+            message     TEXT    NOT NULL,
+            attempts    INTEGER NOT NULL DEFAULT 0,
+            next_try    REAL    NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+    _connection.execute("CREATE INDEX IF NOT EXISTS spool_next_try ON spool (next_try)")
+    _connection.execute('''
+        CREATE TABLE IF NOT EXISTS quarantine (
+            channel_id      INTEGER NOT NULL,
+            message_id      INTEGER NOT NULL,
+            message         TEXT    NOT NULL,
+            reason          TEXT    NOT NULL,
+            quarantined_at  REAL    NOT NULL,
+            PRIMARY KEY (channel_id, message_id)
+        ) WITHOUT ROWID
+    ''')
+    _connection.commit()
+    amount = _connection.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+    debug.log(lg, f"[#] MEMORY SPOOL - Spool opened with {amount} waiting message{'' if amount == 1 else 's'}")
+
+
+def put(channel_id, messages):
+    '''
+    Spool messages of a channel so that they get saved into long-term memory.
+
+    Spooling a message that is already in the spool replaces it, so spooling the same messages twice is harmless.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel identifier
+
+    `messages` : `dict[]`
+        Messages in the format used by `vectorDatabase.add_messages`, without the `embedding` field
+
+    RETURN
+    ------
+    Returns `True` if the messages were spooled, `False` if writing into the spool failed.
+    '''
+    if len(messages) == 0: return True
+    now  = time.time()
+    rows = [(channel_id, message["id"], json.dumps(message, ensure_ascii=False, default=str), now) for message in messages]
+
+    with _lock:
+        try:
+            _connect()
+            _connection.executemany("INSERT OR REPLACE INTO spool (channel_id, message_id, message, attempts, next_try) VALUES (?, ?, ?, 0, ?)", rows)
+            _connection.commit()
+            _stats["spooled"] += len(rows)
+            return True
+        except Exception as e:
+            debug.log(lr,  "[!] MEMORY SPOOL - Failed to spool messages")
+            debug.log(lb, f"                   exception: {e}"        )
+            try: _connection.rollback()
+            except Exception: pass
+            return False
+
+
+def take(limit):
+    '''
+    Get spooled messages that are ready to be saved, oldest first.
+
+    Messages stay in the spool until they are acknowledged with `ack` or delayed with `retry_later`.
+
+    RETURN
+    ------
+    Returns a list of at most `limit` tuples `( channel_id, message, attempts )`.
+    '''
+    with _lock:
+        try:
+            _connect()
+            rows = _connection.execute(
+                "SELECT channel_id, message, attempts FROM spool WHERE next_try <= ? ORDER BY next_try, channel_id, message_id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+        except Exception as e:
+            debug.log(ly,  "[*] MEMORY SPOOL - Failed to read spool")
+            debug.log(lb, f"                   exception: {e}"     )
+            return []
+    return [(channel_id, json.loads(message), attempts) for channel_id, message, attempts in rows]
+
+
+def ack(channel_id, message_ids):
+    '''
+    Remove messages that were saved into long-term memory from the spool.
+    '''
+    if len(message_ids) == 0: return
+    with _lock:
+        try:
+            _connect()
+            _connection.executemany("DELETE FROM spool WHERE channel_id = ? AND message_id = ?", [(channel_id, id) for id in message_ids])
+            _connection.commit()
+            _stats["saved"] += len(message_ids)
+        except Exception as e:
+            debug.log(ly,  "[*] MEMORY SPOOL - Failed to remove saved messages from spool. They will be saved again")
+            debug.log(lb, f"                   exception: {e}")
+
+
+def retry_later(channel_id, message_ids, delay):
+    '''
+    Count a failed attempt for messages and try them again after `delay` seconds.
+    '''
+    if len(message_ids) == 0: return
+    with _lock:
+        try:
+            _connect()
+            _connection.executemany(
+                "UPDATE spool SET attempts = attempts + 1, next_try = ? WHERE channel_id = ? AND message_id = ?",
+                [(time.time() + delay, channel_id, id) for id in message_ids]
+            )
+            _connection.commit()
+            _stats["retried"] += len(message_ids)
+        except Exception as e:
+            debug.log(ly,  "[*] MEMORY SPOOL - Failed to delay messages. They will be tried again right away")
+            debug.log(lb, f"                   exception: {e}")
+
+
+def quarantine(channel_id, messages, reason):
+    '''
+    Move messages of a channel out of the spool and into quarantine, so that they are never tried again.
+
+    PARAMETERS
+    ----------
+    `messages` : `dict[]`
+        The spooled messages
+
+    `reason` : `str`
+        Why the messages were quarantined
+    '''
+    if len(messages) == 0: return
+    now  = time.time()
+    rows = [(channel_id, message["id"], json.dumps({ key: value for key, value in message.items() if key != "embedding" }, ensure_ascii=False, default=str), reason, now) for message in messages]
+
+    with _lock:
+        try:
+            _connect()
+            _connection.executemany("INSERT OR REPLACE INTO quarantine (channel_id, message_id, message, reason, quarantined_at) VALUES (?, ?, ?, ?, ?)", rows)
+            _connection.executemany("DELETE FROM spool WHERE channel_id = ? AND message_id = ?", [(channel_id, message["id"]) for message in messages])
+            _connection.commit()
+            _stats["quarantined"] += len(rows)
+        except Exception as e:
+            debug.log(ly,  "[*] MEMORY SPOOL - Failed to quarantine messages. They stay inside the spool")
+            debug.log(lb, f"                   exception: {e}")
+            try: _connection.rollback()
+            except Exception: pass
+            return
+    debug.log(ly, f"[*] MEMORY SPOOL - Quarantined {len(rows)} message{'' if len(rows) == 1 else 's'} of channel {channel_id}: {reason}")
+
+
+def quarantined(channel_id=None):
+    '''
+    Get quarantined messages, either of one channel or of all of them.
+
+    RETURN
+    ------
+    Returns a list of tuples `( channel_id, message, reason )`, oldest quarantined first.
+    '''
+    with _lock:
+        _connect()
+        if channel_id is None: rows = _connection.execute("SELECT channel_id, message, reason FROM quarantine ORDER BY quarantined_at").fetchall()
+        else: rows = _connection.execute("SELECT channel_id, message, reason FROM quarantine WHERE channel_id = ? ORDER BY quarantined_at", (channel_id,)).fetchall()
+    return [(channel_id, json.loads(message), reason) for channel_id, message, reason in rows]
+
+
+def remove_channel(channel_id):
+    '''
+    Forget every spooled and quarantined message of a channel.
+    '''
+    with _lock:
+        try:
+            _connect()
+            _connection.execute("DELETE FROM spool WHERE channel_id = ?", (channel_id,))
+            _connection.execute("DELETE FROM quarantine WHERE channel_id = ?", (channel_id,))
+            _connection.commit()
+        except Exception as e:
+            debug.log(ly,  "[*] MEMORY SPOOL - Failed to remove channel from spool")
+            debug.log(lb, f"                   exception: {e}")
+
+
+def spooled_ids(channel_id, message_ids):
+    '''
+    Returns which of the given message ids of a channel are waiting inside the spool, as a `set`.
+    '''
+    found = set()
+    with _lock:
+        _connect()
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i+500]
+            rows = _connection.execute(
+                f"SELECT message_id FROM spool WHERE channel_id = ? AND message_id IN ({','.join('?' * len(chunk))})",
+                [channel_id, *chunk]
+            ).fetchall()
+            found.update(id for id, in rows)
+    return found
+
+
+def pending(channel_id=None):
+    '''
+    Returns how many messages are waiting inside the spool, either for one channel or for all of them.
+    '''
+    with _lock:
+        _connect()
+        if channel_id is None: return _connection.execute("SELECT COUNT(*) FROM spool").fetchone()[0]
+        return _connection.execute("SELECT COUNT(*) FROM spool WHERE channel_id = ?", (channel_id,)).fetchone()[0]
+
+
+def get_stats():
+    '''
+    Get information about the spool.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `spooled`, `saved`, `retried`, `quarantined`, and `pending`:
+
+    `spooled` : `int`
+        Messages written into the spool since start
+    `saved` : `int`
+        Messages removed from the spool after being saved into long-term memory
+    `retried` : `int`
+        Failed attempts to save a message
+    `quarantined` : `int`
+        Messages moved into quarantine since start
+    `pending` : `int`
+        Messages currently waiting inside the spool
+    '''
+    amount = pending()
+    with _lock:
+        return { **_stats, "pending": amount }
+
+
+def stop():
+    '''
+    Close the spool database. Messages left inside the spool are saved after the next start.
+    '''
+    global _connection
+    with _lock:
+        if _connection is None: return
+        _connection.close()
+        _connection = None
+        debug.log(lg, "[#] MEMORY SPOOL - Spool closed")
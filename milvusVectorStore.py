@@ -0,0 +1,778 @@
+'''
+MILVUS VECTOR STORE
+===================
+
+Milvus backend of `vectorDatabase`, used unless it is started with `backend="local"`.
+
+All memory is saved inside a single collection, by default `discord_selfbot_memory`,
+and every channel's memory is a partition of it.
+
+Partitions stay loaded after a search, so that following searches in the same channel don't pay for a full load from storage.
+Partitions that have been idle longer than `PARTITION_TTL` are released,
+and least recently used partitions are released while the estimated memory of all loaded partitions exceeds `PARTITION_MAX_MEMORY_BYTES`.
+
+Calls that can run at the same time (inserts, searches and queries) each take a connection from a small pool.
+When a call fails and a liveness probe finds Milvus unreachable, the circuit breaker opens:
+calls fail right away instead of waiting on a dead server, `is_available` returns `False`,
+and a background thread reconnects with backoff until Milvus answers again.
+
+While a new index is built, inserts and removals keep working, but searches and queries fail right away with `IndexRebuilding`,
+so that responses use short-term memory only instead of waiting for the build.
+
+With a quantized index (`IVF_SQ8`) searches find `RERANK_FACTOR` times more candidates,
+which are reordered by their exact vectors before the nearest ones are returned.
+
+NOTES
+-----
+Has the same functions as `localVectorStore`, which `vectorDatabase` calls without knowing which backend it is using.
+Functions raise when Milvus fails, and `vectorDatabase` logs the failure.
+
+Requires Milvus 2.3 or newer running at `_HOST:_PORT`.
+
+CLASSES
+-------
+MilvusUnavailable
+
+IndexRebuilding
+
+FUNCTIONS
+---------
+start
+
+stop
+
+is_available
+
+create_channel_memory_if_new
+
+remove_channel_memory_if_exist
+
+insert
+
+existing_ids
+
+get_neighbors
+
+get_embeddings
+
+list_channels
+
+count_entities
+
+drop_messages
+
+create_index
+
+get_index
+
+search
+
+flush
+
+get_segment_stats
+
+drop_all
+
+release_idle_partitions
+
+get_partition_stats
+
+get_connection_stats
+'''
+
+from pymilvus import (
+    connections,
+    utility,
+    FieldSchema,
+    CollectionSchema,
+    DataType,
+    Collection,
+    Partition
+)
+import time, threading, json, bisect, queue
+import numpy as np
+from collections import OrderedDict
+import debug, localVectorStore
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+_HOST = 'localhost'
+_PORT = '19530'
+
+CONNECTION_POOL_SIZE    = 6         # Connections for calls running at the same time, the first one being "default"
+CONNECT_TIMEOUT         = 5         # Seconds to wait for a connection
+CALL_TIMEOUT            = 10        # Seconds a single insert, search, or query may take
+PROBE_TIMEOUT           = 2         # Seconds a liveness probe may take
+RECONNECT_DELAY         = 1         # Seconds before the first reconnect. Doubles after every failed reconnect
+RECONNECT_MAX_DELAY     = 60
+
+_MAX_DATE_LENGTH    = 26
+_MAX_AUTHOR_LENGTH  = 40
+_MAX_MESSAGE_LENGTH = 2500
+
+PARALLEL_INSERTS    = True                      # Batches of one insert may be sent at the same time
+
+QUANTIZED_INDEXES   = ("IVF_SQ8", "IVF_PQ")     # Indexes comparing approximate vectors, whose hits are reranked
+RERANK_FACTOR       = 4                         # Candidates reranked with the exact vectors, times the amount of wanted hits
+
+PARTITION_TTL               = 15 * 60               # Seconds a partition may stay loaded without being searched
+PARTITION_MAX_MEMORY_BYTES  = 2 * 1024 ** 3         # Estimated memory budget for all loaded partitions
+_BYTES_PER_SCALARS          = 3000                  # Rough estimate of the scalar fields of an entity, added to its float32 vector
+
+_collection_name    = None
+_dim                = None
+memory_collection   = None      # The entire collection object for the bot's memory
+_index              = None      # Parameters of the current index, read from Milvus on first use
+
+_loaded_partitions = OrderedDict()  # channel_id (str) -> { "last_used": float, "bytes": int }, least recently used first
+_partition_lock    = threading.Lock()
+_loads_running     = 0              # Partition loads in progress, which an index rebuild waits for before releasing the collection
+_loads_done        = threading.Condition(_partition_lock)
+_rebuilding        = False          # While a new index is built, partitions aren't loaded and searches fail right away
+_partition_stats   = {
+    "hits"      : 0,
+    "misses"    : 0,
+    "releases"  : 0
+}
+
+_pool           = None      # queue.Queue of ( alias, collection ), a collection object for every pooled connection
+_breaker_lock   = threading.Lock()
+_breaker        = {
+    "state"         : "closed",     # "closed": calls go to Milvus. "open": calls fail right away while reconnecting
+    "openedAt"      : None,
+    "opened"        : 0,            # Times Milvus was found unreachable
+    "reconnects"    : 0,            # Failed reconnects since the breaker opened
+    "rejected"      : 0             # Calls failed right away while the breaker was open
+}
+_reconnector    = None      # Thread reconnecting while the breaker is open
+_reconnect_stop = threading.Event()
+
+
+class MilvusUnavailable(Exception):
+    '''
+    Raised instead of calling Milvus while it is unreachable.
+    '''
+
+
+class IndexRebuilding(Exception):
+    '''
+    Raised instead of loading a partition while a new index is being built.
+    '''
+
+
+def start(name, dim):
+    '''
+    Connect to Milvus, and get the collection `name`, creating it for embeddings of `dim` dimensions if it is new.
+
+    FAILURE
+    -------
+    `[!]` : connecting to Milvus fails
+
+    `[!]` : Could not get collection
+
+    Both raise the exception again.
+    '''
+    global memory_collection, _collection_name, _dim, _index
+
+    _collection_name = name
+    _dim             = dim
+    _index           = None
+
+    try: connections.connect("default", host=_HOST, port=_PORT, timeout=CONNECT_TIMEOUT)
+    except Exception as e:
+        debug.log(lr, f"[!] MILVUS VECTOR STORE - Could not connect to database")
+        debug.log(lb, f"                          exception: {e}",              )
+        raise
+
+    try:
+        if not utility.has_collection(_collection_name):
+            fields = [
+                # REMEBER TO UPDATE SCHEMA SIZE AND THE STUFF THAT DEPENDS ON IT!
+                FieldSchema(name="id",        dtype=DataType.INT64,         is_primary=True,                description="Primary Message ID"),
+                FieldSchema(name="date",      dtype=DataType.VARCHAR,       max_length=_MAX_DATE_LENGTH,    description="Date"),
+                FieldSchema(name="author",    dtype=DataType.VARCHAR,       max_length=_MAX_AUTHOR_LENGTH,  description="Author"),
+                FieldSchema(name="content",   dtype=DataType.VARCHAR,       max_length=_MAX_MESSAGE_LENGTH, description="Actual Message"),
+                FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR,  dim=_dim,                       description="Vector")
+            ]
+            schema = CollectionSchema(fields, "My Discord selfbot's entire long-term memory.", auto_id=False)
+            memory_collection = Collection(_collection_name, schema)
+            debug.log(lg, "[#] MILVUS VECTOR STORE - New collection created")
+        else:
+            memory_collection = Collection(_collection_name)
+            debug.log(lg, "[#] MILVUS VECTOR STORE - Collection loaded")
+        _connect_pool()
+        with _breaker_lock: _breaker["state"] = "closed"
+    except Exception as e:
+        debug.log(lr,  "[!] MILVUS VECTOR STORE - Could not get collection while startup")
+        debug.log(lb, f"                          exception: {e}",                       )
+        raise
+
+
+def stop():
+    '''
+    Release every loaded partition, stop reconnecting, and disconnect.
+    '''
+    _reconnect_stop.set()
+    release_idle_partitions(release_all=True)
+    for alias in _aliases():
+        try: connections.disconnect(alias)
+        except Exception: pass
+    debug.log(lg, "[#] MILVUS VECTOR STORE - Collection disconnected")
+
+
+def is_available():
+    '''
+    Returns `False` while Milvus has been found unreachable and is being reconnected to. Never waits for Milvus.
+    '''
+    return _breaker["state"] == "closed"
+
+
+def get_connection_stats():
+    '''
+    Get information about the connection pool and the circuit breaker.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `state`, `openedAt`, `opened`, `reconnects`, `rejected`, `poolSize`, and `idle`:
+
+    `state` : `str`
+        `closed` while Milvus is reachable, `open` while reconnecting
+    `openedAt` : `None || float`
+        When Milvus was last found unreachable
+    `opened` : `int`
+        Times Milvus was found unreachable since start
+    `reconnects` : `int`
+        Failed reconnects since Milvus was last found unreachable
+    `rejected` : `int`
+        Calls failed right away, without calling Milvus
+    `poolSize` : `int`
+        Pooled connections
+    `idle` : `int`
+        Pooled connections not in use right now
+    '''
+    with _breaker_lock:
+        return { **_breaker, "poolSize": CONNECTION_POOL_SIZE, "idle": 0 if _pool is None else _pool.qsize() }
+
+
+def _aliases():
+    return ["default", *[f"memory-{i}" for i in range(1, CONNECTION_POOL_SIZE)]]
+
+
+def _connect_pool():
+    '''
+    Connect every pooled connection, and get the collection through each of them.
+    Connections that are already connected are connected again.
+    '''
+    global memory_collection, _pool
+
+    pool = queue.Queue()
+    for alias in _aliases():
+        try: connections.disconnect(alias)
+        except Exception: pass
+        connections.connect(alias, host=_HOST, port=_PORT, timeout=CONNECT_TIMEOUT)
+        collection = Collection(_collection_name, using=alias)
+        if alias == "default": memory_collection = collection
+        pool.put((alias, collection))
+    _pool = pool
+
+
+def _probe(alias="default"):
+    '''
+    Liveness probe. Returns `True` if Milvus answers through a connection within `PROBE_TIMEOUT` seconds.
+    '''
+    try:
+        utility.get_server_version(using=alias, timeout=PROBE_TIMEOUT)
+        return True
+    except Exception:
+        return False
+
+
+def _milvus(operation):
+    '''
+    Run `operation(collection)` with a collection from the connection pool, so that several calls can run at the same time.
+
+    If the call fails and a liveness probe finds Milvus unreachable, the circuit breaker is opened.
+    While it is open, `MilvusUnavailable` is raised right away instead of calling Milvus.
+
+    RETURN
+    ------
+    Returns whatever `operation` returns. The exception of a failed call is raised again.
+    '''
+    if not is_available():
+        with _breaker_lock: _breaker["rejected"] += 1
+        raise MilvusUnavailable("Milvus is unreachable, reconnecting in the background")
+
+    pool = _pool
+    alias, collection = pool.get(timeout=CALL_TIMEOUT)
+    try:
+        return operation(collection)
+    except Exception as e:
+        if not isinstance(e, IndexRebuilding) and not _probe(alias): _open_breaker(e)
+        raise
+    finally:
+        pool.put((alias, collection))
+
+
+def _open_breaker(exception):
+    '''
+    Stop calling Milvus and start reconnecting in the background, if not done already.
+    '''
+    global _reconnector
+
+    with _breaker_lock:
+        if _breaker["state"] == "open": return
+        _breaker["state"]       = "open"
+        _breaker["openedAt"]    = time.time()
+        _breaker["opened"]     += 1
+        _breaker["reconnects"]  = 0
+        _reconnect_stop.clear()
+        _reconnector = threading.Thread(target=_reconnect, name="milvusVectorStore-reconnect", daemon=True)
+        _reconnector.start()
+    debug.log(lr,  "[!] MILVUS VECTOR STORE - Milvus is unreachable. Long-term memory is unavailable until it reconnects")
+    debug.log(lb, f"                          exception: {exception}")
+
+
+def _reconnect():
+    '''
+    Reconnect the connection pool with exponential backoff, until Milvus answers or the store is stopped.
+    '''
+    attempt = 0
+    while not _reconnect_stop.wait(min(RECONNECT_MAX_DELAY, RECONNECT_DELAY * 2 ** attempt)):
+        try:
+            _connect_pool()
+            reachable = _probe()
+        except Exception as e:
+            reachable = False
+            debug.log(lb, f"[-] MILVUS VECTOR STORE - Reconnect failed ( attempt, exception ): {attempt + 1} {type(e).__name__}")
+
+        if reachable:
+            # A restarted Milvus has no partitions loaded
+            with _partition_lock: _loaded_partitions.clear()
+            with _breaker_lock:
+                _breaker["state"] = "closed"
+                downtime = time.time() - _breaker["openedAt"]
+            debug.log(lg, f"[#] MILVUS VECTOR STORE - Reconnected to Milvus after {downtime:.0f}s")
+            return
+
+        attempt += 1
+        with _breaker_lock: _breaker["reconnects"] = attempt
+
+
+def create_channel_memory_if_new(channel_id):
+    def run(collection):
+        if collection.has_partition(str(channel_id), timeout=CALL_TIMEOUT): return False
+        collection.create_partition(str(channel_id), timeout=CALL_TIMEOUT)
+        return True
+
+    return _milvus(run)
+
+
+def remove_channel_memory_if_exist(channel_id):
+    if not _milvus(lambda collection: collection.has_partition(str(channel_id), timeout=CALL_TIMEOUT)): return False
+    _release_partition(str(channel_id))
+    _milvus(lambda collection: collection.drop_partition(str(channel_id), timeout=CALL_TIMEOUT))
+    return True
+
+
+def insert(channel_id, entries):
+    '''
+    Insert messages into a channel's memory.
+
+    PARAMETERS
+    ----------
+    `entries` : `list[]`
+        Columns `id`, `date`, `author`, `content`, and `embedding`
+
+    RETURN
+    ------
+    Returns the amount of inserted messages.
+    '''
+    _milvus(lambda collection: collection.insert(entries, partition_name=str(channel_id), timeout=CALL_TIMEOUT))
+    return len(entries[0])
+
+
+def existing_ids(channel_id, message_ids):
+    def run(collection):
+        if not collection.has_partition(str(channel_id)): return []
+        _load_partition(collection, str(channel_id))
+        return collection.query(
+            expr            = "id in " + str([int(id) for id in message_ids]),
+            output_fields   = ["id"],
+            partition_names = [str(channel_id)],
+            timeout         = CALL_TIMEOUT
+        )
+
+    return { row["id"] for row in _milvus(run) }
+
+
+def get_neighbors(channel_id, message_ids, before, after, window):
+    '''
+    Same as `vectorDatabase.get_neighbors`, with a single id range query for all messages.
+    '''
+    delta  = (window * 1000) << 22      # Snowflake ids keep the millisecond timestamp above their lowest 22 bits
+    ranges = " or ".join(f"(id >= {int(id) - delta} and id <= {int(id) + delta})" for id in message_ids)
+
+    def run(collection):
+        if not collection.has_partition(str(channel_id)): return []
+        _load_partition(collection, str(channel_id))
+        return collection.query(
+            expr            = ranges,
+            output_fields   = ["id", "date", "author", "content"],
+            partition_names = [str(channel_id)],
+            timeout         = CALL_TIMEOUT
+        )
+
+    res      = _milvus(run)
+    messages = sorted(({ key: row[key] for key in ("id", "date", "author", "content") } for row in res), key=lambda message: message["id"])
+    ids      = [message["id"] for message in messages]
+
+    neighbors = {}
+    for id in message_ids:
+        index = bisect.bisect_left(ids, id)
+        if index == len(ids) or ids[index] != id:
+            neighbors[id] = []
+            continue
+        # The ranges of all messages were queried together, so the window is checked again for this message
+        first = max(index - before, bisect.bisect_left(ids, id - delta))
+        last  = min(index + after + 1, bisect.bisect_right(ids, id + delta))
+        neighbors[id] = messages[first:last]
+    return neighbors
+
+
+def get_embeddings(channel_id, limit=10000):
+    '''
+    Returns `( ids, embeddings )` of at most `limit` messages, the embeddings as a float32 matrix.
+    '''
+    def run(collection):
+        if not collection.has_partition(str(channel_id)): return []
+        _load_partition(collection, str(channel_id))
+        return collection.query(
+            expr            = "id >= 0",
+            output_fields   = ["id", "embedding"],
+            partition_names = [str(channel_id)],
+            limit           = limit,
+            timeout         = CALL_TIMEOUT
+        )
+
+    res = _milvus(run)
+    return [row["id"] for row in res], np.asarray([row["embedding"] for row in res], dtype=np.float32).reshape(len(res), _dim)
+
+
+# `Collection.partitions` and `num_entities` take no timeout, so the connection handler of the pooled collection is called instead
+
+def list_channels():
+    names = _milvus(lambda collection: collection._get_connection().list_partitions(_collection_name, timeout=CALL_TIMEOUT))
+    return [int(name) for name in names if name.isdigit()]
+
+
+def count_entities(channel_id=None):
+    def run(collection):
+        connection = collection._get_connection()
+        if channel_id is None: return connection.get_collection_stats(_collection_name, timeout=CALL_TIMEOUT)
+        return connection.get_partition_stats(_collection_name, str(channel_id), timeout=CALL_TIMEOUT)
+
+    stats = { stat.key: stat.value for stat in _milvus(run) }
+    return int(stats["row_count"])
+
+
+def drop_messages(channel_id, message_ids):
+    '''
+    Remove messages from a channel's memory.
+
+    RETURN
+    ------
+    Returns the amount of removed messages.
+    '''
+    expr = "id in " + str([int(id) for id in message_ids])
+
+    def run(collection):
+        if not collection.has_partition(str(channel_id), timeout=CALL_TIMEOUT): return 0
+        return collection.delete(expr, partition_name=str(channel_id), timeout=CALL_TIMEOUT).delete_count
+
+    return _milvus(run)
+
+
+def create_index(index):
+    '''
+    Build `index` on the embeddings, replacing the current index.
+
+    Milvus allows a single index on a field, and only drops it from a released collection.
+    So the collection is released, its index dropped, and the new one built, which are done in place without copying any messages.
+    Meanwhile inserts and removals keep working, while searches and queries fail right away with `IndexRebuilding`.
+    Partitions are loaded again by the first search that needs them.
+
+    On failure the cached index is forgotten, so that it is read from Milvus again.
+    '''
+    global _index, _rebuilding
+
+    # Loads already started would fail, or keep the collection from being released
+    with _partition_lock:
+        _rebuilding = True
+        while _loads_running > 0: _loads_done.wait()
+        _loaded_partitions.clear()
+
+    def build(collection):
+        if collection.has_index(timeout=CALL_TIMEOUT):
+            collection.release(timeout=CALL_TIMEOUT)
+            collection.drop_index(timeout=CALL_TIMEOUT)
+        collection.create_index("embedding", index)
+
+    try:
+        _index = None
+        _milvus(build)
+        utility.wait_for_index_building_complete(_collection_name)
+        _index = index
+    except Exception:
+        _index = None
+        raise
+    finally:
+        with _partition_lock: _rebuilding = False
+    return True
+
+
+def get_index():
+    global _index
+
+    if _index is None:
+        def run(collection):
+            if not collection.has_index(timeout=CALL_TIMEOUT): return None
+            return dict(collection.index(timeout=CALL_TIMEOUT).params)
+
+        params = _milvus(run)
+        if params is None: return None
+        _index = {
+            "index_type"  : params["index_type"],
+            "metric_type" : params["metric_type"],
+            "params"      : params["params"] if type(params["params"]) == dict else json.loads(params["params"])
+        }
+    return _index
+
+
+def search(channel_id, vectors, limit, param, expr=None):
+    '''
+    Find the `limit` nearest messages of each vector inside a channel's memory.
+
+    PARAMETERS
+    ----------
+    `vectors` : `None || float32 matrix`
+
+    `param` : `dict`
+        Search parameters, given by `vectorDatabase.search_params`
+
+    `expr` : `None || str`
+        A boolean expression filtering the messages
+
+    RETURN
+    ------
+    Returns the result of the search in the format given by Milvus.
+    Reranked results are lists of hits with the same `id`, `distance`, and `entity`.
+    '''
+    index  = get_index()
+    rerank = vectors is not None and index is not None and index["index_type"] in QUANTIZED_INDEXES
+
+    search_param = {
+        "data"              :   None if vectors is None else list(vectors),
+        "anns_field"        :   "embedding",
+        "param"             :   param,
+        "limit"             :   limit * RERANK_FACTOR if rerank else limit,
+        "expr"              :   expr,
+        "partition_names"   :   [str(channel_id)],
+        "output_fields"     :   ["date", "author", "content"]
+    }
+
+    def run(collection):
+        _load_partition(collection, str(channel_id))
+        return collection.search(**search_param, timeout=CALL_TIMEOUT)
+
+    res = _milvus(run)
+    if rerank: res = _rerank(channel_id, vectors, res, limit, param["metric_type"])
+    return res
+
+
+def _rerank(channel_id, vectors, result, limit, metric):
+    '''
+    Reorder the hits of a quantized index by the exact distances of their vectors, keeping the `limit` nearest of each vector.
+
+    FAILURE
+    -------
+    `[*]` : Reading the exact vectors failed. The approximate order is kept
+
+    RETURN
+    ------
+    Returns a list containing the hits of each vector, nearest first.
+    '''
+    ids = list({ hit.id for hits in result for hit in hits })
+    try:
+        rows  = _milvus(lambda collection: collection.query(expr="id in " + str(ids), output_fields=["id", "embedding"], partition_names=[str(channel_id)], timeout=CALL_TIMEOUT)) if len(ids) > 0 else []
+        exact = { row["id"]: row["embedding"] for row in rows }
+    except Exception as e:
+        debug.log(ly,  "[*] MILVUS VECTOR STORE - Failed to rerank search, approximate order is used")
+        debug.log(lb, f"                          exception: {e}")
+        return [list(hits)[:limit] for hits in result]
+
+    reranked = []
+    for query, hits in zip(vectors, result):
+        hits = [hit for hit in hits if hit.id in exact]
+        if len(hits) == 0:
+            reranked.append([])
+            continue
+        matrix = np.asarray([exact[hit.id] for hit in hits], dtype=np.float32)
+        if metric == "L2":
+            distances = ((matrix - query) ** 2).sum(axis=1)
+            order     = np.argsort(distances)
+        else:
+            distances = matrix @ query
+            order     = np.argsort(-distances)
+        reranked.append([localVectorStore.Hit(hits[i].id, float(distances[i]), hits[i].entity) for i in order[:limit]])
+    return reranked
+
+
+def flush():
+    '''
+    Flush inserted messages, sealing the segments they were inserted into.
+    '''
+    _milvus(lambda collection: collection.flush(timeout=CALL_TIMEOUT))
+
+
+def get_segment_stats():
+    '''
+    Returns `( segments, rows of each segment )` of the loaded partitions.
+    '''
+    segments = utility.get_query_segment_info(_collection_name)
+    return len(segments), [segment.num_rows for segment in segments]
+
+
+def drop_all():
+    '''
+    Drop the entire collection.
+    '''
+    global _index
+
+    release_idle_partitions(release_all=True)
+    _index = None
+    if utility.has_collection(_collection_name): utility.drop_collection(_collection_name)
+
+
+def _load_partition(collection, partition_name):
+    '''
+    Make sure a channel's partition is loaded before it is searched, through the pooled `collection` of the call.
+
+    Partitions stay loaded after a search, so that following searches in the same channel don't pay for a full load from storage.
+    Partitions that have been idle longer than `PARTITION_TTL` are released,
+    and least recently used partitions are released while the estimated memory of all loaded partitions exceeds `PARTITION_MAX_MEMORY_BYTES`.
+
+    Loading is done without holding `_partition_lock`, so a slow load doesn't hold up searches of partitions that are already loaded.
+    '''
+    global _loads_running
+
+    with _partition_lock:
+        if _rebuilding: raise IndexRebuilding("A new index is being built, memory is searchable again once it is done")
+        if partition_name in _loaded_partitions:
+            _partition_stats["hits"] += 1
+            _loaded_partitions[partition_name]["last_used"] = time.time()
+            _loaded_partitions.move_to_end(partition_name)
+            return
+        _partition_stats["misses"] += 1
+        _loads_running += 1
+
+    try:
+        collection.load(partition_names=[partition_name], timeout=CALL_TIMEOUT)
+        entities = collection.query(expr="", output_fields=["count(*)"], partition_names=[partition_name], timeout=CALL_TIMEOUT)[0]["count(*)"]
+    except BaseException:
+        with _partition_lock:
+            _loads_running -= 1
+            _loads_done.notify_all()
+        raise
+
+    with _partition_lock:
+        _loads_running -= 1
+        _loads_done.notify_all()
+        _loaded_partitions[partition_name] = {
+            "last_used" : time.time(),
+            "bytes"     : entities * (_dim * 4 + _BYTES_PER_SCALARS)
+        }
+        _loaded_partitions.move_to_end(partition_name)
+
+    release_idle_partitions()
+
+
+def _release_partition(partition_name):
+    '''
+    Release a channel's partition if it is loaded.
+    '''
+    with _partition_lock:
+        if partition_name not in _loaded_partitions: return
+        del _loaded_partitions[partition_name]
+
+    try: Partition(memory_collection, partition_name).release(timeout=CALL_TIMEOUT)
+    except Exception as e:
+        debug.log(ly,  "[*] MILVUS VECTOR STORE - Failed to release partition")
+        debug.log(lb, f"                          exception: {e}",            )
+        return
+    with _partition_lock: _partition_stats["releases"] += 1
+
+
+def release_idle_partitions(release_all=False):
+    '''
+    Release loaded partitions that have been idle for too long, or that don't fit inside the memory budget.
+
+    The most recently used partition is never released because of the memory budget,
+    as it is most likely about to be searched.
+
+    PARAMETERS
+    ----------
+    `release_all` : `bool`
+        Release every loaded partition, no matter when it was used last
+
+    RETURN
+    ------
+    Returns the amount of released partitions.
+    '''
+    with _partition_lock:
+        now = time.time()
+        total_bytes = sum(info["bytes"] for info in _loaded_partitions.values())
+        to_release  = []
+
+        for partition_name, info in _loaded_partitions.items():
+            remaining = len(_loaded_partitions) - len(to_release)
+            if release_all \
+            or now - info["last_used"] > PARTITION_TTL \
+            or (total_bytes > PARTITION_MAX_MEMORY_BYTES and remaining > 1):
+                to_release.append(partition_name)
+                total_bytes -= info["bytes"]
+
+    for partition_name in to_release: _release_partition(partition_name)
+    if len(to_release) > 0: debug.log(lb, f"[-] MILVUS VECTOR STORE - Released {len(to_release)} idle partition{'' if len(to_release) == 1 else 's'}")
+    return len(to_release)
+
+
+def get_partition_stats():
+    '''
+    Get information about partition residency.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `hits`, `misses`, `releases`, `loaded`, and `loadedBytes`:
+
+    `hits` : `int`
+        Searches that found their partition already loaded
+    `misses` : `int`
+        Searches that had to load their partition
+    `releases` : `int`
+        How many times a partition has been released
+    `loaded` : `str[]`
+        Currently loaded partitions, least recently used first
+    `loadedBytes` : `int`
+        Estimated memory of all loaded partitions
+    '''
+    with _partition_lock:
+        return {
+            **_partition_stats,
+            "loaded"        : list(_loaded_partitions.keys()),
+            "loadedBytes"   : sum(info["bytes"] for info in _loaded_partitions.values())
+        }
@@ -9,22 +9,39 @@ FUNCTIONS
 ---------
 tokens_from_string
 
+tokens_from_strings
+
 tokens_from_message
 
 tokens_from_messages
 
+parse_date
+
+message_timestamp
+
 message_to_string
 
 memory_string_crafter 
 
 prompt_crafter 
 
+TEMPLATE FUNCTIONS
+------------------
+get_template
+
+render_template
+
+set_channel_template
+
+get_channel_template
+
 PROMPT FUNCTIONS
 ----------------
 DEFAULT
 '''
 
-import datetime, tiktoken
+import datetime, tiktoken, threading, itertools, bisect, os, string
+from collections import OrderedDict
 import debug
 
 w  = debug.Fore.WHITE
@@ -37,11 +54,29 @@ lr = debug.Fore.LIGHTRED_EX
 # def get_token_amount(message):
 enc = tiktoken.get_encoding("cl100k_base")
 
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+PROMPT_DIRECTORY = "prompts"
+DEFAULT_TEMPLATE = "default"
+
+TOKEN_CACHE_MAX_ENTRIES = 100000    # Rendered strings whose token count is remembered
+TOKEN_BATCH_THREADS     = 8         # Threads tiktoken uses when encoding a batch
+
+_token_cache      = OrderedDict()   # string -> tokens, least recently used first
+_token_cache_lock = threading.Lock()
+
+_templates          = {}        # name -> { "path": str, "mtime": int, "text": str, "pieces": tuple[], "fields": str[], "baseTokens": int }
+_channel_templates  = {}        # channel_id (str) -> template name
+_templates_lock     = threading.Lock()
+_formatter          = string.Formatter()
+
 # the added * 2 is there to get a more accurate answer for this kind of usage, as Discord messages aren't like typical paragraphs
 def tokens_from_string(string):
     '''
     Get a perdiction for tokens with tiktoken.
 
+    Special tokens such as `<|endoftext|>` are counted as ordinary text.
+
     PARAMETERS
     ----------
     `string` : `str`
@@ -50,7 +85,49 @@ def tokens_from_string(string):
     ------
     Returns an `int` of how many tokens the string would be.
     '''
-    return len(enc.encode(string)) + 1
+    return tokens_from_strings([string])[0]
+
+
+def tokens_from_strings(strings):
+    '''
+    Get a perdiction for tokens of many strings at once.
+
+    Counts are cached by string, and strings not inside the cache are encoded together with tiktoken's multi-threaded batch encoding.
+    Use this instead of calling `tokens_from_string` in a loop.
+
+    PARAMETERS
+    ----------
+    `strings` : `str[]`
+
+    RETURN
+    ------
+    Returns an `int[]` of how many tokens each string would be.
+    '''
+    result  = [None] * len(strings)
+    missing = {}
+
+    with _token_cache_lock:
+        for i, string in enumerate(strings):
+            tokens = _token_cache.get(string)
+            if tokens is None: missing.setdefault(string, []).append(i)
+            else:
+                _token_cache.move_to_end(string)
+                result[i] = tokens
+
+    if len(missing) == 0: return result
+
+    missing_strings = list(missing.keys())
+    if len(missing_strings) == 1: encoded = [enc.encode_ordinary(missing_strings[0])]
+    else:                         encoded = enc.encode_ordinary_batch(missing_strings, num_threads=TOKEN_BATCH_THREADS)
+
+    with _token_cache_lock:
+        for string, tokens in zip(missing_strings, encoded):
+            tokens = len(tokens) + 1
+            _token_cache[string] = tokens
+            for i in missing[string]: result[i] = tokens
+        while len(_token_cache) > TOKEN_CACHE_MAX_ENTRIES: _token_cache.popitem(last=False)
+
+    return result
 
 
 def tokens_from_message(prev_message, message):
@@ -79,16 +156,21 @@ def tokens_from_message(prev_message, message):
     return tokens_from_string(message_to_string(prev_message, message))
 
 
-def tokens_from_messages(messages):
+def tokens_from_messages(messages, prev_message=None):
     '''
     Calculate the amount of tokens inside a message or list of messages.
 
+    All messages are rendered first and then counted together with `tokens_from_strings`.
+
     PARAMETERS
     ----------
     `messages` : `dict || dict[]`
         Message or messages from for which tokens will be counted.
         Read the assumptions section on the proper message format. 
 
+    `prev_message` : `None || dict`
+        The message right before the first message, if there is one.
+
     ASSUMPTIONS
     -----------
     `messages` must follow the message format given by the `message_to_string` function.
@@ -107,27 +189,56 @@ def tokens_from_messages(messages):
     '''
     if type(messages) != list: messages = [messages]
 
-    info = {
-        "total" : 0,
-        "each"  : []
+    strings = []
+    for message in messages:   
+        strings.append(message_to_string(prev_message, message))
+        prev_message = message
+
+    each = tokens_from_strings(strings)
+
+    return {
+        "total" : sum(each),
+        "each"  : each
     }
 
-    prev_message = None
-    for message in messages:   
 
-        next_tokens = tokens_from_message(prev_message, message)
+def parse_date(date):
+    '''
+    Parse a message date into seconds since epoch.
 
-        info["total"] += next_tokens
-        info["each"].append(next_tokens) 
-        prev_message   = message
+    Dates without a timezone are taken to be in UTC, which is what Discord uses.
 
-    return info
+    PARAMETERS
+    ----------
+    `date` : `str || datetime.datetime`
+        `str` must be of format `%Y-%m-%d %H:%M:%S` or `%Y-%m-%d %H:%M:%S.%f`
+
+    RETURN
+    ------
+    Returns a `float` timestamp.
+    '''
+    if type(date) != datetime.datetime:
+        if len(date) == 19: date += ".000000"
+        date = datetime.datetime.strptime(date, DATE_FORMAT)
+    if date.tzinfo is None: date = date.replace(tzinfo=datetime.timezone.utc)
+    return date.timestamp()
+
+
+def message_timestamp(message):
+    '''
+    Returns the `timestamp` of a message, parsing its `date` only if the message doesn't have one.
+    '''
+    timestamp = message.get("timestamp")
+    if timestamp is None: timestamp = parse_date(message['date'])
+    return timestamp
 
 
 def message_to_string(prev_message, current_message):
     '''
     Get the string representation of a message.
 
+    Neither message is changed.
+
     PARAMETERS
     ----------
     `prev_message` : `None || dict`
@@ -146,24 +257,23 @@ def message_to_string(prev_message, current_message):
     `author`    : str
     `content`   : str
 
+    Messages should also contain the field `timestamp`, the date already parsed with `parse_date`.
+    Without it the date has to be parsed on every call, which is slow.
+
     RETURN
     ------
     Depends on the time difference between `prev_message` and `current_date`.
     Check what happens inside the function to find out. :)
     '''
-    if prev_message is None: return f"\n({current_message['date'].split('.')[0]}) {current_message['author']}:\n{current_message['content']}\n"
+    content = current_message['content']
+    if content == "": content = "[attachment]"
 
-    if current_message['content'] == "": current_message['content'] = "[attachment]"
-
-    if len(prev_message['date'])    == 19:    prev_message['date'] += ".000000"
-    if len(current_message['date']) == 19: current_message['date'] += ".000000"
-
-    prev_date    = datetime.datetime.strptime(   prev_message['date'], '%Y-%m-%d %H:%M:%S.%f')
-    current_date = datetime.datetime.strptime(current_message['date'], '%Y-%m-%d %H:%M:%S.%f')  
-    if current_message['author'] == prev_message['author'] and abs( current_date - prev_date ).total_seconds() < 3 * 60:    
-        return current_message['content'] + '\n'
-    else:                                           
-        return f"\n({current_message['date'].split('.')[0]}) {current_message['author']}:\n{current_message['content']}\n"
+    if prev_message is not None \
+    and current_message['author'] == prev_message['author'] \
+    and abs( message_timestamp(current_message) - message_timestamp(prev_message) ) < 3 * 60:
+        return content + '\n'
+    else:
+        return f"\n({str(current_message['date']).split('.')[0]}) {current_message['author']}:\n{content}\n"
 
 
 def memory_string_crafter(memory, max_tokens, mode=1):
@@ -171,7 +281,9 @@ def memory_string_crafter(memory, max_tokens, mode=1):
     Crafts a string representation of a chain of messages which complies with being inside the a token threshold.
     Returned string could then be placed onto a prompt.
 
-    This is achieved by creating an empty string and then adding messages onto the string in the right format until the token threshold is reached.
+    Every message is rendered and counted only once.
+    Which messages fit inside the threshold is then found with prefix sums of the token counts, 
+    and the chosen messages are joined into the string in one go.
 
     `memory` can be an empty list.
 
@@ -219,76 +331,94 @@ def memory_string_crafter(memory, max_tokens, mode=1):
         "tokens" : 0
     }
 
-    if len(memory) == 0: return A
-    
-    if mode == 0:
-        prev_message = None
+    n = len(memory)
+    if n == 0: return A
+
+    # Every message is rendered and counted at most once, as it would appear after the previous message.
+    # The first message always gets a header, as it has no previous message.
+    # Modes 0 and 1 render in growing chunks from their starting end, and stop once the threshold is passed.
+    strings = [None] * n
+    each    = [0]    * n
+
+    def render(lo, hi):
+        chunk = [message_to_string(memory[i-1] if i > 0 else None, memory[i]) for i in range(lo, hi)]
+        strings[lo:hi] = chunk
+        each   [lo:hi] = tokens_from_strings(chunk)
+        return sum(each[lo:hi])
+
+    def header(i):
+        # The first message of a window that doesn't start at the beginning needs its header back
+        if i == 0: return strings[0], each[0]
+        string = message_to_string(None, memory[i])
+        return string, tokens_from_string(string)
+
+    def craft(left, right, left_header=None):
+        # Window memory[left:right+1], with memory[left] rendered with a header
+        if left > right: return A
+        string, tokens = left_header or header(left)
+        return {
+            "string" : string + "".join(strings[left+1:right+1]),
+            "tokens" : tokens + sum(each[left+1:right+1])
+        }
 
-        for message in memory:
-            next        = message_to_string(prev_message, message)
-            next_tokens = tokens_from_string(next)
-            if A["tokens"] + next_tokens > max_tokens: break
-            A["tokens"] += next_tokens
-            A["string"] += next
-            prev_message = message
+    if mode == 0:
+        hi, total, chunk = 0, 0, 32
+        while hi < n and total <= max_tokens:
+            total += render(hi, min(n, hi + chunk))
+            hi, chunk = min(n, hi + chunk), chunk * 2
+
+        prefix = [0, *itertools.accumulate(each[:hi])]
+        count = bisect.bisect_right(prefix, max_tokens) - 1
+        return {
+            "string" : "".join(strings[:count]),
+            "tokens" : prefix[count]
+        }
 
     elif mode == 1:
-        prev_A = None
-
-        for i in range(len(memory) - 1, -1, -1):
-            next_tokens = tokens_from_string(message_to_string(None, memory[i]))
-
-            if A["tokens"] + next_tokens > max_tokens:
-                if not i == len(memory) - 1: 
-                    next        = message_to_string(None, memory[i+1])
-                    next_tokens = tokens_from_string(next)
-                    A = prev_A
-                    A["tokens"] += next_tokens
-                    A["string"]  = next + A["string"]
-                break
-
-            prev_A = A.copy()
-
-            prev_message = None
-            if i - 1 >= 0: prev_message = memory[i - 1] 
-            next        = message_to_string(memory[i - 1], memory[i])
-            next_tokens = tokens_from_string(next)
-            A["tokens"] += next_tokens
-            A["string"] = next + A["string"]
+        lo, total, chunk = n, 0, 32
+        while lo > 0 and total <= max_tokens:
+            total += render(max(0, lo - chunk), lo)
+            lo, chunk = max(0, lo - chunk), chunk * 2
+
+        # The oldest messages that fit, counted as they appear after their previous message.
+        # Messages in front of `lo` can never fit, as the messages after them alone are already too many tokens.
+        left, tokens = n, 0
+        while left > lo and tokens + each[left-1] <= max_tokens:
+            left   -= 1
+            tokens += each[left]
+
+        # Only the first message of the window gets its header back, which is rendered just for the message at the cut.
+        # If the header doesn't fit, the window starts one message later instead
+        while left < n:
+            left_header = header(left)
+            if tokens - each[left] + left_header[1] <= max_tokens: return craft(left, n - 1, left_header)
+            tokens -= each[left]
+            left   += 1
+        return A
 
     elif mode == 2:
-        result = tokens_from_messages(memory)
-
-        switch = True
-        section = [0, len(memory) - 1]
-        while result["total"] > max_tokens:
-            if switch:
-                result["total"] -= result["each"][section[0]]
-                section[0]      += 1
-                switch           = False
-            else:
-                result["total"] -= result["each"][section[1]]
-                section[1]      -= 1
-                switch           = True
+        render(0, n)
+        prefix = [0, *itertools.accumulate(each)]     # prefix[k] = tokens of the first k messages
 
-        result["total"] -= result["each"][section[0]]
-        tokens = tokens_from_message(None, memory[section[0]])
-        result["total"] += tokens
+        # Dropping k messages alternately from the left and the right leaves the window [(k+1)//2, n-1-k//2].
+        # Tokens only ever decrease with k, so the first fitting k is found with a binary search.
+        def fits(k):
+            return prefix[n - k//2] - prefix[(k+1)//2] <= max_tokens
 
-        if result["total"] > max_tokens: section[0] += 1
+        k = bisect.bisect_left(range(n + 1), True, key=fits)
+        left, right = (k+1)//2, n - 1 - k//2
+        if left > right: return A
 
-        prev_message = None
-        for message in memory[section[0]:section[1]]:
-            next        = message_to_string(prev_message, message)
-            next_tokens = tokens_from_string(next)
-            A["tokens"] += next_tokens
-            A["string"] += next
-            prev_message = message
+        left_header = header(left)
+        if prefix[right+1] - prefix[left+1] + left_header[1] > max_tokens: 
+            left += 1
+            left_header = None
+        return craft(left, right, left_header)
 
     return A
 
 
-def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_tokens, output_result_to_file=False):
+def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_tokens, output_result_to_file=False, channel_id=None, template=None):
     '''
     Craft a prompt containing long-term memory and short-term memory.
 
@@ -310,6 +440,13 @@ def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_
 
     `output_result_to_file` : `bool`
         Also write output into file `outputs/ai_generated_prompt.txt`
+
+    `channel_id` : `None || int`
+        If given, the template chosen for this channel with `set_channel_template` is used
+
+    `template` : `None || str`
+        Name of the template to use. Overrides the channel's template.
+        If neither is given, `DEFAULT_TEMPLATE` is used
     
     ASSUMPTIONS
     -----------
@@ -322,7 +459,7 @@ def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_
     
     RETURN
     ------
-    Returns a dictionary containing the fields `string`, `ltm_tokens`, `stm_tokens`:
+    Returns a dictionary containing the fields `string`, `base_tokens`, `ltm_tokens`, `stm_tokens`, `total_tokens`:
 
     `string` : `str`
         The actual wanted prompt string which can then be given to ChatGPT or any other AI model.
@@ -335,13 +472,18 @@ def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_
 
     `stm_tokens` : `int`
         How many tokens the shortstring inside the promp-term memory string inside the prompt is
+
+    `total_tokens` : `int`
+        Perdiction of how many tokens the whole prompt is
     '''
 
     # message = [ id, date, author, message ]
 
+    if template is None: template = get_channel_template(channel_id)
+
     ltm = ""
     stm = ""
-    ltm_tokens_per_memory = max_ltm_tokens / len(long_term_memory)
+    ltm_tokens_per_memory = max_ltm_tokens / max(1, len(long_term_memory))
     ltm_tokens = 0
     stm_tokens = 0
 
@@ -356,7 +498,8 @@ def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_
     ltm_tokens = tokens_from_string(ltm)
     stm_tokens = tokens_from_string(stm)
 
-    prompt = DEFAULT(ltm.strip(), stm.strip())
+    prompt = render_template(template, long_term_memory_string = ltm.strip(), short_term_memory_string = stm.strip())
+    base_tokens = get_template(template)["baseTokens"]
 
     if output_result_to_file:
         with open("outputs/generated_prompt.txt", 'w', encoding='utf-8') as file:
@@ -367,11 +510,118 @@ def prompt_crafter(long_term_memory, short_term_memory, max_ltm_tokens, max_stm_
 
     return {
         "string" : prompt,
+        "base_tokens" : base_tokens,
         "ltm_tokens" : ltm_tokens,
-        "stm_tokens" : stm_tokens
+        "stm_tokens" : stm_tokens,
+        "total_tokens" : base_tokens + ltm_tokens + stm_tokens
     }
 
 
+def get_template(name=DEFAULT_TEMPLATE):
+    '''
+    Get a prompt template from `PROMPT_DIRECTORY`.
+
+    Templates are read and parsed from disk only once, and again only after the file has changed.
+    So prompts can be edited while the bot is running, without being parsed again for every prompt.
+
+    PARAMETERS
+    ----------
+    `name` : `str`
+        Name of the template. The template is read from `{PROMPT_DIRECTORY}/{name}.txt`
+
+    FAILURE
+    -------
+    `[!]` : The template has positional fields, such as `{}` or `{0}`. Fields are filled in by name, so `ValueError` is raised
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `path`, `mtime`, `text`, `pieces`, `fields`, and `baseTokens`:
+
+    `text` : `str`
+        The template, with `str.format` fields
+
+    `pieces` : `tuple[]`
+        The parsed template, as `( literal_text, field_name, format_spec, conversion )` tuples of `string.Formatter().parse`
+
+    `fields` : `str[]`
+        Names of the fields inside the template
+
+    `baseTokens` : `int`
+        How many tokens the template is with every field left empty
+    '''
+    path  = os.path.join(PROMPT_DIRECTORY, f"{name}.txt")
+    mtime = os.stat(path).st_mtime_ns
+
+    with _templates_lock:
+        template = _templates.get(name)
+        if template is not None and template["mtime"] == mtime: return template
+
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    pieces = tuple(_formatter.parse(text))
+    positional = [field for _, field, _, _ in pieces if field is not None and (field == "" or field.split('.')[0].split('[')[0].isdigit())]
+    if len(positional) > 0:
+        debug.log(lr, f"[!] PROMPT - Template {name} has positional fields, but fields are filled in by name: {', '.join('{' + field + '}' for field in positional)}")
+        raise ValueError(f"template {name} has positional fields, give every field a name")
+    template = {
+        "path"       : path,
+        "mtime"      : mtime,
+        "text"       : text,
+        "pieces"     : pieces,
+        "fields"     : [field for _, field, _, _ in pieces if field],
+        "baseTokens" : tokens_from_string("".join(literal for literal, _, _, _ in pieces))
+    }
+
+    with _templates_lock:
+        _templates[name] = template
+    debug.log(lb, f"[-] PROMPT - Template loaded: {name}")
+    return template
+
+
+def render_template(name, **fields):
+    '''
+    Fill in a prompt template, using the pieces parsed by `get_template`.
+    Gives the same result as `str.format` on the template text.
+
+    PARAMETERS
+    ----------
+    `name` : `str`
+        Name of the template
+
+    `**fields` :
+        Value for each field inside the template
+
+    RETURN
+    ------
+    Returns the filled in template.
+    '''
+    parts = []
+    for literal, field, format_spec, conversion in get_template(name)["pieces"]:
+        parts.append(literal)
+        if field is None: continue
+        value = _formatter.convert_field(_formatter.get_field(field, (), fields)[0], conversion)
+        parts.append(_formatter.format_field(value, format_spec))
+    return "".join(parts)
+
+
+def set_channel_template(channel_id, name):
+    '''
+    Choose the template used for a channel's prompts.
+    Giving `None` as `name` makes the channel use `DEFAULT_TEMPLATE` again.
+    '''
+    with _templates_lock:
+        if name is None: _channel_templates.pop(str(channel_id), None)
+        else:            _channel_templates[str(channel_id)] = name
+
+
+def get_channel_template(channel_id):
+    '''
+    Returns the name of the template used for a channel's prompts.
+    '''
+    with _templates_lock:
+        return _channel_templates.get(str(channel_id), DEFAULT_TEMPLATE)
+
+
 
 def DEFAULT(long_term_memory_string, short_term_memory_string):
     '''
@@ -389,5 +639,4 @@ def DEFAULT(long_term_memory_string, short_term_memory_string):
     ------
     Returns the full prompt containing the given long-term memory and short-term memory.
     '''
-    with open("prompts/default.txt") as file:
-        return file.read().format(long_term_memory_string = long_term_memory_string, short_term_memory_string = short_term_memory_string)
\ No newline at end of file
+    return render_template(DEFAULT_TEMPLATE, long_term_memory_string = long_term_memory_string, short_term_memory_string = short_term_memory_string)
\ No newline at end of file
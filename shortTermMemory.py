@@ -0,0 +1,442 @@
+'''
+SHORT-TERM MEMORY
+=================
+
+Module for storing the short-term memory of each channel.
+
+Every channel's short-term memory is saved inside the `short-term-memory` directory as two files:
+
+`{channel_id}.json` : snapshot of the memory
+
+`{channel_id}.log.jsonl` : changes made after the snapshot, one JSON object per line
+
+Changes are only ever appended to the log, so adding a message costs the same no matter how large the memory is.
+Once the log grows past `COMPACT_AFTER_ENTRIES` lines, the memory is compacted:
+a new snapshot is atomically written over the old one and the log is emptied.
+
+Recently used memories are kept in memory as `ShortTermMemory` objects, so they are read from disk only once.
+A `ShortTermMemory` keeps a running total of its tokens, so adding and evicting messages never has to recount the whole memory.
+
+NOTES
+-----
+Memories returned by `load` are shared hot copies. They must only be changed through the functions of this module.
+
+Call `stop` before the program exits, so that every memory gets compacted.
+
+CLASSES
+-------
+MessageRecord
+
+ShortTermMemory
+
+FUNCTIONS
+---------
+exists
+
+create
+
+remove
+
+load
+
+append_messages
+
+trim
+
+peek_overflow
+
+evict_overflow
+
+clear_failed_saves
+
+compact
+
+stop
+'''
+
+import os, json, threading
+from collections import OrderedDict, deque
+import debug, prompt, utility
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+STM_DIRECTORY           = "short-term-memory"
+COMPACT_AFTER_ENTRIES   = 500       # Log lines allowed before the memory is compacted into a new snapshot
+MAX_HOT_CHANNELS        = 64        # Memories kept in memory, least recently used are dropped first
+FSYNC_APPENDS           = False     # fsync after every append. Safer, but much slower
+
+_memories   = OrderedDict()         # channel_id (str) -> { "memory": ShortTermMemory, "sequence": int, "logEntries": int }
+_lock       = threading.RLock()
+
+
+def _snapshot_path(channel_id):
+    return os.path.join(STM_DIRECTORY, f"{channel_id}.json")
+
+
+def _log_path(channel_id):
+    return os.path.join(STM_DIRECTORY, f"{channel_id}.log.jsonl")
+
+
+class MessageRecord:
+    '''
+    A single message inside short-term memory.
+
+    Supports item access (`record["content"]`), so records can be used anywhere a message dictionary is expected.
+    '''
+    __slots__ = ("id", "date", "timestamp", "author", "content", "tokens")
+
+    def __init__(self, id, date, timestamp, author, content, tokens):
+        self.id        = id
+        self.date      = date
+        self.timestamp = timestamp
+        self.author    = author
+        self.content   = content
+        self.tokens    = tokens
+
+    def __getitem__(self, key):
+        try: return getattr(self, key)
+        except AttributeError: raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        return { key : getattr(self, key) for key in self.__slots__ }
+
+    @classmethod
+    def from_dict(cls, message):
+        return cls(message["id"], message["date"], prompt.message_timestamp(message), message["author"], message["content"], message["tokens"])
+
+
+class ShortTermMemory:
+    '''
+    Messages of a channel's short-term memory, from oldest to newest, and a running total of their tokens.
+
+    ATTRIBUTES
+    ----------
+    `messages` : `deque[MessageRecord]`
+
+    `total_tokens` : `int`
+
+    `failed_saves` : `dict[]`
+        Messages that could not be saved into long-term memory
+    '''
+    __slots__ = ("messages", "total_tokens", "failed_saves")
+
+    def __init__(self):
+        self.messages       = deque()
+        self.total_tokens   = 0
+        self.failed_saves   = []
+
+    def __len__(self):
+        return len(self.messages)
+
+    def last(self):
+        '''
+        Returns the newest message, or `None` if memory is empty.
+        '''
+        return self.messages[-1] if len(self.messages) > 0 else None
+
+    def append(self, record):
+        self.messages.append(record)
+        self.total_tokens += record.tokens
+
+    def trim(self, count):
+        '''
+        Remove the `count` oldest messages. Returns the removed messages.
+        '''
+        evicted = []
+        for _ in range(min(count, len(self.messages))):
+            record = self.messages.popleft()
+            self.total_tokens -= record.tokens
+            evicted.append(record)
+        return evicted
+
+    def overflow(self, max_tokens):
+        '''
+        Returns the oldest messages that must be removed for memory to be at most `max_tokens` tokens, without removing them.
+        '''
+        overflowing = []
+        tokens = self.total_tokens
+        for record in self.messages:
+            if tokens <= max_tokens: break
+            tokens -= record.tokens
+            overflowing.append(record)
+        return overflowing
+
+    def evict_overflow(self, max_tokens):
+        '''
+        Remove the oldest messages until memory is at most `max_tokens` tokens. Returns the removed messages.
+        '''
+        evicted = []
+        while self.total_tokens > max_tokens and len(self.messages) > 0:
+            record = self.messages.popleft()
+            self.total_tokens -= record.tokens
+            evicted.append(record)
+        return evicted
+
+    def to_dict(self):
+        return {
+            "total_tokens": self.total_tokens,
+            "messages": [record.to_dict() for record in self.messages],
+            "failedSaves": self.failed_saves
+        }
+
+    @classmethod
+    def from_dict(cls, memory):
+        stm = cls()
+        for message in memory["messages"]: stm.append(MessageRecord.from_dict(message))
+        stm.failed_saves = memory["failedSaves"]
+        return stm
+
+
+def _apply(memory, entry):
+    '''
+    Apply a single log entry onto a memory.
+    '''
+    if "add" in entry:
+        memory.append(MessageRecord.from_dict(entry["add"]))
+    elif "trim" in entry:
+        memory.trim(entry["trim"])
+    elif "failed" in entry:
+        memory.failed_saves.extend(entry["failed"])
+    elif "clearFailed" in entry:
+        memory.failed_saves = []
+
+
+def _get(channel_id):
+    '''
+    Get the hot copy of a channel's memory, reading it from disk if needed.
+
+    The snapshot contains the sequence number of the last log entry applied into it,
+    so entries left in the log by a crash during compaction are not applied twice.
+    A half-written last line, left by a crash during an append, is ignored.
+    '''
+    channel_id = str(channel_id)
+
+    if channel_id in _memories:
+        _memories.move_to_end(channel_id)
+        return _memories[channel_id]
+
+    memory   = ShortTermMemory()
+    sequence = 0
+    if os.path.isfile(_snapshot_path(channel_id)):
+        with open(_snapshot_path(channel_id), encoding='utf-8') as file:
+            snapshot = json.load(file)
+        memory   = ShortTermMemory.from_dict(snapshot)
+        sequence = snapshot.get("sequence", 0)
+
+    log_entries = 0
+    broken      = False
+    if os.path.isfile(_log_path(channel_id)):
+        with open(_log_path(channel_id), encoding='utf-8') as file:
+            for line in file:
+                try: entry = json.loads(line)
+                except json.JSONDecodeError:
+                    debug.log(ly, f"[*] SHORT-TERM MEMORY - Ignored broken log entry for channel {channel_id}")
+                    broken = True
+                    continue
+                log_entries += 1
+                if entry["sequence"] <= sequence: continue
+                _apply(memory, entry)
+                sequence = entry["sequence"]
+
+    _memories[channel_id] = {
+        "memory"        : memory,
+        "sequence"      : sequence,
+        "logEntries"    : log_entries
+    }
+    # Compacting gets rid of the broken line, so that the next append doesn't continue it
+    if broken: _compact(channel_id, force=True)
+    while len(_memories) > MAX_HOT_CHANNELS:
+        _compact(next(iter(_memories)))
+        _memories.popitem(last=False)
+    return _memories[channel_id]
+
+
+def _append(channel_id, entries, apply=True):
+    '''
+    Apply entries onto a channel's memory and append them into its log.
+
+    With `apply=False` the entries are only logged, for changes already made onto the hot copy.
+    '''
+    hot = _get(channel_id)
+    lines = []
+    for entry in entries:
+        hot["sequence"] += 1
+        entry["sequence"] = hot["sequence"]
+        if apply: _apply(hot["memory"], entry)
+        lines.append(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+
+    with open(_log_path(channel_id), 'a', encoding='utf-8') as file:
+        file.write(''.join(lines))
+        if FSYNC_APPENDS:
+            file.flush()
+            os.fsync(file.fileno())
+    hot["logEntries"] += len(lines)
+
+    if hot["logEntries"] >= COMPACT_AFTER_ENTRIES: _compact(channel_id)
+
+
+def _compact(channel_id, force=False):
+    channel_id = str(channel_id)
+    if channel_id not in _memories: return
+    hot = _memories[channel_id]
+    if hot["logEntries"] == 0 and not force: return
+
+    utility.write_json_atomic(_snapshot_path(channel_id), { **hot["memory"].to_dict(), "sequence": hot["sequence"] })
+    open(_log_path(channel_id), 'w').close()
+    hot["logEntries"] = 0
+
+
+def exists(channel_id):
+    '''
+    Returns `True` if the channel has short-term memory.
+    '''
+    with _lock:
+        return str(channel_id) in _memories or os.path.isfile(_snapshot_path(channel_id))
+
+
+def create(channel_id):
+    '''
+    Create empty short-term memory for a channel, replacing any existing memory.
+    '''
+    with _lock:
+        os.makedirs(STM_DIRECTORY, exist_ok=True)
+        _memories.pop(str(channel_id), None)
+        utility.write_json_atomic(_snapshot_path(channel_id), { **ShortTermMemory().to_dict(), "sequence": 0 })
+        if os.path.isfile(_log_path(channel_id)): os.remove(_log_path(channel_id))
+
+
+def remove(channel_id):
+    '''
+    Remove a channel's short-term memory.
+
+    RETURN
+    ------
+    `True` : memory was removed.
+
+    `False` : there was no memory to remove.
+    '''
+    with _lock:
+        _memories.pop(str(channel_id), None)
+        existed = os.path.isfile(_snapshot_path(channel_id))
+        for path in (_snapshot_path(channel_id), _log_path(channel_id)):
+            if os.path.isfile(path): os.remove(path)
+        return existed
+
+
+def load(channel_id):
+    '''
+    Get a channel's short-term memory.
+
+    RETURN
+    ------
+    Returns the channel's `ShortTermMemory`.
+    It is shared and must only be changed through the functions of this module.
+    '''
+    with _lock:
+        return _get(channel_id)["memory"]
+
+
+def append_messages(channel_id, messages):
+    '''
+    Append messages onto the end of a channel's short-term memory.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel identifier
+
+    `messages` : `MessageRecord[]`
+        Messages from oldest to newest
+    '''
+    if len(messages) == 0: return
+    with _lock:
+        hot = _get(channel_id)
+        for record in messages: hot["memory"].append(record)
+        _append(channel_id, [{ "add": record.to_dict() } for record in messages], apply=False)
+
+
+def trim(channel_id, count):
+    '''
+    Remove the `count` oldest messages from a channel's short-term memory.
+
+    RETURN
+    ------
+    Returns the removed messages as `MessageRecord[]`.
+    '''
+    if count <= 0: return []
+    with _lock:
+        evicted = _get(channel_id)["memory"].trim(count)
+        if len(evicted) > 0: _append(channel_id, [{ "trim": len(evicted) }], apply=False)
+        return evicted
+
+
+def peek_overflow(channel_id, max_tokens):
+    '''
+    Get the oldest messages that `evict_overflow` would remove, without removing them.
+
+    Lets the caller save the messages somewhere durable first, and then remove them with `trim`.
+
+    RETURN
+    ------
+    Returns the messages as `MessageRecord[]`, from oldest to newest.
+    '''
+    with _lock:
+        return _get(channel_id)["memory"].overflow(max_tokens)
+
+
+def evict_overflow(channel_id, max_tokens):
+    '''
+    Remove the oldest messages from a channel's short-term memory until it is at most `max_tokens` tokens.
+
+    RETURN
+    ------
+    Returns the removed messages as `MessageRecord[]`, from oldest to newest.
+    These should be moved into long-term memory.
+    '''
+    with _lock:
+        evicted = _get(channel_id)["memory"].evict_overflow(max_tokens)
+        if len(evicted) > 0: _append(channel_id, [{ "trim": len(evicted) }], apply=False)
+        return evicted
+
+
+def clear_failed_saves(channel_id):
+    '''
+    Forget the messages that could not be saved into long-term memory.
+
+    Failed saves are no longer added, as the memory spool retries them instead.
+    Clear the ones left from before once they have been spooled.
+    '''
+    with _lock:
+        if len(_get(channel_id)["memory"].failed_saves) > 0: _append(channel_id, [{ "clearFailed": True }])
+
+
+def compact(channel_id):
+    '''
+    Write a channel's memory into a new snapshot and empty its log.
+    '''
+    with _lock:
+        _compact(channel_id)
+
+
+def stop():
+    '''
+    Compact every memory that is in memory.
+    '''
+    with _lock:
+        for channel_id in list(_memories.keys()): _compact(channel_id)
+        _memories.clear()
+    debug.log(lg, "[#] SHORT-TERM MEMORY - All memory compacted")
@@ -0,0 +1,106 @@
+'''
+SYNC STATE
+==========
+
+Module for remembering how far each channel's history has been ingested into memory.
+
+Every channel's state is saved inside the `sync-state` directory as `{channel_id}.json`,
+and contains the fields:
+
+`newest` : `None || int`
+    Id of the newest message added into memory
+
+`backfill` : `None || dict`
+    Progress of ingesting the channel's older history into long-term memory.
+    Contains the fields `before` (id of the oldest ingested message), `count` (messages ingested), `limit`, and `done`.
+
+States are written atomically, so a crash never leaves a half-written state behind.
+
+FUNCTIONS
+---------
+load
+
+save
+
+update
+
+remove
+'''
+
+import os, json, threading
+import debug, utility
+
+w  = debug.Fore.WHITE
+lb = debug.Fore.LIGHTBLACK_EX
+lg = debug.Fore.LIGHTGREEN_EX
+ly = debug.Fore.LIGHTYELLOW_EX
+lr = debug.Fore.LIGHTRED_EX
+
+
+SYNC_DIRECTORY = "sync-state"
+
+_states = {}                # channel_id (str) -> state
+_lock   = threading.Lock()
+
+
+def _path(channel_id):
+    return os.path.join(SYNC_DIRECTORY, f"{channel_id}.json")
+
+
+def load(channel_id):
+    '''
+    Get a channel's sync state.
+
+    RETURN
+    ------
+    Returns a copy of the channel's state. A channel without a saved state gets an empty state.
+    '''
+    with _lock:
+        return json.loads(json.dumps(_load(channel_id)))
+
+
+def _load(channel_id):
+    '''
+    Returns the cached state of a channel, reading it from disk first if needed. Call while holding `_lock`.
+    '''
+    channel_id = str(channel_id)
+    if channel_id not in _states:
+        state = { "newest": None, "backfill": None }
+        if os.path.isfile(_path(channel_id)):
+            with open(_path(channel_id), encoding='utf-8') as file:
+                state.update(json.load(file))
+        _states[channel_id] = state
+    return _states[channel_id]
+
+
+def save(channel_id, state):
+    '''
+    Save a channel's sync state.
+    '''
+    with _lock:
+        os.makedirs(SYNC_DIRECTORY, exist_ok=True)
+        utility.write_json_atomic(_path(channel_id), state)
+        _states[str(channel_id)] = json.loads(json.dumps(state))
+
+
+def update(channel_id, **fields):
+    '''
+    Save only the given fields of a channel's sync state.
+
+    Fields saved by others after this caller loaded the state are kept, 
+    so a long running backfill doesn't roll `newest` back, and the other way around.
+    '''
+    with _lock:
+        state = { **_load(channel_id), **json.loads(json.dumps(fields)) }
+        os.makedirs(SYNC_DIRECTORY, exist_ok=True)
+        utility.write_json_atomic(_path(channel_id), state)
+        _states[str(channel_id)] = state
+
+
+def remove(channel_id):
+    '''
+    Forget a channel's sync state.
+    '''
+    with _lock:
+        _states.pop(str(channel_id), None)
+        if os.path.isfile(_path(channel_id)): os.remove(_path(channel_id))
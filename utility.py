@@ -1,4 +1,4 @@
-import datetime
+import datetime, os, json
 import debug
 from settings import BOT_ID, ADMINS_ID, COMMAND_PREFIX, CONTAINER_CHAR
 
@@ -125,6 +125,18 @@ def get_command_info(messageClass):
     return (command, args)
 
 
+def write_json_atomic(path, data):
+    '''
+    Write JSON into a file so that the file contains either the old or the new content, even if the program crashes.
+    '''
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w', encoding='utf-8') as file:
+        json.dump(data, file, ensure_ascii=False, default=str)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, path)
+
+
 # def serialize_datetime(obj):
 #     if isinstance(obj, datetime.datetime):
 #         return obj.isoformat()
@@ -4,10 +4,18 @@ VECTOR DATABASE
 
 Module for handling all long-term memory of the AI.
 
-LTM is handled with the use of a milvus vector database.
+LTM is handled with the use of a milvus vector database, see `milvusVectorStore`.
 
 All memory is saved inside the collection called `discord_selfbot_memory`
 
+Instead of Milvus, memory can be kept inside the bot's own process with `localVectorStore`,
+which needs no server and is fast enough for the few thousand messages of most channels:
+    >>> start(backend="local")
+
+Both backends have the same functions. The backend is chosen once by `start`,
+and every function of this module calls it without knowing which one it is.
+Another backend is added by writing a module with the same functions and adding it into `_STORES`.
+
 NOTES
 -----
 The database must be started and stopped:
@@ -15,6 +23,27 @@ The database must be started and stopped:
     >>> DO STUFF ...
     >>> stop()
 
+Every function talking to Milvus blocks.
+When called from the discord event loop, use the asynchronous versions instead,
+which run the blocking calls inside a bounded thread pool:
+    >>> result = await asearch(channel_id, vector)
+
+Inserts are not flushed one by one. They are flushed in groups by `flush_if_due`, and on `stop`.
+
+While Milvus is unreachable, `is_available` returns `False` and calls fail right away instead of waiting on a dead server.
+
+Large inserts are split into batches, of which `INSERT_WORKERS` are sent to Milvus at the same time.
+The size of the batches follows how fast Milvus has been inserting, see `INSERT_TARGET_SECONDS`.
+
+Messages are inserted as a columnar `MessageBatch`, which insert batches are sliced out of without copying.
+Embeddings are handled as NumPy float32 arrays. 
+
+CLASSES
+-------
+StringColumn
+
+MessageBatch
+
 FUNCTIONS
 ---------
 start
@@ -23,31 +52,75 @@ stop
 
 is_running
 
+is_available
+
+get_connection_stats
+
 create_channel_memory_if_new
 
 remove_channel_memory_if_exist
 
 add_messages
 
+invalid_reason
+
+existing_ids
+
+get_neighbors
+
+get_embeddings
+
+list_channels
+
 drop_messages
 
+flush
+
+flush_if_due
+
+get_segment_stats
+
+get_insert_stats
+
 create_index
 
+get_index
+
+count_entities
+
+search_params
+
 search
 
+release_idle_partitions
+
+get_partition_stats
+
+ASYNC FUNCTIONS
+---------------
+acreate_channel_memory_if_new
+
+aremove_channel_memory_if_exist
+
+aadd_messages
+
+aexisting_ids
+
+aget_neighbors
+
+adrop_messages
+
+acreate_index
+
+asearch
+
 DROP_ALL_MEMORY
 '''
 
-from pymilvus import (
-    connections,
-    utility,
-    FieldSchema,
-    CollectionSchema,
-    DataType,
-    Collection,
-    Partition
-)
-import debug
+import time, threading, asyncio, functools
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import debug, milvusVectorStore, localVectorStore
 
 w  = debug.Fore.WHITE
 lb = debug.Fore.LIGHTBLACK_EX
@@ -56,22 +129,221 @@ ly = debug.Fore.LIGHTYELLOW_EX
 lr = debug.Fore.LIGHTRED_EX
 
 
-_HOST = 'localhost'
-_PORT = '19530'
 _DIM = 1536
 _COLLECTION_NAME = "discord_selfbot_memory"
 
 _SCHEMA_SIZE        = 5
-_MAX_AUTHOR_LENGTH  = 40
-_MAX_MESSAGE_LENGTH = 2500
-
-INSERT_BATCH_SIZE = 1000
+_MAX_DATE_LENGTH    = milvusVectorStore._MAX_DATE_LENGTH        # Limits of the Milvus schema, which every backend is held to
+_MAX_AUTHOR_LENGTH  = milvusVectorStore._MAX_AUTHOR_LENGTH
+_MAX_MESSAGE_LENGTH = milvusVectorStore._MAX_MESSAGE_LENGTH
+
+INSERT_BATCH_SIZE       = 1000                  # Rows of the first insert batches, before their size is adapted
+INSERT_MIN_BATCH_SIZE   = 100
+INSERT_MAX_BATCH_SIZE   = 20000
+INSERT_MAX_BATCH_BYTES  = 32 * 1024 ** 2        # Largest batch payload. gRPC messages are limited to 64 MB by default
+INSERT_TARGET_SECONDS   = 1.0                   # Batches are sized so that inserting one takes about this long
+INSERT_WORKERS          = 4                     # Batches inserted at the same time, by backends that allow it
+
+BACKEND = "milvus"      # "milvus" or "local", used when start is not given a backend
+
+DEFAULT_INDEX = {
+    "index_type"  : "IVF_FLAT",
+    "metric_type" : "L2",
+    "params"      : {"nlist": 128},
+}
+NEIGHBORS_BEFORE    = 3         # Messages given with a search hit, sent before it
+NEIGHBORS_AFTER     = 3         # Messages given with a search hit, sent after it
+NEIGHBOR_WINDOW     = 30 * 60   # Seconds around a hit that its neighbors must be sent within
+
+SEARCH_LIMIT    = 10    # Messages returned for each searched vector
+SEARCH_NPROBE   = 10    # Clusters searched with IVF indexes
+SEARCH_EF       = 64    # Candidates searched with HNSW indexes
+
+FLUSH_INTERVAL      = 60        # Seconds inserted messages may stay unflushed
+FLUSH_AFTER_ROWS    = 10000     # Unflushed messages that cause a flush right away
+
+ASYNC_MAX_WORKERS   = 4     # Threads running blocking Milvus calls for the async functions
+ASYNC_MAX_PENDING   = 64    # Async calls allowed to wait for a thread before callers are made to wait
+ASYNC_TIMEOUT       = 30    # Default seconds an async read may take, including time waiting for a thread. Writes wait until done
+
+_STORES = {             # Backend name -> module implementing it
+    "milvus"    : milvusVectorStore,
+    "local"     : localVectorStore
+}
 
 running = False
-memory_collection = None    # The entire collection object for the bot's memory
+_store  = None          # Module of the backend chosen by start
+
+_flush_lock     = threading.Lock()
+_flush_state    = {
+    "unflushed"         : 0,                # Messages inserted since the last flush
+    "firstUnflushed"    : None,             # When the oldest of them was inserted
+    "lastFlush"         : time.time()
+}
+_flush_stats    = {
+    "flushes"       : 0,
+    "rowsFlushed"   : 0,
+    "flushSeconds"  : 0.0
+}
+
+_executor      = None     # Thread pool for the async functions, created on first use
+_pending_slots = None     # Semaphore bounding how many async calls may be queued at once
+
+_insert_executor = None     # Thread pool inserting batches, created by start and removed by stop
+_insert_lock     = threading.Lock()
+_inserts_running = 0        # add_messages calls using the thread pool, which stop waits for
+_inserts_done    = threading.Condition(_insert_lock)
+_insert_stats    = {
+    "batches"       : 0,
+    "rows"          : 0,
+    "bytes"         : 0,
+    "seconds"       : 0.0,                  # Time spent inside insert calls, summed over all workers
+    "batchSize"     : INSERT_BATCH_SIZE     # Rows of the next batch
+}
+
+
+class StringColumn:
+    '''
+    Column of strings stored the way Apache Arrow stores them: 
+    the utf-8 bytes of every string one after another, and the offset where each string starts.
+
+    Slicing gives a view of the same bytes. Strings are only decoded when they are read.
+    '''
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, data, offsets):
+        self.data    = data         # uint8 array
+        self.offsets = offsets      # int64 array, one longer than the column
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode('utf-8') for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.fromiter((len(string) for string in encoded), dtype=np.int64, count=len(encoded)))
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def nbytes(self):
+        return int(self.offsets[-1] - self.offsets[0])
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, _ = key.indices(len(self))
+            return StringColumn(self.data, self.offsets[start:max(start, stop) + 1])
+        return self.data[self.offsets[key]:self.offsets[key + 1]].tobytes().decode('utf-8')
+
+    def take(self, indexes):
+        return StringColumn.from_strings([self[i] for i in indexes])
+
+    def byte_lengths(self):
+        return np.diff(self.offsets)
+
+    def to_list(self):
+        base = int(self.offsets[0])
+        raw  = self.data[base:self.offsets[-1]].tobytes()
+        bounds = (self.offsets - base).tolist()
+        return [raw[bounds[i]:bounds[i + 1]].decode('utf-8') for i in range(len(self))]
 
 
-def start(collection_name=_COLLECTION_NAME):
+class MessageBatch:
+    '''
+    Columnar batch of messages, in the format `add_messages` inserts.
+
+    `ids` : int64 array
+
+    `dates`, `authors`, `contents` : `StringColumn`
+
+    `embeddings` : contiguous float32 matrix of shape `( len, _DIM )`
+
+    Slicing a batch gives views of the same columns, so insert batches are cut out of it without copying anything.
+    Indexing a batch gives a single message in the dictionary format.
+    '''
+    __slots__ = ("ids", "dates", "authors", "contents", "embeddings")
+
+    def __init__(self, ids, dates, authors, contents, embeddings):
+        self.ids        = ids
+        self.dates      = dates
+        self.authors    = authors
+        self.contents   = contents
+        self.embeddings = embeddings
+
+    @classmethod
+    def from_messages(cls, messages, embeddings=None):
+        '''
+        Build a batch from messages in the dictionary format.
+
+        PARAMETERS
+        ----------
+        `embeddings` : `None || float[][]`
+            Embedding of each message, for example straight from `ai.embed_strings`.
+            By default the `embedding` field of each message is used
+        '''
+        if embeddings is None: embeddings = [message["embedding"] for message in messages]
+        return cls(
+            np.fromiter((message["id"] for message in messages), dtype=np.int64, count=len(messages)),
+            StringColumn.from_strings([message["date"]    for message in messages]),
+            StringColumn.from_strings([message["author"]  for message in messages]),
+            StringColumn.from_strings([message["content"] for message in messages]),
+            np.ascontiguousarray(np.asarray(embeddings, dtype=np.float32).reshape(len(messages), _DIM))
+        )
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self):
+        '''
+        Bytes of the rows inside this batch, roughly what inserting it sends.
+        '''
+        return self.ids.nbytes + self.dates.nbytes + self.authors.nbytes + self.contents.nbytes + self.embeddings.nbytes
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return MessageBatch(self.ids[key], self.dates[key], self.authors[key], self.contents[key], self.embeddings[key])
+        return { "id": int(self.ids[key]), "date": self.dates[key], "author": self.authors[key], "content": self.contents[key], "embedding": self.embeddings[key] }
+
+    def take(self, indexes):
+        '''
+        Returns a new batch of the rows at `indexes`. Unlike slicing, this copies.
+        '''
+        return MessageBatch(self.ids[indexes], self.dates.take(indexes), self.authors.take(indexes), self.contents.take(indexes), self.embeddings[indexes])
+
+    def to_messages(self, embedding=True):
+        '''
+        Returns the messages in the dictionary format, with or without their `embedding`.
+        '''
+        fields = zip(self.ids.tolist(), self.dates.to_list(), self.authors.to_list(), self.contents.to_list())
+        if not embedding: return [{ "id": id, "date": date, "author": author, "content": content } for id, date, author, content in fields]
+        return [{ "id": id, "date": date, "author": author, "content": content, "embedding": vector } for (id, date, author, content), vector in zip(fields, self.embeddings)]
+
+    def columns(self):
+        '''
+        Returns the columns in the order of the schema, as inserted into Milvus.
+        '''
+        return [self.ids.tolist(), self.dates.to_list(), self.authors.to_list(), self.contents.to_list(), self.embeddings]
+
+    def invalid_reasons(self):
+        '''
+        Same as `invalid_reason` for every message at once, from the byte lengths of the string columns.
+
+        RETURN
+        ------
+        Returns a dictionary of index -> reason, for the messages Milvus would reject.
+        '''
+        reasons = {}
+        for column, limit, reason in (
+            (self.dates,    _MAX_DATE_LENGTH,    "date too long"   ),
+            (self.authors,  _MAX_AUTHOR_LENGTH,  "author too long" ),
+            (self.contents, _MAX_MESSAGE_LENGTH, "content too long")
+        ):
+            for i in np.flatnonzero(column.byte_lengths() > limit).tolist(): reasons.setdefault(i, reason)
+        return dict(sorted(reasons.items()))
+
+
+def start(collection_name=_COLLECTION_NAME, backend=None):
     '''
     Start the vector database.
 
@@ -82,20 +354,26 @@ def start(collection_name=_COLLECTION_NAME):
         By default is `discord_selfbot_memory`, but can be changed to a different collection.
         This could be done for testing purposes.
 
+    `backend` : `None || str`
+        `milvus`, or `local` for keeping memory inside this process with `localVectorStore`.
+        By default `BACKEND`
+
     ASSUMPTIONS
     -----------
-    Milvus is running
+    Milvus is running, unless the local backend is used
 
     FAILURE
     -------
     `[%]` : Database is already running
 
+    `[!]` : Unknown backend
+
     `[!]` : connecting to Milvus fails
 
     `[!]` : Could not get collection
     '''
     debug.init()
-    global memory_collection, _COLLECTION_NAME, running
+    global _COLLECTION_NAME, running, _store, _insert_executor
 
     if running: 
         debug.log(w, "[%] VECTOR DATABASE - Could not start database, as it is already running")
@@ -104,38 +382,16 @@ def start(collection_name=_COLLECTION_NAME):
     if collection_name != _COLLECTION_NAME:
         debug.log(w, f"[%] VECTOR DATABASE - Non-default database chosen: {collection_name}")
 
-    _COLLECTION_NAME = collection_name
-
-    try: connections.connect("default", host=_HOST, port=_PORT)
-    except Exception as e:
-        debug.log(lr, f"[!] VECTOR DATABASE - Could not connect to database")
-        debug.log(lb, f"                      exception: {e}",              )
-        raise
+    if (backend or BACKEND) not in _STORES:
+        debug.log(lr, f"[!] VECTOR DATABASE - Unknown backend: {backend or BACKEND}")
+        raise ValueError(f"unknown backend {backend or BACKEND}")
 
-    try:
-        if not utility.has_collection(_COLLECTION_NAME):
-            fields = [
-                # REMEBER TO UPDATE SCHEMA SIZE AND THE STUFF THAT DEPENDS ON IT!
-                FieldSchema(name="id",        dtype=DataType.INT64,         is_primary=True,                description="Primary Message ID"),
-                FieldSchema(name="date",      dtype=DataType.VARCHAR,       max_length=26,                  description="Date"),
-                FieldSchema(name="author",    dtype=DataType.VARCHAR,       max_length=_MAX_AUTHOR_LENGTH,  description="Author"),
-                FieldSchema(name="content",   dtype=DataType.VARCHAR,       max_length=_MAX_MESSAGE_LENGTH, description="Actual Message"),
-                FieldSchema(name="embedding", dtype=DataType.FLOAT_VECTOR,  dim=_DIM,                       description="Vector")
-            ]
-            schema = CollectionSchema(fields, "My Discord selfbot's entire long-term memory.", auto_id=False)
-            memory_collection = Collection(_COLLECTION_NAME, schema)
-            debug.log(lg, "[#] VECTOR DATABASE - New collection created")
-            running = True
-            return True
-        else:
-            memory_collection = Collection(_COLLECTION_NAME)
-            debug.log(lg, "[#] VECTOR DATABASE - Collection loaded")
-            running = True
-            return True
-    except Exception as e:
-        debug.log(lr,  "[!] VECTOR DATABASE - Could not get collection while startup")
-        debug.log(lb, f"                      exception: {e}",                       )
-        raise
+    _COLLECTION_NAME = collection_name
+    _store = _STORES[backend or BACKEND]
+    _store.start(_COLLECTION_NAME, _DIM)
+    with _insert_lock: _insert_executor = ThreadPoolExecutor(max_workers=INSERT_WORKERS, thread_name_prefix="vectorDatabaseInsert")
+    running = True
+    return True
 
 
 def stop():
@@ -150,8 +406,10 @@ def stop():
     if not running: 
         debug.log(w, "[%] VECTOR DATABASE - Could not stop database, as it isn't running in the first place")
         return
-    connections.disconnect("default")
-    debug.log(lg, "[#] VECTOR DATABASE - Collection disconnected")
+    _shutdown_executor()
+    _shutdown_insert_executor()
+    flush()
+    _store.stop()
     running = False
 
 
@@ -165,6 +423,26 @@ def is_running():
     return running
 
 
+def is_available():
+    '''
+    Returns `True` if long-term memory can be used right now: 
+    the database is running, and Milvus hasn't been found unreachable.
+
+    Never waits for Milvus, so it can be checked before every response.
+    '''
+    return running and _store.is_available()
+
+
+def get_connection_stats():
+    '''
+    Get information about the connections of the backend, see `milvusVectorStore.get_connection_stats`.
+
+    RETURN
+    ------
+    Returns a dictionary, or `None` if the backend has no connections.
+    '''
+    return _store.get_connection_stats()
+
 
 def create_channel_memory_if_new(channel_id):
     '''
@@ -183,14 +461,17 @@ def create_channel_memory_if_new(channel_id):
     `True` : channel memory was created.
 
     `False` : channel memory already existed.
-    '''
-    global memory_collection
 
-    if not memory_collection.has_partition(str(channel_id)):
-        memory_collection.create_partition(str(channel_id))
-        debug.log(lg, f"[#] VECTOR DATABASE - New memory created for channel {str(channel_id)}")
-        return True
-    return False
+    `None` : creating the memory failed, for example because Milvus is unreachable
+    '''
+    try:
+        if not _store.create_channel_memory_if_new(channel_id): return False
+    except Exception as e:
+        debug.log(ly, f"[*] VECTOR DATABASE - Failed to create memory for channel {str(channel_id)}")
+        debug.log(lb, f"                      exception: {e}")
+        return None
+    debug.log(lg, f"[#] VECTOR DATABASE - New memory created for channel {str(channel_id)}")
+    return True
 
 
 def remove_channel_memory_if_exist(channel_id):
@@ -207,14 +488,17 @@ def remove_channel_memory_if_exist(channel_id):
     `True` : channel memory was dropped.
     
     `False` : there was no memory to drop.
-    '''
-    global memory_collection
 
-    if memory_collection.has_partition(str(channel_id)):
-        memory_collection.drop_partition(str(channel_id))
-        debug.log(lg, f"[#] VECTOR DATABASE - Memory removed for channel {str(channel_id)}")
-        return True
-    return False
+    `None` : removing the memory failed, for example because Milvus is unreachable
+    '''
+    try:
+        if not _store.remove_channel_memory_if_exist(channel_id): return False
+    except Exception as e:
+        debug.log(ly, f"[*] VECTOR DATABASE - Failed to remove memory of channel {str(channel_id)}")
+        debug.log(lb, f"                      exception: {e}")
+        return None
+    debug.log(lg, f"[#] VECTOR DATABASE - Memory removed for channel {str(channel_id)}")
+    return True
 
 
 def add_messages(channel_id, messages, debug_info=False):
@@ -226,9 +510,10 @@ def add_messages(channel_id, messages, debug_info=False):
     `channel_id` : unique `int`
         Channel identifier for which new messages will be added
 
-    `messages` : `dict || dict[]`
+    `messages` : `dict || dict[] || MessageBatch`
         The message or list of messages that will be added into the channel's memory.
-        Read the assumptions section on the proper message format before adding any messages
+        Read the assumptions section on the proper message format before adding any messages.
+        A `MessageBatch` is inserted without turning it into lists first
 
     `debug_info` : `bool`
         If extra infomation will be printed
@@ -241,17 +526,25 @@ def add_messages(channel_id, messages, debug_info=False):
     `date`      : str, of format `%Y-%m-%d %H:%M:%S` or `%Y-%m-%d %H:%M:%S.%f`
     `author`    : str, not longer than _MAX_AUTHOR_LENGTH
     `content`   : str, not longer than _MAX_MESSAGE_LENGTH
-    `embedding` : float[_DIM]
+    `embedding` : float32 array or float[], of _DIM
 
     FAILURE
     -------
     `[*]` : Developer forgor to update `schema_size_assumption` after changing the schema size.
 
-    `[*]` : Inserting a batch of messages into long-term memory failed
+    `[*]` : Inserting a batch of messages into long-term memory failed.
+            The batch is split in halves and tried again, so that only the messages actually failing are reported.
+            Other batches are inserted at the same time, and are not affected.
+
+    `[*]` : Some messages are invalid. They are not inserted
+
+    `[*]` : Milvus is unreachable. Nothing is inserted and `None` is returned
+
+    `[*]` : The database is stopping. Nothing is inserted and `None` is returned
 
     RETURN
     ------
-    Returns a dictionary containing the fields `fullSuccess`, `failedAmount`, and `failedSlices`:
+    Returns a dictionary containing the fields `fullSuccess`, `failedAmount`, `failedSlices`, and `invalid`:
 
     `fullSuccess` : `bool`
         Whether all messages were added correctly, or a batch insert failed
@@ -261,13 +554,40 @@ def add_messages(channel_id, messages, debug_info=False):
         Contains information about all the messages that failed.
         For each entry,
         first index contains the beggining of the slice,
-        the second index contains the end of the slice
+        the second index contains the end of the slice (exclusive)
+    `invalid` : `dict`
+        Index -> reason, for the failed messages that Milvus would never accept, given by `invalid_reason`.
+        Trying these again is pointless
     '''
-    global memory_collection
+    global _inserts_running
+
+    if type(messages) != list and not isinstance(messages, MessageBatch): messages = [messages]
+
+    if not is_available():
+        debug.log(ly, "[*] VECTOR DATABASE - Could not add messages, as Milvus is unreachable")
+        return
+
+    # The thread pool is read once, and stop waits for this call to finish before closing it and the backend
+    with _insert_lock:
+        executor = _insert_executor
+        if executor is not None: _inserts_running += 1
+    if executor is None:
+        debug.log(ly, "[*] VECTOR DATABASE - Could not add messages, as the database is stopping")
+        return
+
+    try:
+        return _add_messages(channel_id, messages, executor, debug_info)
+    finally:
+        with _insert_lock:
+            _inserts_running -= 1
+            _inserts_done.notify_all()
 
-    if type(messages) != list: messages = [messages]
 
-    create_channel_memory_if_new(channel_id)
+def _add_messages(channel_id, messages, executor, debug_info):
+    '''
+    Body of `add_messages`, inserting batches with `executor`.
+    '''
+    if create_channel_memory_if_new(channel_id) is None: return
 
     # Check that I have indeed remembered to update this function after changing the schema entry fields
     schema_size_assumption = 5
@@ -275,62 +595,271 @@ def add_messages(channel_id, messages, debug_info=False):
         debug.log(ly, "[*] VECTOR DATABASE - Could not safely add messages, as schema size has changed without proper refactoring")
         return
 
+    # Messages that Milvus would reject are not sent at all, so that they can't fail the rest of their batch
+    if isinstance(messages, MessageBatch):
+        invalid = messages.invalid_reasons()
+    else:
+        invalid = {}
+        for i, message in enumerate(messages):
+            reason = invalid_reason(message)
+            if reason is not None: invalid[i] = reason
+    if len(invalid) > 0: debug.log(ly, f"[*] VECTOR DATABASE - {len(invalid)} invalid message{' was' if len(invalid) == 1 else 's were'} not inserted")
+    valid = [i for i in range(len(messages)) if i not in invalid]
+
     # Turn message entries into proper format
-    entries = [[] for _ in range(_SCHEMA_SIZE)]
-    for message in messages:
-        entries[0].append(message["id"]       )
-        entries[1].append(message["date"]     )
-        entries[2].append(message["author"]   )
-        entries[3].append(message["content"]  )
-        entries[4].append(message["embedding"])
+    if not isinstance(messages, MessageBatch): batch = MessageBatch.from_messages([messages[i] for i in valid])
+    elif len(invalid) > 0:                     batch = messages.take(valid)
+    else:                                      batch = messages
 
     if debug_info: debug.log(lb, "[-] Memory arranged")
 
-    # Check that all the messages are the correct size
-    # too_large_messages = []
-    # for enum in enumerate(entries[3]):
-    #     if len(enum[1]) > _MAX_MESSAGE_LENGTH:
-    #         too_large_messages.append(enum)
-    # if len(too_large_messages) > 0:
-    #     debug.log (ly, f"[*] VECTOR DATABASE - Could not add messages, as {len(too_large_messages)} too large message{ ' was' if len(too_large_messages) == 1 else 's were'} found" )
-    #     [debug.log(lb, f"                      index: {pair[0]}    message: {pair[1][:100]}") for pair in too_large_messages[:10]]
-        
+    failed = [False] * len(messages)
+    for i in invalid: failed[i] = True
+
+    # Batches are cut while earlier ones are still being inserted, so each gets the latest adapted size.
+    # Results arrive in any order, but are written into `failed` by index, so the failed slices stay in order
+    workers   = INSERT_WORKERS if _store.PARALLEL_INSERTS else 1
+    row_bytes = batch.nbytes / max(1, len(batch))
+    in_flight = set()
+    batch_end = 0
+    inserted  = 0
+    while batch_end < len(batch) or len(in_flight) > 0:
+        while batch_end < len(batch) and len(in_flight) < workers:
+            batch_start = batch_end
+            batch_end   = min(len(batch), batch_start + _next_batch_size(row_bytes))
+            in_flight.add(executor.submit(_insert_batch, str(channel_id), batch, batch_start, batch_end))
+
+        done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+        for future in done:
+            for row in future.result(): failed[valid[row]] = True
+            inserted += 1
+            if debug_info: debug.logt(lb, f"[-] VECTOR DATABASE - Batches Inserted: {inserted}")
 
-    batches_inserted = 0
     info = {
-        "fullSuccess"  : True,
-        "failedAmount" : 0,
-        "failedSlices" : []
+        "fullSuccess"  : not any(failed),
+        "failedAmount" : sum(failed),
+        "failedSlices" : [],
+        "invalid"      : invalid
     }
+    for i in range(len(messages)):
+        if not failed[i]: continue
+        if len(info["failedSlices"]) > 0 and info["failedSlices"][-1][1] == i: info["failedSlices"][-1][1] = i + 1
+        else: info["failedSlices"].append([i, i + 1])
 
-    while True:
-        if INSERT_BATCH_SIZE*batches_inserted >= len(messages): break
-        batch = [
-            entries[i][INSERT_BATCH_SIZE*batches_inserted:(batches_inserted+1)*INSERT_BATCH_SIZE] 
-            for i in range(_SCHEMA_SIZE)
-        ]
-        
-        try:
-            memory_collection.insert(batch, partition_name=str(channel_id))
-            if debug_info: debug.logt(lb, f"[-] VECTOR DATABASE - Batches Inserted: {batches_inserted + 1}")
-            
-        except Exception as e:
-            debug.log(ly,  "[*] VECTOR DATABASE - Inserting message batch failed")
-            debug.log(lb, f"                      exception  : {e}",             )
-            info["fullSuccess"]   = False
-            info["failedAmount"] += len(batch[0])
-            info["failedSlices"].append((INSERT_BATCH_SIZE*batches_inserted, (batches_inserted+1)*INSERT_BATCH_SIZE))
-
-        batches_inserted += 1
-
-    memory_collection.flush()
-    if info["fullSuccess"]: debug.log(lg, f"[#] VECTOR DATABASE - Memory flushed. Insert complete")
+    _count_unflushed(len(messages) - info["failedAmount"])
+    if info["fullSuccess"]: debug.log(lg, f"[#] VECTOR DATABASE - Insert complete")
     else: 
-        debug.log(ly, f"[*] VECTOR DATABASE - Memory flushed. Insert completed with {info['failedAmount']} failed inserts")
+        debug.log(ly, f"[*] VECTOR DATABASE - Insert completed with {info['failedAmount']} failed inserts")
         debug.log(lb, f"                      percentage: {info['failedAmount']/len(messages)*100} %",                    )
     return info
     
 
+def invalid_reason(message):
+    '''
+    Check a message against the limits of the schema.
+
+    RETURN
+    ------
+    Returns why Milvus would reject the message as `str`, or `None` if the message is valid.
+    '''
+    if len(message["date"]) > _MAX_DATE_LENGTH:                         return "date too long"
+    if len(message["author"].encode('utf-8'))  > _MAX_AUTHOR_LENGTH:    return "author too long"
+    if len(message["content"].encode('utf-8')) > _MAX_MESSAGE_LENGTH:   return "content too long"
+    if message.get("embedding") is None or len(message["embedding"]) != _DIM: return "embedding has wrong dimension"
+    return None
+
+
+def _next_batch_size(row_bytes):
+    '''
+    Returns how many rows the next insert batch should have, for rows of about `row_bytes` bytes.
+    '''
+    with _insert_lock:
+        return max(1, min(_insert_stats["batchSize"], int(INSERT_MAX_BATCH_BYTES // max(1, row_bytes))))
+
+
+def _insert_batch(partition_name, batch, start, end):
+    '''
+    Insert rows `start:end` of a `MessageBatch`, run by an insert worker.
+
+    Batches that inserted without failures adapt the batch size towards the amount of rows 
+    Milvus can insert in `INSERT_TARGET_SECONDS`, smoothed so that a single slow call doesn't halve it.
+
+    RETURN
+    ------
+    Returns the indexes of the failed rows.
+    '''
+    failed_rows = []
+    started = time.perf_counter()
+    _insert_bisected(partition_name, batch, start, end, failed_rows)
+    elapsed = time.perf_counter() - started
+
+    with _insert_lock:
+        _insert_stats["batches"] += 1
+        _insert_stats["rows"]    += end - start - len(failed_rows)
+        _insert_stats["bytes"]   += batch[start:end].nbytes
+        _insert_stats["seconds"] += elapsed
+        if len(failed_rows) == 0 and elapsed > 0:
+            target = (end - start) / elapsed * INSERT_TARGET_SECONDS
+            size   = 0.5 * _insert_stats["batchSize"] + 0.5 * target
+            _insert_stats["batchSize"] = int(min(INSERT_MAX_BATCH_SIZE, max(INSERT_MIN_BATCH_SIZE, size)))
+    return failed_rows
+
+
+def get_insert_stats():
+    '''
+    Get information about inserting.
+
+    RETURN
+    ------
+    Returns a dictionary containing the fields `batches`, `rows`, `bytes`, `seconds`, `batchSize`, and `workers`:
+
+    `batches` : `int`
+        Insert batches sent since start
+    `rows` : `int`
+        Messages inserted since start
+    `bytes` : `int`
+        Approximate bytes of all sent batches
+    `seconds` : `float`
+        Time spent inside insert calls, summed over all workers
+    `batchSize` : `int`
+        Rows of the next batch
+    `workers` : `int`
+        Batches inserted at the same time
+    '''
+    with _insert_lock:
+        return { **_insert_stats, "workers": INSERT_WORKERS if _store.PARALLEL_INSERTS else 1 }
+
+
+def _insert_bisected(partition_name, batch, start, end, failed_rows):
+    '''
+    Insert rows `start:end` of a `MessageBatch`. If the insert fails, the rows are split in halves which are inserted separately,
+    until the failing rows are found. Their indexes are appended into `failed_rows`.
+
+    If a half fails completely, Milvus itself is most likely failing rather than some rows,
+    so the remaining rows are given up on without trying them one by one.
+
+    RETURN
+    ------
+    Returns the amount of inserted rows.
+    '''
+    try:
+        _store.insert(partition_name, batch[start:end].columns())
+        return end - start
+    except Exception as e:
+        if end - start == 1:
+            debug.log(ly,  "[*] VECTOR DATABASE - Inserting message failed")
+            debug.log(lb, f"                      id         : {batch.ids[start]}")
+            debug.log(lb, f"                      exception  : {e}")
+            failed_rows.append(start)
+            return 0
+        debug.log(ly,  "[*] VECTOR DATABASE - Inserting message batch failed. Splitting it")
+        debug.log(lb, f"                      exception  : {e}",             )
+
+    middle   = (start + end) // 2
+    inserted = _insert_bisected(partition_name, batch, start, middle, failed_rows)
+    if inserted == 0 and middle - start > 1:
+        failed_rows.extend(range(middle, end))
+        return 0
+    return inserted + _insert_bisected(partition_name, batch, middle, end, failed_rows)
+
+
+def existing_ids(channel_id, message_ids):
+    '''
+    Find which messages are already inside a channel's memory.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel identifier
+
+    `message_ids` : `int[]`
+        Ids of the messages to look for
+
+    FAILURE
+    -------
+    `[*]` : Query failed
+
+    RETURN
+    ------
+    Returns a `set` of the ids that are inside the channel's memory, or `None` if the query failed.
+    '''
+    if len(message_ids) == 0: return set()
+
+    try:
+        return _store.existing_ids(channel_id, message_ids)
+    except Exception as e:
+        debug.log(ly,  "[*] VECTOR DATABASE - Failed to query existing messages")
+        debug.log(lb, f"                      exception: {e}",                  )
+
+
+def get_neighbors(channel_id, message_ids, before=NEIGHBORS_BEFORE, after=NEIGHBORS_AFTER, window=NEIGHBOR_WINDOW):
+    '''
+    Get the messages sent right before and after messages inside a channel's memory, with a single query for all of them.
+
+    Discord message ids grow with the time the message was sent,
+    so the messages sent within `window` seconds of a message are exactly an id range.
+    Messages further away in time are left out, as they most likely belong to a different conversation.
+
+    PARAMETERS
+    ----------
+    `channel_id` : unique `int`
+        Channel identifier
+
+    `message_ids` : `int[]`
+        Ids of the messages whose neighbors are wanted
+
+    `before`, `after` : `int`
+        At most how many messages to get before and after each message
+
+    `window` : `int`
+        Seconds before and after each message searched for neighbors
+
+    FAILURE
+    -------
+    `[*]` : Query failed
+
+    RETURN
+    ------
+    Returns a dictionary of message id -> messages as `dict[]` from oldest to newest, 
+    containing the message itself and its neighbors, with the fields `id`, `date`, `author`, and `content`.
+    Returns `None` if failed.
+    '''
+    if len(message_ids) == 0: return {}
+
+    try:
+        return _store.get_neighbors(channel_id, message_ids, before, after, window)
+    except Exception as e:
+        debug.log(ly,  "[*] VECTOR DATABASE - Failed to query neighboring messages")
+        debug.log(lb, f"                      exception: {e}",                     )
+
+
+def get_embeddings(channel_id, limit=10000):
+    '''
+    Get the ids and embeddings of messages inside a channel's memory.
+
+    FAILURE
+    -------
+    `[*]` : Query failed
+
+    RETURN
+    ------
+    Returns the tuple `( ids, embeddings )` containing at most `limit` messages, the embeddings as a float32 matrix.
+    Returns `None` if the query failed.
+    '''
+    try:
+        return _store.get_embeddings(channel_id, limit)
+    except Exception as e:
+        debug.log(ly,  "[*] VECTOR DATABASE - Failed to query embeddings")
+        debug.log(lb, f"                      exception: {e}",          )
+
+
+def list_channels():
+    '''
+    Returns the ids of the channels that have long-term memory, as `int[]`.
+    '''
+    return _store.list_channels()
+
+
 def drop_messages(channel_id, message_ids):
     '''
     Remove messages from channel's memory.
@@ -355,48 +884,150 @@ def drop_messages(channel_id, message_ids):
 
     `False` : Failed to remove messages
     '''
-    global memory_collection
-
     if type(message_ids) != list: message_ids = [message_ids]
 
-    expr = "id in " + str(message_ids)
+    try:    
+        _store.drop_messages(channel_id, message_ids)
+        debug.log(lg, f"[#] VECTOR DATABASE - Removed {len(message_ids)} messages")
+        return True
+    except Exception as e:
+        debug.log(ly,  "[*] VECTOR DATABASE - Removing messages failed")
+        debug.log(lb, f"                      exception  : {e}",       )
+        return False
+
+
+def _count_unflushed(amount):
+    '''
+    Remember that `amount` messages were inserted without a flush, and flush if they are due.
+    '''
+    with _flush_lock:
+        if _flush_state["unflushed"] == 0 and amount > 0: _flush_state["firstUnflushed"] = time.time()
+        _flush_state["unflushed"] += amount
+    flush_if_due()
 
-    if memory_collection.has_partition(str(channel_id)):
-        try:    
-            memory_collection.delete(expr, partition_name=str(channel_id))
-            debug.log(lg, f"[#] VECTOR DATABASE - Removed {len(message_ids[0])} messages")
-            return True
+
+def flush(force=False):
+    '''
+    Flush inserted messages, sealing the segments they were inserted into and persisting them.
+
+    Inserted messages are searchable before they are flushed, 
+    so flushing is only done every `FLUSH_INTERVAL` seconds or after `FLUSH_AFTER_ROWS` messages,
+    instead of after every insert, which would seal a new tiny segment every time.
+
+    PARAMETERS
+    ----------
+    `force` : `bool`
+        Flush even if nothing was inserted since the last flush
+
+    FAILURE
+    -------
+    `[*]` : Flush failed. Messages stay unflushed and are flushed next time
+
+    RETURN
+    ------
+    Returns `True` if the flush succeeded.
+    '''
+    with _flush_lock:
+        if _flush_state["unflushed"] == 0 and not force: return True
+        if not is_available(): return False
+        start = time.perf_counter()
+        try:
+            _store.flush()
         except Exception as e:
-            debug.log(ly,  "[*] VECTOR DATABASE - Removing messages failed")
-            debug.log(lb, f"                      exception  : {e}",       )
+            debug.log(ly,  "[*] VECTOR DATABASE - Flush failed")
+            debug.log(lb, f"                      exception: {e}")
             return False
+        elapsed = time.perf_counter() - start
+
+        _flush_stats["flushes"]      += 1
+        _flush_stats["rowsFlushed"]  += _flush_state["unflushed"]
+        _flush_stats["flushSeconds"] += elapsed
+        debug.log(lb, f"[-] VECTOR DATABASE - Memory flushed ( messages, seconds ): {_flush_state['unflushed']} {elapsed:.2f}")
+        _flush_state["unflushed"]       = 0
+        _flush_state["firstUnflushed"]  = None
+        _flush_state["lastFlush"]       = time.time()
+        return True
+
 
+def flush_if_due():
+    '''
+    Flush if `FLUSH_AFTER_ROWS` messages are unflushed, or unflushed messages are older than `FLUSH_INTERVAL` seconds.
+
+    Called after every insert. Call it periodically as well, so that the last messages of a quiet period get flushed.
+    '''
+    with _flush_lock:
+        unflushed = _flush_state["unflushed"]
+        due = unflushed >= FLUSH_AFTER_ROWS or (unflushed > 0 and time.time() - _flush_state["firstUnflushed"] >= FLUSH_INTERVAL)
+    if due: flush()
 
-def create_index():
+
+def get_segment_stats():
     '''
-    Generate a new index for AI's memory.
+    Get information about flushing and the segments of the collection.
 
     FAILURE
     -------
-    `[*]` Failed to create new index
+    `[*]` : Reading segment information failed. Segment fields are `None`
 
     RETURN
     ------
-    `True` : Index created
+    Returns a dictionary containing the fields 
+    `flushes`, `rowsFlushed`, `flushSeconds`, `unflushed`, `segments`, `segmentRows`, and `smallSegments`:
+
+    `flushes` : `int`
+        Flushes done since start
+    `rowsFlushed` : `int`
+        Messages flushed since start
+    `flushSeconds` : `float`
+        Total time spent flushing
+    `unflushed` : `int`
+        Messages inserted since the last flush
+    `segments` : `None || int`
+        Segments of the loaded partitions
+    `segmentRows` : `None || int[]`
+        Messages inside each of those segments
+    `smallSegments` : `None || int`
+        Segments with fewer than `FLUSH_AFTER_ROWS` messages
+    '''
+    with _flush_lock:
+        stats = { **_flush_stats, "unflushed": _flush_state["unflushed"], "segments": None, "segmentRows": None, "smallSegments": None }
 
-    `False` : Failed to create index
+    try:
+        stats["segments"], stats["segmentRows"] = _store.get_segment_stats()
+        stats["smallSegments"] = sum(1 for rows in stats["segmentRows"] if rows < FLUSH_AFTER_ROWS)
+    except Exception as e:
+        debug.log(ly,  "[*] VECTOR DATABASE - Failed to get segment information")
+        debug.log(lb, f"                      exception: {e}")
+    return stats
+
+
+def create_index(index=None):
     '''
+    Generate a new index for AI's memory, replacing the current index if it is different.
 
-    global memory_collection
+    The current index keeps serving searches while the new one is built, see `milvusVectorStore.create_index`.
 
-    index = {
-        "index_type": "IVF_FLAT",
-        "metric_type": "L2",
-        "params": {"nlist": 128},
-    }
+    PARAMETERS
+    ----------
+    `index` : `None || dict`
+        Index parameters in the format used by Milvus, containing the fields `index_type`, `metric_type`, and `params`.
+        By default `DEFAULT_INDEX`
+
+    FAILURE
+    -------
+    `[*]` Failed to create new index
+
+    RETURN
+    ------
+    `True` : Index created, or the same index already existed
+
+    `False` : Failed to create index
+    '''
+    if index is None: index = DEFAULT_INDEX
     try:
-        memory_collection.create_index("embedding", index)
-        debug.log(lg, f"[#] VECTOR DATABASE - New index created")
+        if get_index() == index: return True
+        _store.create_index(index)
+        debug.log(lg, f"[#] VECTOR DATABASE - New index created ( {index['index_type']} {index['metric_type']} {index['params']} )")
         return True
     except Exception as e:
         debug.log(ly,  "[*] VECTOR DATABASE - Failed to create a new index")
@@ -404,7 +1035,47 @@ def create_index():
         return False
 
 
-def search(channel_id, vectors=None, expr=None):
+def get_index():
+    '''
+    Get the parameters of the current index.
+
+    RETURN
+    ------
+    Returns the index parameters as `dict`, or `None` if there is no index.
+    '''
+    return _store.get_index()
+
+
+def count_entities(channel_id=None):
+    '''
+    Returns the amount of flushed messages inside a channel's memory, or inside all memory if `channel_id` is `None`.
+    '''
+    return _store.count_entities(channel_id)
+
+
+def search_params(index=None, nprobe=None, ef=None):
+    '''
+    Get the search parameters for an index, by default the current one.
+
+    PARAMETERS
+    ----------
+    `nprobe` : `None || int`
+        Clusters searched with IVF indexes. By default `SEARCH_NPROBE`
+
+    `ef` : `None || int`
+        Candidates searched with HNSW indexes. By default `SEARCH_EF`
+
+    RETURN
+    ------
+    Returns the search parameters in the format used by Milvus, containing the fields `metric_type` and `params`.
+    '''
+    if index is None: index = get_index() or DEFAULT_INDEX
+    if index["index_type"] == "HNSW": params = { "ef": ef or SEARCH_EF }
+    else:                             params = { "nprobe": nprobe or SEARCH_NPROBE }
+    return { "metric_type": index["metric_type"], "params": params }
+
+
+def search(channel_id, vectors=None, expr=None, limit=SEARCH_LIMIT, nprobe=None, ef=None, metric=None):
     '''
     Search for messages inside channel.
 
@@ -415,10 +1086,23 @@ def search(channel_id, vectors=None, expr=None):
         Channel identifier from which messages will searched from
 
     `vectors` : `float[_DIM] || float[][_DIM] || None`
-        A vector or a list of vectors that will be compared to all the messages' embeddings inside long-term memory of the channel
+        A vector or a list of vectors, or a float32 array or matrix of them, that will be compared to all the messages' embeddings inside long-term memory of the channel
 
     `expr` : `str || None`
-        A boolean expression used in search 
+        A boolean expression used in search. Not supported by the local backend
+
+    `limit` : `int`
+        Top-k, how many messages are returned for each vector
+
+    `nprobe` : `None || int`
+        Clusters searched with IVF indexes. More is slower, but finds more of the true nearest messages
+
+    `ef` : `None || int`
+        Candidates searched with HNSW indexes. Must be at least `limit`
+
+    `metric` : `None || str`
+        `L2` or `IP`. Must be the metric the index was built with, which is used by default.
+        ada-002 embeddings are normalized, so both give the same order
 
     ASSUMTIONS
     ----------
@@ -427,44 +1111,219 @@ def search(channel_id, vectors=None, expr=None):
 
     FAILURE
     -------
-    `[*]` : Search failed
+    `[*]` : Metric is not the metric of the index
+
+    `[*]` : Milvus is unreachable
+
+    `[*]` : Search failed, also when an expression is given to the local backend
 
     RETURN
     ------
     If fails, returns `None`
 
     If search succeeds, returns the result of the search, which is in the format given by Milvus.
+    Reranked and local results are lists of hits with the same `id`, `distance`, and `entity`.
+    With `L2` a smaller distance is nearer, with `IP` a larger distance is nearer.
 
     Check Milvus' documentation for more information on the search function.
     '''
-    global memory_collection
-
     if vectors is None and expr is None:
         debug.log(ly, "[*] VECTOR DATABASE - Failed to search database, as both vectors and expresion were invalid")
         return
     
-    if type(vectors) != list: vectors = [vectors]
-    
-    search_param = {
-        "data"              :   vectors,
-        "anns_field"        :   "embedding",
-        "param"             :   {"metric_type": "L2", "params": {"nprobe": 10}},
-        "limit"             :   10,
-        "expr"              :   expr,
-        "partition_names"   :   [str(channel_id)],
-        "output_fields"     :   ["date", "author", "content"]
-    }
+    if not is_available():
+        debug.log(ly, "[*] VECTOR DATABASE - Failed to search database, as Milvus is unreachable")
+        return
+
+    if vectors is not None: vectors = np.asarray(vectors, dtype=np.float32).reshape(-1, _DIM)
+
+    index = get_index() or DEFAULT_INDEX
+    param = search_params(index, nprobe=nprobe, ef=max(ef or SEARCH_EF, limit))
+    if metric is not None and metric != param["metric_type"]:
+        debug.log(ly, f"[*] VECTOR DATABASE - Failed to search with metric {metric}, as the index was built with {param['metric_type']}")
+        return
 
     try:
-        memory_collection.load([str(channel_id)])
-        res = memory_collection.search(**search_param)
-        memory_collection.release()
+        res = _store.search(channel_id, vectors, limit, param, expr)
         debug.log(lg, f"[#] VECTOR DATABASE - Search completed")
         return res
     except Exception as e:
         debug.log(ly,  "[*] VECTOR DATABASE - Failed search" )
         debug.log(lb, f"                      exception: {e}")
 
+
+def release_idle_partitions(release_all=False):
+    '''
+    Release loaded partitions that have been idle for too long, or that don't fit inside the memory budget,
+    see `milvusVectorStore.release_idle_partitions`.
+
+    Loading a partition checks the others, but call this periodically as well,
+    so that partitions are released even while no other partition is loaded.
+
+    PARAMETERS
+    ----------
+    `release_all` : `bool`
+        Release every loaded partition, no matter when it was used last
+
+    RETURN
+    ------
+    Returns the amount of released partitions.
+    '''
+    if not running: return 0
+    return _store.release_idle_partitions(release_all)
+
+
+def get_partition_stats():
+    '''
+    Get information about partition residency, see `milvusVectorStore.get_partition_stats`.
+
+    RETURN
+    ------
+    Returns a dictionary, or `None` if the backend keeps nothing loaded.
+    '''
+    return _store.get_partition_stats()
+
+
+def _shutdown_executor():
+    '''
+    Stop the async thread pool. Calls still waiting for a thread are cancelled, running calls are waited for.
+    '''
+    global _executor, _pending_slots
+    if _executor is None: return
+    _executor.shutdown(wait=True, cancel_futures=True)
+    _executor      = None
+    _pending_slots = None
+
+
+def _shutdown_insert_executor():
+    '''
+    Stop the insert thread pool, waiting for running `add_messages` calls and the batches they are inserting.
+    New calls are refused from now on.
+    '''
+    global _insert_executor
+    with _insert_lock:
+        if _insert_executor is None: return
+        executor, _insert_executor = _insert_executor, None
+        while _inserts_running > 0: _inserts_done.wait()
+    executor.shutdown(wait=True)
+
+
+async def _run_async(func, *args, timeout=None, **kwargs):
+    '''
+    Run a blocking function of this module inside the thread pool without blocking the event loop.
+
+    On timeout or cancellation the awaiting coroutine stops waiting immediately.
+    If the call was still waiting for a thread it never runs, 
+    otherwise the thread finishes the call in the background and its result is discarded.
+
+    PARAMETERS
+    ----------
+    `timeout` : Seconds to wait for the call. `None` waits until it is done
+
+    FAILURE
+    -------
+    `[*]` : Call took longer than `timeout`
+
+    RETURN
+    ------
+    Returns whatever `func` returns, or `None` on timeout.
+    After a timeout the outcome is unknown, so writes are only given a timeout when the caller asks for one.
+    '''
+    global _executor, _pending_slots
+
+    if _executor is None:
+        _executor      = ThreadPoolExecutor(max_workers=ASYNC_MAX_WORKERS, thread_name_prefix="vectorDatabase")
+        _pending_slots = asyncio.Semaphore(ASYNC_MAX_PENDING)
+
+    async def run():
+        async with _pending_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+    try:
+        return await asyncio.wait_for(run(), timeout)
+    except asyncio.TimeoutError:
+        debug.log(ly, f"[*] VECTOR DATABASE - {func.__name__} timed out")
+        debug.log(lb, f"                      timeout: {timeout}s"      )
+        return None
+
+
+async def acreate_channel_memory_if_new(channel_id, timeout=None):
+    '''
+    Asynchronous version of `create_channel_memory_if_new`.
+
+    Waits until the creation is done, unless `timeout` is given.
+    Returns `None` if `timeout` seconds passed, in which case the creation might still complete in the background.
+    '''
+    return await _run_async(create_channel_memory_if_new, channel_id, timeout=timeout)
+
+
+async def aremove_channel_memory_if_exist(channel_id, timeout=None):
+    '''
+    Asynchronous version of `remove_channel_memory_if_exist`.
+
+    Waits until the removal is done, unless `timeout` is given.
+    Returns `None` if `timeout` seconds passed, in which case the removal might still complete in the background.
+    '''
+    return await _run_async(remove_channel_memory_if_exist, channel_id, timeout=timeout)
+
+
+async def aadd_messages(channel_id, messages, debug_info=False, timeout=None):
+    '''
+    Asynchronous version of `add_messages`.
+
+    Waits until the insert is done, unless `timeout` is given.
+    Returns `None` if `timeout` seconds passed, in which case the insert might still complete in the background.
+    '''
+    return await _run_async(add_messages, channel_id, messages, debug_info=debug_info, timeout=timeout)
+
+
+async def aexisting_ids(channel_id, message_ids, timeout=None):
+    '''
+    Asynchronous version of `existing_ids`.
+
+    Returns `None` if `timeout` seconds passed, the same as a failed query. By default `ASYNC_TIMEOUT` is used.
+    '''
+    return await _run_async(existing_ids, channel_id, message_ids, timeout=ASYNC_TIMEOUT if timeout is None else timeout)
+
+
+async def aget_neighbors(channel_id, message_ids, before=NEIGHBORS_BEFORE, after=NEIGHBORS_AFTER, window=NEIGHBOR_WINDOW, timeout=None):
+    '''
+    Asynchronous version of `get_neighbors`.
+
+    Returns `None` if `timeout` seconds passed, the same as a failed query. By default `ASYNC_TIMEOUT` is used.
+    '''
+    return await _run_async(get_neighbors, channel_id, message_ids, before=before, after=after, window=window, timeout=ASYNC_TIMEOUT if timeout is None else timeout)
+
+
+async def adrop_messages(channel_id, message_ids, timeout=None):
+    '''
+    Asynchronous version of `drop_messages`.
+
+    Waits until the removal is done, unless `timeout` is given.
+    Returns `None` if `timeout` seconds passed, in which case the removal might still complete in the background.
+    '''
+    return await _run_async(drop_messages, channel_id, message_ids, timeout=timeout)
+
+
+async def acreate_index(index=None, timeout=None):
+    '''
+    Asynchronous version of `create_index`.
+
+    Waits until the index build is done, unless `timeout` is given.
+    Returns `None` if `timeout` seconds passed, in which case the index build might still complete in the background.
+    '''
+    return await _run_async(create_index, index, timeout=timeout)
+
+
+async def asearch(channel_id, vectors=None, expr=None, limit=SEARCH_LIMIT, nprobe=None, ef=None, metric=None, timeout=None):
+    '''
+    Asynchronous version of `search`.
+
+    Returns `None` if `timeout` seconds passed, the same as a failed search. By default `ASYNC_TIMEOUT` is used.
+    '''
+    return await _run_async(search, channel_id, vectors=vectors, expr=expr, limit=limit, nprobe=nprobe, ef=ef, metric=metric, timeout=ASYNC_TIMEOUT if timeout is None else timeout)
+
         
 def DROP_ALL_MEMORY():
     '''
@@ -472,10 +1331,8 @@ def DROP_ALL_MEMORY():
     
     SHOULD ONLY BE USED WITH ABSOLUTE CONFIDENCE!
     '''
-    global memory_collection
-    if utility.has_collection(_COLLECTION_NAME):
-        utility.drop_collection(_COLLECTION_NAME)
-        debug.log(lg, f"[#] VECTOR DATABASE - COLLECTION DROPPED")
+    _store.drop_all()
+    debug.log(lg, f"[#] VECTOR DATABASE - COLLECTION DROPPED")
 
 
 # def COPY_MEMORY_FROM_TO(from_collection, from_channel_id, to_collection, to_channel_id):
@@ -483,4 +1340,4 @@ def DROP_ALL_MEMORY():
 
 #     if utility.has_collection(from_collection):
 #         utility.drop_collection(_COLLECTION_NAME)
-#         debug.log(lg, f"[#] VECTOR DATABASE - COLLECTION DROPPED")
\ No newline at end of file
+#         debug.log(lg, f"[#] VECTOR DATABASE - COLLECTION DROPPED")